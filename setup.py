@@ -36,7 +36,7 @@ stakkr-compose=stakkr.stakkr_compose:cli''',
         'click-plugins==1.1.1',
         'clint==0.5.1',
         'PyYAML==3.13',
-        'anyconfig==0.9.0',
+        'jsonschema>=2.6.0,<4',
         'GitPython==3.1.7'
         ] + extra_packages,
     classifiers=[
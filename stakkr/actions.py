@@ -1,15 +1,19 @@
 # coding: utf-8
-"""Stakkr main controller. Used by the CLI to do all its actions."""
+"""
+Stakkr main controller. Used by the CLI to do all its actions.
+
+Heavy dependencies (docker, clint, yaml, jsonschema...) are imported by each action
+when needed, to keep the CLI startup fast.
+"""
 
 import os
+import re
 from platform import system as os_name
 import subprocess
 import sys
 import click
-from clint.textui import colored, puts, columns
-from stakkr import command, docker_actions as docker
-from stakkr.configreader import Config
-from stakkr.proxy import Proxy
+from stakkr import command
+from stakkr.profiler import phase, wrap
 
 
 class StakkrActions:
@@ -23,24 +27,31 @@ class StakkrActions:
         self.config = None
         self.project_name = None
         self.project_dir = None
+        self.config_file = None
         self.cwd_relative = None
+        # Running containers by service, resolved one by one
+        self.services_cts = dict()
+        # Client of the stakkr daemon, if it's running and gave the config
+        self.daemon = None
 
-    def console(self, container: str, user: str, tty: bool):
+    def console(self, container: str, user: str, tty: bool, engine: str = None):
         """Enter a container. Stakkr will try to guess the right shell."""
         self.init_project()
 
-        docker.check_cts_are_running(self.project_name)
-
-        tty = 't' if tty is True else ''
-        ct_name = docker.get_ct_name(container)
-        cmd = ['docker', 'exec', '-u', user, '-i' + tty]
-        cmd += [docker.get_ct_name(container), docker.guess_shell(ct_name)]
-        subprocess.call(cmd)
+        ct_info = self.get_running_container(container)
+        shell = self._guess_shell(ct_info)
+        # A console needs a real exec, even with sessions
+        if self._get_exec_engine(engine) != 'cli':
+            return self._exec_api(ct_info['name'], [shell], user, None, tty, lambda: self._console_cli(
+                ct_info['name'], shell, user, tty))
 
-        command.verbose(self.context['VERBOSE'], 'Command : "' + ' '.join(cmd) + '"')
+        return self._console_cli(ct_info['name'], shell, user, tty)
 
     def get_services_urls(self):
         """Once started, displays a message with a list of running containers."""
+        from clint.textui import colored
+        from stakkr import docker_actions as docker
+
         self.init_project()
 
         cts = docker.get_running_containers(self.project_name)[1]
@@ -63,28 +74,92 @@ class StakkrActions:
 
         return text
 
-    def exec_cmd(self, container: str, user: str, args: tuple, tty: bool, workdir: str):
-        """Run a command from outside to any container. Wrapped into /bin/sh."""
+    def exec_cmd(self, container: str, user: str, args: tuple, tty: bool, workdir: str = None, engine: str = None,
+                 outputs: tuple = None):
+        """
+        Run a command from outside to any container, return its exit code.
+        outputs are binary streams (stdout, stderr) to get the output instead of the terminal, without stdin.
+        """
         self.init_project()
 
-        docker.check_cts_are_running(self.project_name)
-
-        # Protect args to avoid strange behavior in exec
-        args = ['"{}"'.format(arg) for arg in args]
+        ct_info = self.get_running_container(container)
         workdir = "/var/{}".format(self.cwd_relative) if workdir is None else workdir
-        tty = 't' if tty is True else ''
-        ct_name = docker.get_ct_name(container)
-        cmd = ['docker', 'exec', '-u', user, '-i' + tty, '-w', workdir, ct_name, 'sh', '-c']
-        cmd += ["""exec {}""".format(' '.join(args))]
-        command.verbose(self.context['VERBOSE'], 'Command : "' + ' '.join(cmd) + '"')
-        subprocess.call(cmd, stdin=sys.stdin)
+        engine = self._get_exec_engine(engine)
+        reason = None if engine != 'session' or outputs is not None else _get_session_blocker(tty)
+        if reason is not None:
+            command.verbose(self.context['VERBOSE'], "Can't use a session ({}), using the API".format(reason))
+            engine = 'api'
+
+        if engine == 'session':
+            return self._exec_session(ct_info['name'], args, user, workdir, outputs, lambda: self._exec_api(
+                ct_info['name'], _get_shell_cmd(args), user, workdir, tty, lambda: self._exec_cli(
+                    ct_info['name'], args, user, workdir, tty, outputs), outputs))
+
+        if engine != 'cli':
+            return self._exec_api(ct_info['name'], _get_shell_cmd(args), user, workdir, tty, lambda: self._exec_cli(
+                ct_info['name'], args, user, workdir, tty, outputs), outputs)
+
+        return self._exec_cli(ct_info['name'], args, user, workdir, tty, outputs)
+
+    def get_container(self, service: str):
+        """Get the running container of a service without listing all containers, None if not running."""
+        self.init_project()
+        if self.services_cts.get(service) is None:
+            self.services_cts[service] = self._ask_daemon('container', service=service)
+
+        if self.services_cts.get(service) is None and self.daemon is None:
+            from stakkr import docker_actions as docker
+
+            self.services_cts[service] = docker.get_service_container(self.project_name, service)
+
+        return self.services_cts[service]
+
+    def get_containers(self, services: list):
+        """Get the running containers of several services, listing all containers once if needed."""
+        self.init_project()
+        missing = [service for service in set(services) if self.services_cts.get(service) is None]
+        if len(missing) > 1 and self.daemon is None:
+            for ct_info in self.get_running_containers()[1].values():
+                self.services_cts[ct_info['compose_name']] = ct_info
+
+        return {service: self.get_container(service) for service in services}
+
+    def get_running_containers(self):
+        """Get the number of running containers and their details."""
+        self.init_project()
+        containers = self._ask_daemon('containers')
+        if containers is not None:
+            return containers['running'], {ct_info['name']: ct_info for ct_info in containers['containers']}
+
+        from stakkr import docker_actions as docker
+
+        return docker.get_running_containers(self.project_name)
+
+    def get_running_container(self, service: str):
+        """Same as get_container but throw an error if the service is not running."""
+        ct_info = self.get_container(service)
+        if ct_info is None:
+            raise LookupError('{} does not seem to be started ...'.format(service))
+
+        return ct_info
 
     def get_config(self):
-        """Read and validate config from config file"""
-        config = Config(self.context['CONFIG'])
-        main_config = config.read()
+        """Read and validate config from config file (once per process), from the daemon if it runs"""
+        from stakkr.configreader import get_session
+        from stakkr.daemon import get_daemon_client
+
+        session = get_session(self.context['CONFIG'])
+        self.config_file = session.config_file
+        self.daemon = get_daemon_client()
+        main_config = self._ask_daemon('config')
+        if main_config is not None:
+            return main_config
+
+        # Invalid config (errors are displayed below) or daemon not running
+        self.daemon = None
+        main_config = session.get_config()
         if main_config is False:
-            config.display_errors()
+            session.reader.display_errors()
             sys.exit(1)
 
         return main_config
@@ -97,7 +172,8 @@ class StakkrActions:
         if self.config is not None:
             return
 
-        self.config = self.get_config()
+        with phase('config'):
+            self.config = self.get_config()
         self.project_name = self.config['project_name']
         self.project_dir = self.config['project_dir']
         sys.path.append(self.project_dir)
@@ -107,70 +183,296 @@ class StakkrActions:
 
     def start(self, container: str, pull: bool, recreate: bool, proxy: bool):
         """If not started, start the containers defined in config."""
+        from concurrent.futures import ThreadPoolExecutor
+        from stakkr import docker_actions as docker
+        from stakkr.proxy import Proxy
+
         self.init_project()
         verb = self.context['VERBOSE']
-        debug = self.context['DEBUG']
-
-        self._is_up(container)
-
-        if pull is True:
-            command.launch_cmd_displays_output(self._get_compose_base_cmd() + ['pull'], verb, debug, True)
 
-        recreate_param = '--force-recreate' if recreate is True else '--no-recreate'
-        cmd = self._get_compose_base_cmd() + ['up', '-d', recreate_param, '--remove-orphans']
-        cmd += _get_single_container_option(container)
-
-        command.verbose(self.context['VERBOSE'], 'Command: ' + ' '.join(cmd))
-        command.launch_cmd_displays_output(cmd, verb, debug, True)
-
-        running_cts, cts = docker.get_running_containers(self.project_name)
-        if not running_cts:
-            raise SystemError("Couldn't start the containers, run the start with '-v' and '-d'")
-
-        self._run_iptables_rules(cts)
-        if proxy is True:
-            conf = self.config['proxy']
-            Proxy(conf.get('http_port'), conf.get('https_port'), version=conf.get('version')).start(
-                docker.get_network_name(self.project_name))
+        with phase('check'):
+            self._is_up(container)
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            # Images (known once the config is resolved) are pulled and the proxy container starts
+            # while compose loads the project, compose up waits for the pull
+            images_pull = None
+            if pull is True:
+                images_pull = executor.submit(
+                    wrap('images pull', self._pull_images), _get_single_container_option(container))
+
+            proxy_start = None
+            if proxy is True:
+                conf = self.config['proxy']
+                stakkr_proxy = Proxy(conf.get('http_port'), conf.get('https_port'), version=conf.get('version'),
+                                     pull=conf.get('pull', 'missing'))
+                proxy_start = executor.submit(_run_timed, wrap('proxy start', stakkr_proxy.start))
+
+            try:
+                _, compose_time = _run_timed(self._compose_up, container, images_pull, recreate)
+
+                with phase('containers'):
+                    running_cts, cts = docker.get_running_containers(self.project_name)
+                if not running_cts:
+                    raise SystemError("Couldn't start the containers, run the start with '-v' and '-d'")
+            except Exception:
+                if proxy_start is not None:
+                    _stop_started_proxy(stakkr_proxy, proxy_start, verb)
+                raise
+
+            with phase('iptables'):
+                self._run_iptables_rules(cts)
+            if proxy_start is not None:
+                # Raises the error of the proxy start, if any
+                _, proxy_time = proxy_start.result()
+                # The network exists only once compose started the services
+                with phase('proxy network'):
+                    stakkr_proxy.connect(docker.get_network_name(self.project_name))
+                command.verbose(verb, 'Proxy started in {:.2f}s during compose up, {:.2f}s saved'.format(
+                    proxy_time, min(proxy_time, compose_time)))
 
     def status(self):
         """Return a nice table with the list of started containers."""
+        from clint.textui import colored, puts
+
         self.init_project()
 
-        try:
-            docker.check_cts_are_running(self.project_name)
-        except SystemError:
+        with phase('containers'):
+            running_cts, cts = self.get_running_containers()
+        if not running_cts:
             puts(colored.yellow('[INFO]') + ' stakkr is currently stopped')
             sys.exit(0)
 
-        _, cts = docker.get_running_containers(self.project_name)
-
-        _print_status_headers()
-        _print_status_body(cts)
+        with phase('display'):
+            _print_status_headers()
+            _print_status_body(cts)
 
     def stop(self, container: str, proxy: bool):
         """If started, stop the containers defined in config. Else throw an error."""
+        from stakkr import docker_actions as docker
+        from stakkr.proxy import Proxy
+
         self.init_project()
         verb = self.context['VERBOSE']
         debug = self.context['DEBUG']
 
-        docker.check_cts_are_running(self.project_name)
+        with phase('check'):
+            docker.check_cts_are_running(self.project_name)
+
+        with phase('sessions'):
+            from stakkr.exec_session import close_sessions
+
+            close_sessions(self.project_dir)
 
-        cmd = self._get_compose_base_cmd() + ['stop'] + _get_single_container_option(container)
-        command.launch_cmd_displays_output(cmd, verb, debug, True)
+        with phase('compose project'):
+            compose_project = self._get_compose_project()
+        with phase('compose stop'):
+            if compose_project is not None:
+                compose_project.stop(_get_single_container_option(container))
+            else:
+                cmd = self._get_compose_base_cmd() + ['stop'] + _get_single_container_option(container)
+                command.launch_cmd_displays_output(cmd, verb, debug, True)
 
-        running_cts, _ = docker.get_running_containers(self.project_name)
+        with phase('containers'):
+            running_cts, _ = docker.get_running_containers(self.project_name)
         if running_cts and container is None:
             raise SystemError("Couldn't stop services ...")
 
         if proxy is True:
-            Proxy().stop()
+            with phase('proxy stop'):
+                Proxy().stop()
+
+    def wait(self, services: list = None, timeout: float = None):
+        """Wait until the services (all the running ones by default) are ready, display the time each one took."""
+        from stakkr.readiness import get_probe, wait_for
+
+        self.init_project()
+        cts = {ct_info['compose_name']: ct_info for ct_info in self.get_running_containers()[1].values()}
+        services = sorted(cts) if not services else list(services)
+        for service in services:
+            if service not in cts:
+                raise LookupError('{} does not seem to be started ...'.format(service))
+
+        timeout = self.config['wait']['timeout'] if timeout is None else timeout
+        probes = [get_probe(cts[service], self.config['services'].get(service, {}), self.config['proxy'])
+                  for service in services]
+        results = wait_for(probes, timeout)
+        for service in services:
+            if results[service]['seconds'] is None:
+                print(click.style('[NOT READY]', fg='red') + ' {} ({})'.format(service, results[service]['probe']))
+                continue
+
+            print(click.style('[READY]', fg='green') + ' {} in {:.2f}s ({})'.format(
+                service, results[service]['seconds'], results[service]['probe']))
+
+        not_ready = [service for service in services if results[service]['seconds'] is None]
+        if not_ready:
+            raise SystemError('Services not ready after {}s: {}'.format(timeout, ', '.join(not_ready)))
+
+    def _ask_daemon(self, action: str, **params):
+        """Ask the daemon for the current project, None if there is no daemon (or it stopped)."""
+        if self.daemon is None:
+            return None
+
+        try:
+            return self.daemon.query(action, config=self.config_file, **params)
+        except (ConnectionError, RuntimeError):
+            self.daemon = None
+
+        return None
+
+    def _compose_up(self, container: str, images_pull, recreate: bool):
+        """Start the services once the images are pulled (images_pull is the future of the pull, or None)."""
+        verb = self.context['VERBOSE']
+        debug = self.context['DEBUG']
+
+        with phase('compose project'):
+            compose_project = self._get_compose_project()
+        # The native pull couldn't list the images: compose pulls them
+        with phase('images pull wait'):
+            compose_pull = images_pull is not None and images_pull.result() is None
+        if compose_project is not None:
+            if compose_pull is True:
+                with phase('compose pull'):
+                    compose_project.pull(_get_single_container_option(container), verb)
+            with phase('compose up'):
+                compose_project.up(_get_single_container_option(container), recreate)
+            return
+
+        if compose_pull is True:
+            with phase('compose pull'):
+                command.launch_cmd_displays_output(self._get_compose_base_cmd() + ['pull'], verb, debug, True)
+
+        with phase('compose up'):
+            recreate_param = '--force-recreate' if recreate is True else '--no-recreate'
+            cmd = self._get_compose_base_cmd() + ['up', '-d', recreate_param, '--remove-orphans']
+            cmd += _get_single_container_option(container)
+
+            command.verbose(self.context['VERBOSE'], 'Command: ' + ' '.join(cmd))
+            command.launch_cmd_displays_output(cmd, verb, debug, True)
+
+    def _pull_images(self, services: list):
+        """Pull the images with the docker API, return None if they can't be listed (compose pulls them)."""
+        from time import perf_counter
+        from stakkr.docker_pull import pull_services_images
+
+        start = perf_counter()
+        results = pull_services_images(self.config, services, self.context['VERBOSE'])
+        if results is not None:
+            pulled = [image for image, result in results.items() if result['status'] == 'pulled']
+            command.verbose(self.context['VERBOSE'], '{} images pulled, {} up to date in {:.2f}s'.format(
+                len(pulled), len(results) - len(pulled), perf_counter() - start))
+
+        return results
+
+    def _console_cli(self, ct_name: str, shell: str, user: str, tty: bool):
+        tty = 't' if tty is True else ''
+        cmd = ['docker', 'exec', '-u', user, '-i' + tty, ct_name, shell]
+        command.verbose(self.context['VERBOSE'], 'Command : "' + ' '.join(cmd) + '"')
+
+        return subprocess.call(cmd)
+
+    def _exec_api(self, ct_name: str, cmd: list, user: str, workdir: str, tty: bool, fallback, outputs: tuple = None):
+        """Run a command with the docker API, call fallback if docker can't create it."""
+        from docker.errors import DockerException
+        from stakkr.docker_exec import DockerExec
+
+        streams = dict()
+        if outputs is not None:
+            streams = dict(stdin=open(os.devnull, 'rb'), stdout=outputs[0], stderr=outputs[1])
+        try:
+            docker_exec = DockerExec(ct_name, cmd, user, workdir, tty, **streams)
+        except DockerException as error:
+            command.verbose(self.context['VERBOSE'], "Can't exec with the API ({}), using docker CLI".format(error))
+            return fallback()
+
+        command.verbose(self.context['VERBOSE'], 'Exec in {} : "{}"'.format(ct_name, ' '.join(map(str, cmd))))
+
+        try:
+            return docker_exec.run()
+        finally:
+            if 'stdin' in streams:
+                streams['stdin'].close()
+
+    def _exec_cli(self, ct_name: str, args: tuple, user: str, workdir: str, tty: bool, outputs: tuple = None):
+        tty = 't' if tty is True else ''
+        cmd = ['docker', 'exec', '-u', user, '-i' + tty, '-w', workdir, ct_name] + _get_shell_cmd(args)
+        command.verbose(self.context['VERBOSE'], 'Command : "' + ' '.join(cmd) + '"')
+        if outputs is None:
+            return subprocess.call(cmd, stdin=sys.stdin)
+
+        process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        command.pump(process, outputs[0].write, outputs[1].write)
+
+        return process.wait()
+
+    def _exec_session(self, ct_name: str, args: tuple, user: str, workdir: str, outputs: tuple, fallback):
+        """Run a command in the session of the container, call fallback if the session can't be started."""
+        from stakkr import exec_session
+
+        if outputs is None:
+            outputs = (getattr(sys.stdout, 'buffer', sys.stdout), getattr(sys.stderr, 'buffer', sys.stderr))
+        timeout = self.config.get('exec', {}).get('session_timeout', 600)
+        command.verbose(self.context['VERBOSE'], 'Exec in the session of {} : "{}"'.format(
+            ct_name, ' '.join(map(str, args))))
+        try:
+            return exec_session.run(
+                self.project_dir, ct_name, user, _quote_args(args), workdir, timeout, outputs[0], outputs[1])
+        except ConnectionError as error:
+            command.verbose(self.context['VERBOSE'], "Can't use a session ({}), using the API".format(error))
+            return fallback()
+
+    def _get_exec_engine(self, engine: str = None):
+        """Engine given in the command line, else from config. The CLI if the API can't be used here."""
+        from stakkr.docker_exec import api_available
+
+        if engine is None:
+            engine = self.config.get('exec', {}).get('engine', 'api')
+
+        if engine in ('api', 'session') and api_available() is False:
+            return 'cli'
+
+        return engine
 
     def _get_compose_base_cmd(self):
+        # The config file is absolute, as we moved to the project dir
         if self.context['CONFIG'] is None:
             return ['stakkr-compose']
 
-        return ['stakkr-compose', '-c', self.context['CONFIG']]
+        return ['stakkr-compose', '-c', self.config_file]
+
+    def _get_compose_project(self):
+        """In-process compose project, or None to run stakkr-compose (compose.engine: cli)."""
+        if self.config.get('compose', {}).get('engine', 'api') != 'api':
+            return None
+
+        try:
+            from stakkr.stakkr_compose import ComposeProject
+            compose_project = ComposeProject(self.config)
+        except ImportError as error:
+            command.verbose(self.context['VERBOSE'], "Can't load compose ({}), using stakkr-compose".format(error))
+            return None
+
+        command.verbose(self.context['VERBOSE'], 'Compose files: ' + ', '.join(compose_project.files))
+
+        return compose_project
+
+    def _guess_shell(self, ct_info: dict):
+        """Guess the shell of a container, cached by image as it can't change."""
+        from stakkr import docker_actions as docker
+        from stakkr.file_utils import get_stakkr_dir, read_json, write_json
+
+        try:
+            cache_file = get_stakkr_dir(self.project_dir, 'cache') + '/shells.json'
+        except OSError:
+            return docker.guess_shell(ct_info['name'])
+
+        shells = read_json(cache_file, {})
+        if ct_info['image_id'] not in shells:
+            shells[ct_info['image_id']] = docker.guess_shell(ct_info['name'])
+            write_json(cache_file, shells)
+
+        return shells[ct_info['image_id']]
 
     def _get_relative_dir(self):
         if os.getcwd().startswith(self.project_dir):
@@ -179,6 +481,9 @@ class StakkrActions:
         return ''
 
     def _is_up(self, container: str):
+        from clint.textui import colored, puts
+        from stakkr import docker_actions as docker
+
         try:
             docker.check_cts_are_running(self.project_name)
         except SystemError:
@@ -196,14 +501,15 @@ class StakkrActions:
 
     def _run_iptables_rules(self, cts: dict):
         """For some containers we need to add iptables rules added from the config."""
+        from stakkr import docker_actions as docker
+
+        services_ports = dict()
         for _, ct_info in cts.items():
-            container = ct_info['compose_name']
-            ct_config = self.config['services'][container]
-            if 'blocked_ports' not in ct_config:
-                continue
+            ct_config = self.config['services'][ct_info['compose_name']]
+            if 'blocked_ports' in ct_config:
+                services_ports[ct_info['compose_name']] = ct_config['blocked_ports']
 
-            blocked_ports = ct_config['blocked_ports']
-            error, msg = docker.block_ct_ports(container, blocked_ports, self.project_name)
+        for _, (error, msg) in docker.block_cts_ports(self.project_name, services_ports).items():
             if error is True:
                 click.secho(msg, fg='red')
                 continue
@@ -212,6 +518,9 @@ class StakkrActions:
 
     def get_url(self, service_url: str, service: str):
         """Build URL to be displayed."""
+        from clint.textui import colored, puts
+        from stakkr import docker_actions as docker
+
         proxy_conf = self.config['proxy']
         # By default our URL is the IP
         url = docker.get_ct_item(service, 'ip')
@@ -228,6 +537,56 @@ class StakkrActions:
         return ' / '.join(urls)
 
 
+def _get_shell_cmd(args: tuple):
+    """Wrap a command into /bin/sh."""
+    return ['sh', '-c', 'exec {}'.format(_quote_args(args))]
+
+
+def _get_session_blocker(tty: bool):
+    """Why a command can't run in a session (without TTY nor input), None if it can."""
+    from stakkr.exec_session import input_needed
+
+    try:
+        terminal = sys.stdin.isatty()
+    except (AttributeError, ValueError):
+        terminal = False
+
+    if tty is True and terminal is True:
+        return 'a TTY is asked, use --no-tty'
+
+    if input_needed() is True:
+        return 'it has an input to read'
+
+    return None
+
+
+def _quote_args(args: tuple):
+    """Each arg double quoted: variables are expanded in the container but spaces and quotes are kept."""
+    return ' '.join('"{}"'.format(re.sub(r'(["\\`])', r'\\\1', str(arg))) for arg in args)
+
+
+def _run_timed(func, *args):
+    """Run a function, return its result and how long it took."""
+    from time import perf_counter
+
+    start = perf_counter()
+    result = func(*args)
+
+    return result, perf_counter() - start
+
+
+def _stop_started_proxy(stakkr_proxy, proxy_start, verb: bool):
+    """The services didn't start: stop the proxy if it was started with them."""
+    try:
+        started, _ = proxy_start.result()
+    except Exception as error:
+        command.verbose(verb, "The proxy didn't start either ({})".format(error))
+        return
+
+    if started is True:
+        stakkr_proxy.stop()
+
+
 def _get_single_container_option(container: str):
     if container is None:
         return []
@@ -237,6 +596,8 @@ def _get_single_container_option(container: str):
 
 def _print_status_headers():
     """Display messages for stakkr status (header)"""
+    from clint.textui import colored, puts, columns
+
     puts(columns(
         [(colored.green('Container')), 16], [colored.green('IP'), 15],
         [(colored.green('Url')), 32], [(colored.green('Image')), 32],
@@ -252,6 +613,8 @@ def _print_status_headers():
 
 def _print_status_body(cts: dict):
     """Display messages for stakkr status (body)"""
+    from clint.textui import puts, columns
+
     for container in sorted(cts.keys()):
         ct_data = cts[container]
         if ct_data['ip'] == '':
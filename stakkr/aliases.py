@@ -1,36 +1,241 @@
 # coding: utf-8
 """Aliases management"""
 
-from sys import argv
-from yaml import load, error
-from stakkr.configreader import get_config_and_project_dir
+from click import echo
+from stakkr.configreader import get_session
 
 
-def get_config_from_argv(argv: list):
-    """Search for a config file option in command line"""
-    for index, arg in enumerate(argv):
-        # manage "=" sign
-        if arg.find('=') != -1 and arg.split('=')[0] == '--config':
-            return arg.split('=')[1]
+def get_aliases(config_file: str = None):
+    """Get aliases from config file"""
+    config = get_session(config_file).get_user_config()
+    if not isinstance(config.get('aliases'), dict):
+        return {}
 
-        # else search for -c  or --config and get the next value
-        if arg in ['-c', '--config']:
-            try:
-                return argv[index + 1]
-            except IndexError:
-                raise ValueError('You must specify the config file name')
+    return config['aliases']
 
-    return None
 
+def get_steps(alias: str, conf: dict):
+    """
+    Return the steps of an alias with their id (given, or their position) and
+    the ids of the steps they wait for. Without "parallel", a step waits for the
+    previous one and ids can't be given. Raise a ValueError if an id is unknown
+    or steps wait for each other.
+    """
+    if conf.get('parallel') is not True and any('id' in step or 'depends_on' in step for step in conf['exec']):
+        raise ValueError('Alias {}: "id" and "depends_on" need "parallel: true", else the steps run in order'.format(
+            alias))
 
-def get_aliases():
-    """Get aliases from config file"""
-    config_file, _ = get_config_and_project_dir(get_config_from_argv(argv[1:]))
-    config = {}
-    try:
-        with open(config_file, 'r') as stream:
-            config = load(stream)
-    except (error.YAMLError, FileNotFoundError):
-        pass
-
-    return config['aliases'] if 'aliases' in config else {}
+    steps = []
+    for num, step in enumerate(conf['exec']):
+        step = dict(step, id=str(step.get('id', num + 1)))
+        default_deps = [] if conf.get('parallel') is True or num == 0 else [steps[-1]['id']]
+        step['depends_on'] = [str(dep) for dep in step.get('depends_on', default_deps)]
+        steps.append(step)
+
+    ids = [step['id'] for step in steps]
+    for step in steps:
+        if ids.count(step['id']) > 1:
+            raise ValueError('Alias {}: the id "{}" is used by several steps'.format(alias, step['id']))
+        unknown = set(step['depends_on']) - set(ids)
+        if unknown:
+            raise ValueError('Alias {}: step "{}" depends on unknown steps: {}'.format(
+                alias, step['id'], ', '.join(sorted(unknown))))
+
+    _check_cycles(alias, steps)
+
+    return steps
+
+
+def run_steps(steps: list, run_step, concurrency: int = 4):
+    """
+    Run each step (run_step(step) returns an exit code) once the steps it
+    depends on succeeded, up to concurrency at the same time. After a failure
+    no step is started, the running ones end. Return the exit code of each
+    step, None for the ones not run.
+    """
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    results = {step['id']: None for step in steps}
+    waiting = list(steps)
+    running = dict()
+    failed = False
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while waiting or running:
+            ready = [] if failed else [step for step in waiting if all(
+                results[dep] == 0 for dep in step['depends_on'])]
+            for step in ready:
+                waiting.remove(step)
+                running[executor.submit(run_step, step)] = step['id']
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+                failed = failed or future.result() != 0
+
+    return results
+
+
+class RunCache:
+    """
+    Last successful run of an alias that declares its inputs (and outputs): globs
+    of files under the project dir. The alias is up to date if its commands,
+    the extra arguments and the content of these files did not change since.
+    Runs are kept in .stakkr/aliases.json.
+    """
+
+    def __init__(self, project_dir: str, alias: str, conf: dict, extra_args: tuple = None):
+        """The cache is only used if the alias has inputs."""
+        from stakkr.file_utils import get_stakkr_dir, read_json
+
+        self.project_dir = project_dir
+        self.alias = alias
+        self.conf = conf
+        self.extra_args = list(extra_args or [])
+        self.enabled = bool(conf.get('inputs'))
+        self.cache_file = get_stakkr_dir(project_dir) + '/aliases.json' if self.enabled else None
+        self.runs = read_json(self.cache_file, {}) if self.enabled else {}
+
+    def is_up_to_date(self):
+        """True if the last run succeeded with the same commands and files, and the outputs are still there."""
+        last_run = self.runs.get(self.alias)
+        if last_run is None:
+            return False
+
+        fingerprint = self._get_fingerprint(last_run.get('files', {}))
+
+        return fingerprint is not None and all(fingerprint[key] == last_run.get(key) for key in ('inputs', 'outputs'))
+
+    def save(self):
+        """
+        Record a successful run (files are read again, the commands could have changed them).
+        Other aliases could have been saved meanwhile (stakkr watch): the file is read again, locked.
+        """
+        if self.enabled is False:
+            return
+
+        from stakkr.file_utils import lock_file, read_json, write_json
+
+        fingerprint = self._get_fingerprint(self.runs.get(self.alias, {}).get('files', {}), False)
+        with lock_file(self.cache_file):
+            self.runs = read_json(self.cache_file, {})
+            # Without its inputs, the alias is never up to date: the run is not recorded
+            if fingerprint is None:
+                self.runs.pop(self.alias, None)
+            else:
+                self.runs[self.alias] = fingerprint
+            write_json(self.cache_file, self.runs)
+
+    def _get_fingerprint(self, known_files: dict, outputs_required: bool = True):
+        """Hashes of the inputs and outputs, None if an input (or an output) is missing."""
+        import json
+
+        files = dict()
+        inputs = _hash_files(self.project_dir, self.conf['inputs'], known_files, files)
+        outputs = _hash_files(self.project_dir, self.conf.get('outputs', []), known_files, files)
+        if inputs is None or (outputs is None and outputs_required is True):
+            return None
+
+        definition = json.dumps([self.conf['exec'], self.extra_args], sort_keys=True)
+
+        return {'inputs': _get_digest(definition, inputs), 'outputs': _get_digest('', outputs), 'files': files}
+
+
+class PrefixedOutput:
+    """Binary stream writing whole lines, prefixed, to a text stream shared (with a lock) by several steps."""
+
+    def __init__(self, prefix: str, stream, lock):
+        """lock is the one of all the outputs written to the stream."""
+        self.prefix = prefix
+        self.stream = stream
+        self.lock = lock
+        self.pending = bytearray()
+
+    def write(self, data: bytes):
+        """Write the complete lines received, keep the rest."""
+        self.pending += data
+        end = self.pending.rfind(b'\n') + 1
+        if end > 0:
+            self._write_lines(bytes(self.pending[:end]))
+            del self.pending[:end]
+
+        return len(data)
+
+    def flush(self):
+        """Lines are written as soon as they end."""
+
+    def close(self):
+        """Write the last line, even if it doesn't end."""
+        if self.pending:
+            self._write_lines(bytes(self.pending) + b'\n')
+            self.pending = bytearray()
+
+    def _write_lines(self, data: bytes):
+        lines = data.decode(errors='replace').splitlines(True)
+        with self.lock:
+            # click removes the colors if it's not a terminal
+            echo(''.join(self.prefix + line for line in lines), file=self.stream, nl=False)
+
+
+def _get_digest(definition: str, hashes: dict):
+    from hashlib import sha256
+
+    digest = sha256(definition.encode())
+    for filename in sorted(hashes or {}):
+        digest.update('{}\0{}\0'.format(filename, hashes[filename]).encode())
+
+    return digest.hexdigest()
+
+
+def _hash_files(project_dir: str, patterns: list, known_files: dict, files: dict):
+    """
+    Hash the files matching the globs (all files of the directories matched),
+    None if a glob matches no file. A file with the same mtime and size than
+    in known_files is not read again. files receives [mtime, size, hash] of each file.
+    """
+    from glob import glob
+    from os import walk
+    from os.path import isdir, join, relpath
+
+    hashes = dict()
+    for pattern in patterns:
+        paths = []
+        for match in glob(join(project_dir, pattern), recursive=True):
+            paths += [join(root, name) for root, _, names in walk(match) for name in names] if isdir(match) else [match]
+        if not paths:
+            return None
+
+        for path in paths:
+            filename = relpath(path, project_dir)
+            files[filename] = _hash_file(path, known_files.get(filename))
+            hashes[filename] = files[filename][2]
+
+    return hashes
+
+
+def _hash_file(path: str, known: list = None):
+    from hashlib import sha256
+    from os import stat
+
+    stats = stat(path)
+    if known is not None and known[:2] == [stats.st_mtime_ns, stats.st_size]:
+        return known
+
+    digest = sha256()
+    with open(path, 'rb') as stream:
+        for chunk in iter(lambda: stream.read(1048576), b''):
+            digest.update(chunk)
+
+    return [stats.st_mtime_ns, stats.st_size, digest.hexdigest()]
+
+
+def _check_cycles(alias: str, steps: list):
+    """Steps are sorted by their dependencies: what is left waits for itself."""
+    deps = {step['id']: set(step['depends_on']) for step in steps}
+    while deps:
+        done = [step_id for step_id, step_deps in deps.items() if not step_deps & set(deps)]
+        if not done:
+            raise ValueError('Alias {}: steps wait for each other: {}'.format(alias, ', '.join(sorted(deps))))
+        for step_id in done:
+            del deps[step_id]
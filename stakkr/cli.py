@@ -10,21 +10,57 @@ Give all options to manage services to be launched, stopped, etc.
 import sys
 import click
 from click.core import Context
-from stakkr.docker_actions import get_running_containers_names
-from stakkr.aliases import get_aliases
 
 
-@click.group(help="""Main CLI Tool that easily create / maintain
+class AliasedGroup(click.Group):
+    """
+    Click group that resolves aliases defined in stakkr.yml lazily.
+
+    Aliases are only read when the command name is not a builtin command,
+    or when the full list of commands is requested (help).
+    """
+
+    def get_command(self, ctx: Context, cmd_name: str):
+        """Return a builtin command or build the alias command on the fly."""
+        builtin = super().get_command(ctx, cmd_name)
+        if builtin is not None:
+            return builtin
+
+        from stakkr.aliases import get_aliases
+
+        aliases = get_aliases(ctx.params.get('config'))
+        if aliases.get(cmd_name) is None:
+            return None
+
+        return _build_alias_command(cmd_name, aliases[cmd_name])
+
+    def list_commands(self, ctx: Context):
+        """List builtin commands then aliases, if a config file is found."""
+        from stakkr.aliases import get_aliases
+
+        commands = super().list_commands(ctx)
+        try:
+            aliases = get_aliases(ctx.params.get('config'))
+        except FileNotFoundError:
+            return commands
+
+        return commands + sorted(alias for alias, conf in aliases.items()
+                                 if conf is not None and alias not in commands)
+
+
+@click.group(cls=AliasedGroup, help="""Main CLI Tool that easily create / maintain
 a stack of services, for example for web development.
 
 Read the configuration file and setup the required services by
 linking and managing everything for you.""")
 @click.version_option('4.2')
-@click.option('--config', '-c', help='Set the configuration filename (stakkr.yml by default)')
+@click.option('--config', '-c', is_eager=True, help='Set the configuration filename (stakkr.yml by default)')
 @click.option('--debug/--no-debug', '-d', default=False)
 @click.option('--verbose', '-v', is_flag=True)
+@click.option('--profile', is_flag=True, envvar='STAKKR_PROFILE',
+              help="Time each phase, save it into .stakkr/timings.jsonl (or set STAKKR_PROFILE=1)")
 @click.pass_context
-def stakkr(ctx: Context, config=None, debug=False, verbose=True):
+def stakkr(ctx: Context, config=None, debug=False, verbose=True, profile=False):
     """Click group, set context and main object."""
     from stakkr.actions import StakkrActions
 
@@ -32,6 +68,30 @@ def stakkr(ctx: Context, config=None, debug=False, verbose=True):
     ctx.obj['DEBUG'] = debug
     ctx.obj['VERBOSE'] = verbose
     ctx.obj['STAKKR'] = StakkrActions(ctx.obj)
+    if profile is True:
+        from stakkr.profiler import start_profile
+
+        start_profile(ctx.invoked_subcommand)
+        ctx.call_on_close(lambda: _end_profile(ctx))
+
+
+@stakkr.command(help="""Run the stakkr daemon in the foreground. It keeps configs
+and running containers in memory (updated from docker events) so the commands
+don't have to read them again. Commands work the same without it.
+Set STAKKR_DAEMON=0 to ignore it.""")
+@click.option('--stop', is_flag=True, help="Stop the running daemon")
+def daemon(stop: bool):
+    """See command Help."""
+    from stakkr.daemon import Daemon, DaemonClient
+
+    if stop is True:
+        DaemonClient().query('stop')
+        print(click.style('[STOPPED]', fg='yellow') + ' stakkr daemon')
+        return
+
+    server = Daemon()
+    print(click.style('[STARTED]', fg='green') + ' stakkr daemon on {}'.format(server.socket_path))
+    server.serve()
 
 
 @stakkr.command(help="""Enter a container to perform direct actions such as
@@ -39,16 +99,13 @@ install packages, run commands, etc.""")
 @click.argument('container', required=True)
 @click.option('--user', '-u', help="User's name. Valid choices : www-data or root")
 @click.option('--tty/--no-tty', '-t/ ', is_flag=True, default=True, help="Use a TTY")
+@click.option('--engine', '-e', type=click.Choice(['api', 'cli']), help="Docker API or CLI (exec.engine by default)")
 @click.pass_context
-def console(ctx: Context, container: str, user: str, tty: bool):
+def console(ctx: Context, container: str, user: str, tty: bool, engine: str):
     """See command Help."""
-    ctx.obj['STAKKR'].init_project()
-    ctx.obj['CTS'] = get_running_containers_names(ctx.obj['STAKKR'].project_name)
-    if ctx.obj['CTS']:
-        ct_choice = click.Choice(ctx.obj['CTS'])
-        ct_choice.convert(container, None, ctx)
+    _check_container_running(ctx, container)
 
-    ctx.obj['STAKKR'].console(container, _get_cmd_user(user, container), tty)
+    ctx.exit(ctx.obj['STAKKR'].console(container, _get_cmd_user(user, container), tty, engine))
 
 
 @stakkr.command(help="""Execute a command into a container.
@@ -62,16 +119,18 @@ Examples:\n
 @click.option('--user', '-u', help="User's name. Be careful, each container have its own users.")
 @click.option('--tty/--no-tty', '-t/ ', is_flag=True, default=True, help="Use a TTY")
 @click.option('--workdir', '-w', help="Working directory")
+@click.option('--engine', '-e', type=click.Choice(['api', 'cli', 'session']),
+              help="Docker API, CLI or a persistent session (exec.engine by default)")
 @click.argument('container', required=True)
 @click.argument('command', required=True, nargs=-1, type=click.UNPROCESSED)
-def exec_cmd(ctx: Context, user: str, container: str, command: tuple, tty: bool, workdir: str):
+def exec_cmd(ctx: Context, user: str, container: str, command: tuple, tty: bool, workdir: str, engine: str = None):
     """See command Help."""
-    ctx.obj['STAKKR'].init_project()
-    ctx.obj['CTS'] = get_running_containers_names(ctx.obj['STAKKR'].project_name)
-    if ctx.obj['CTS']:
-        click.Choice(ctx.obj['CTS']).convert(container, None, ctx)
+    _check_container_running(ctx, container)
 
-    ctx.obj['STAKKR'].exec_cmd(container, _get_cmd_user(user, container), command, tty, workdir)
+    return_code = ctx.obj['STAKKR'].exec_cmd(container, _get_cmd_user(user, container), command, tty, workdir, engine)
+    # The exit code of the command is the one of stakkr (and stops an alias)
+    if return_code:
+        ctx.exit(return_code)
 
 
 @stakkr.command(help="Restart all (or a single as CONTAINER) container(s)")
@@ -103,7 +162,7 @@ def services(ctx):
     print('Available services usable in stakkr.yml ', end='')
     print('({} = disabled) : '.format(click.style('✘', fg='red')))
 
-    svcs = ctx.obj['STAKKR'].get_config()['services']
+    svcs = ctx.obj['STAKKR'].config['services']
     enabled_svcs = [svc for svc, opts in svcs.items() if opts['enabled'] is True]
     available_svcs = get_available_services(ctx.obj['STAKKR'].project_dir)
     for available_svc in sorted(list(available_svcs.keys())):
@@ -125,11 +184,13 @@ NAME is the directory name to clone the repo.
 def services_add(ctx: Context, package: str, name: str):
     """See command Help."""
     from stakkr.services import install
+    from stakkr.services_index import rebuild_services_index
 
     project_dir = _get_project_dir(ctx.obj['CONFIG'])
     services_dir = '{}/services'.format(project_dir)
     name = package if name is None else name
     success, message = install(services_dir, package, name)
+    rebuild_services_index(project_dir)
     if success is False:
         click.echo(click.style(message, fg='red'))
         sys.exit(1)
@@ -147,10 +208,12 @@ def services_add(ctx: Context, package: str, name: str):
 def services_update(ctx):
     """See command Help."""
     from stakkr.services import update_all
+    from stakkr.services_index import rebuild_services_index
 
     project_dir = _get_project_dir(ctx.obj['CONFIG'])
     services_dir = '{}/services'.format(project_dir)
     update_all(services_dir)
+    rebuild_services_index(project_dir)
     print(click.style('Packages updated', fg='green'))
 
 
@@ -159,12 +222,15 @@ def services_update(ctx):
 @click.option('--pull', '-p', help="Force a pull of the latest images versions", is_flag=True)
 @click.option('--recreate', '-r', help="Recreate all containers", is_flag=True)
 @click.option('--proxy/--no-proxy', '-P', help="Start proxy", default=True)
+@click.option('--wait', '-w', help="Wait until the services are ready", is_flag=True)
 @click.pass_context
-def start(ctx: Context, container: str, pull: bool, recreate: bool, proxy: bool):
+def start(ctx: Context, container: str, pull: bool, recreate: bool, proxy: bool, wait: bool):
     """See command Help."""
     print(click.style('[STARTING]', fg='green') + ' your stakkr services')
 
     ctx.obj['STAKKR'].start(container, pull, recreate, proxy)
+    if wait is True:
+        ctx.obj['STAKKR'].wait([container] if container is not None else None)
     _show_status(ctx)
 
 
@@ -185,6 +251,57 @@ def stop(ctx: Context, container: str, proxy: bool):
     ctx.obj['STAKKR'].stop(container, proxy)
 
 
+@stakkr.command(help="""Wait until all (or some) running services are ready: their
+docker healthcheck is healthy, their service_url answers or their port accepts
+connections. The probe can be set by service with its "ready" option.""")
+@click.argument('services', required=False, nargs=-1)
+@click.option('--timeout', type=float, help="Maximum time to wait, in seconds (wait.timeout by default)")
+@click.pass_context
+def wait(ctx: Context, services: tuple, timeout: float):
+    """See command Help."""
+    ctx.obj['STAKKR'].wait(list(services), timeout)
+
+
+@stakkr.command(help="""Watch the files of the project and run aliases when they change,
+as set in watch.triggers. Stop it with Ctrl-C.""")
+@click.option('--poll', is_flag=True, help="Scan the files every second instead of using inotify")
+@click.pass_context
+def watch(ctx: Context, poll: bool):
+    """See command Help."""
+    import os
+    from stakkr.watcher import Watcher, get_triggers
+
+    ctx.obj['STAKKR'].init_project()
+    config = ctx.obj['STAKKR'].config
+    triggers = get_triggers(config, config.get('aliases') or {})
+    if not triggers:
+        raise SystemError('No trigger to watch, set watch.triggers in stakkr.yml')
+
+    # Aliases run in the background, they don't read the terminal
+    sys.stdin = open(os.devnull)
+    watcher = Watcher(ctx.obj['STAKKR'].project_dir, triggers, lambda alias: _run_alias(ctx, alias),
+                      config['watch']['debounce'], poll)
+    print(click.style('[WATCHING]', fg='green') + ' {} (Ctrl-C to stop)'.format(', '.join(sorted(
+        '/'.join(filter(None, (ctx.obj['STAKKR'].project_dir, root))) for root in watcher.roots))))
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        watcher.wait()
+
+
+def _check_container_running(ctx: Context, container: str):
+    """Make sure the container is running, else list running ones to display the valid choices."""
+    if ctx.obj['STAKKR'].get_container(container) is not None:
+        return
+
+    cts = ctx.obj['STAKKR'].get_running_containers()[1]
+    ctx.obj['CTS'] = sorted([ct_info['compose_name'] for ct_info in cts.values()])
+    if not ctx.obj['CTS']:
+        raise SystemError('Have you started stakkr with the start action ?')
+
+    click.Choice(ctx.obj['CTS']).convert(container, None, ctx)
+
+
 def _get_cmd_user(user: str, container: str):
     users = {'apache': 'www-data', 'nginx': 'www-data', 'php': 'www-data'}
 
@@ -206,15 +323,20 @@ def _show_status(ctx):
     print(services_ports)
 
 
-def _get_project_dir(config: str):
-    from os.path import abspath, dirname
+def _end_profile(ctx: Context):
+    """Display the phases of the command, and save them if the project is known."""
+    from stakkr.profiler import stop_profile
 
-    if config is not None:
-        config = abspath(config)
-        return dirname(config)
+    profile = stop_profile()
+    profile.display()
+    if ctx.obj['STAKKR'].project_dir is not None:
+        profile.save(ctx.obj['STAKKR'].project_dir)
+
+
+def _get_project_dir(config: str):
+    from stakkr.configreader import get_session
 
-    from stakkr.file_utils import find_project_dir
-    return find_project_dir()
+    return get_session(config).project_dir
 
 
 def debug_mode():
@@ -225,35 +347,105 @@ def debug_mode():
     return False
 
 
-def run_commands(ctx: Context, extra_args: tuple, tty: bool):
-    """Run commands for a specific alias"""
-    commands = ctx.obj['STAKKR'].get_config()['aliases'][ctx.command.name]['exec']
-    for command in commands:
-        user = command['user'] if 'user' in command else 'root'
-        workdir = command['workdir'] if 'workdir' in command else None
-        container = command['container']
-        args = command['args'] + list(extra_args) if extra_args is not None else []
+def _build_alias_command(alias: str, conf: dict):
+    """Build a click command that runs the commands of an alias."""
+    cmd_help = conf['description'] if 'description' in conf else 'No description'
 
-        ctx.invoke(exec_cmd, user=user, container=container, command=args, tty=tty, workdir=workdir)
+    @click.command(help=cmd_help, name=alias)
+    @click.option('--tty/--no-tty', '-t/ ', is_flag=True, default=True, help="Use a TTY")
+    @click.option('--force', '-f', is_flag=True, help="Run even if the inputs didn't change since the last run")
+    @click.argument('extra_args', required=False, nargs=-1, type=click.UNPROCESSED)
+    @click.pass_context
+    def _f(ctx: Context, extra_args: tuple, tty: bool, force: bool):
+        """See command Help."""
+        run_commands(ctx, extra_args, tty, force)
 
+    return _f
 
-def main():
-    """Call the CLI Script."""
+
+def _run_alias(ctx: Context, alias: str):
+    """Run an alias like stakkr {alias} --no-tty, return its exit code."""
+    command = _build_alias_command(alias, ctx.obj['STAKKR'].config['aliases'][alias])
     try:
-        for alias, conf in get_aliases().items():
-            if conf is None:
-                continue
+        with click.Context(command, parent=ctx, info_name=alias, obj=ctx.obj) as alias_ctx:
+            run_commands(alias_ctx, (), False)
+    except click.exceptions.Exit as error:
+        return error.exit_code
+
+    return 0
+
+
+def run_commands(ctx: Context, extra_args: tuple, tty: bool, force: bool = False):
+    """
+    Run commands for a specific alias: one after another, or at the same time if it's parallel.
+    Nothing is run if the alias has inputs that didn't change since its last successful run.
+    """
+    from stakkr.aliases import RunCache, get_steps
 
-            cmd_help = conf['description'] if 'description' in conf else 'No description'
+    ctx.obj['STAKKR'].init_project()
+    alias = ctx.command.name
+    conf = ctx.obj['STAKKR'].config['aliases'][alias]
+    cache = RunCache(ctx.obj['STAKKR'].project_dir, alias, conf, extra_args)
+    if force is False and cache.is_up_to_date() is True:
+        print(click.style('[UP TO DATE]', fg='green') + " {}: inputs didn't change (--force to run it)".format(alias))
+        return
+
+    steps = get_steps(alias, conf)
+    # Containers of all steps are found at once
+    ctx.obj['STAKKR'].get_containers([step['container'] for step in steps])
+    if conf.get('parallel') is True:
+        _run_parallel_commands(ctx, steps, extra_args)
+    else:
+        for command in steps:
+            user = command['user'] if 'user' in command else 'root'
+            workdir = command['workdir'] if 'workdir' in command else None
+            container = command['container']
+            args = command['args'] + list(extra_args) if extra_args is not None else []
+
+            ctx.invoke(exec_cmd, user=user, container=container, command=args, tty=tty, workdir=workdir)
+
+    # A failed command exits before
+    cache.save()
+
+
+def _run_parallel_commands(ctx: Context, steps: list, extra_args: tuple):
+    """Steps run without TTY nor stdin, their output lines are prefixed by their id."""
+    import threading
+    from stakkr.aliases import PrefixedOutput, run_steps
+
+    for step in steps:
+        _check_container_running(ctx, step['container'])
+
+    lock = threading.Lock()
+    width = max(len(step['id']) for step in steps)
+
+    def _run_step(step: dict):
+        prefix = click.style('[{}]'.format(step['id'].ljust(width)), fg='cyan') + ' '
+        outputs = (PrefixedOutput(prefix, sys.stdout, lock), PrefixedOutput(prefix, sys.stderr, lock))
+        args = step['args'] + list(extra_args) if extra_args is not None else []
+        try:
+            return ctx.obj['STAKKR'].exec_cmd(
+                step['container'], step.get('user', 'root'), args, False, step.get('workdir'), outputs=outputs)
+        finally:
+            for output in outputs:
+                output.close()
+
+    results = run_steps(steps, _run_step, len(steps))
+    failed = [(step_id, code) for step_id, code in results.items() if code]
+    for step_id, code in failed:
+        click.echo(click.style('[FAILED]', fg='red') + ' {} (exit code {})'.format(step_id, code), err=True)
+    not_run = [step_id for step_id, code in results.items() if code is None]
+    if not_run:
+        click.echo(click.style('[SKIPPED]', fg='yellow') + ' ' + ', '.join(not_run), err=True)
+
+    # The exit code of the first step that failed, in the order of the alias
+    if failed:
+        ctx.exit(failed[0][1])
 
-            @stakkr.command(help=cmd_help, name=alias)
-            @click.option('--tty/--no-tty', '-t/ ', is_flag=True, default=True, help="Use a TTY")
-            @click.argument('extra_args', required=False, nargs=-1, type=click.UNPROCESSED)
-            @click.pass_context
-            def _f(ctx: Context, extra_args: tuple, tty: bool):
-                """See command Help."""
-                run_commands(ctx, extra_args, tty)
 
+def main():
+    """Call the CLI Script."""
+    try:
         stakkr(obj={})
     except Exception as error:
         msg = click.style(r""" ______ _____  _____   ____  _____
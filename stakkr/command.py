@@ -2,29 +2,41 @@
 """
 Command Wrapper.
 
-A command wrapper to get a live output displayed.
+A command wrapper to get a live output displayed. Both streams of the command
+are read as they come (a full stderr pipe would block it), stdout is written
+to the terminal in batches and only the first and last lines of stderr are
+kept for the summary of errors.
 """
 
+import os
 import subprocess
 import sys
-from io import BufferedReader
 from click import echo, style
 
+# Write stdout to the terminal at most every FLUSH_DELAY s, or when that much is waiting
+FLUSH_DELAY = 0.05
+FLUSH_SIZE = 65536
+# Lines of stderr displayed at the beginning and at the end of the errors
+ERRORS_LINES = 5
+
 
 def launch_cmd_displays_output(cmd: list, print_msg: bool = True, print_err: bool = True,
                                err_to_out: bool = False):
-    """Launch a command and displays conditionally messages and / or errors."""
+    """Launch a command and displays conditionally messages and / or errors. Return its exit code."""
     try:
         stderr = subprocess.PIPE if err_to_out is False else subprocess.STDOUT
         result = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
     except Exception as error:
         raise SystemError('Cannot run the command: {}'.format(error))
 
-    _read_messages(result, print_msg)
+    output = _Output(print_msg)
+    errors = _Errors()
+    pump(result, output.feed, errors.feed, output.flush_if_due)
+    output.end()
     if print_err is True and err_to_out is False:
-        _print_errors(result)
+        errors.display()
 
-    return result
+    return result.wait()
 
 
 def verbose(display: bool, message: str):
@@ -34,29 +46,139 @@ def verbose(display: bool, message: str):
              ' {}'.format(message), file=sys.stderr)
 
 
-def _read_messages(result: BufferedReader, display: bool = False):
-    """Print messages sent to the STDOUT."""
-    for line in result.stdout:
-        line = line.decode()
-        line = line if display is True else '.'
-        print(line, end='')
-        sys.stdout.flush()
-
-    print()
-
-
-def _print_errors(result: BufferedReader):
-    """Print messages sent to the STDERR."""
-    num = 0
-    for line in result.stderr:
-        err = line.decode()
-
-        if num == 0:
-            print(style("Command returned errors :", fg='red'))
-
-        if num < 5:
-            print(err, end='')
-        elif num == 5:
-            print(style('... and more', fg='red'))
-
-        num += 1
+class _Output:
+    """stdout of the command (or a dot per line if it's not displayed), written in batches."""
+
+    def __init__(self, display: bool):
+        import codecs
+        from time import perf_counter
+
+        self.display = display
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.pending = []
+        self.pending_size = 0
+        self.in_line = False
+        self.clock = perf_counter
+        self.last_flush = perf_counter()
+
+    def feed(self, data: bytes):
+        """Receive a chunk of stdout."""
+        if self.display is True:
+            text = self.decoder.decode(data)
+        else:
+            # A dot each time a line starts
+            text = '.' * (data[:-1].count(b'\n') + (0 if self.in_line else 1))
+            self.in_line = not data.endswith(b'\n')
+
+        self.pending.append(text)
+        self.pending_size += len(text)
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        """Write what's waiting if it's been waiting long enough or if it's big enough."""
+        if self.pending_size >= FLUSH_SIZE or self.clock() - self.last_flush >= FLUSH_DELAY:
+            self.flush()
+
+    def flush(self):
+        """Write what's waiting to the terminal."""
+        if self.pending:
+            sys.stdout.write(''.join(self.pending))
+            sys.stdout.flush()
+            self.pending, self.pending_size = [], 0
+        self.last_flush = self.clock()
+
+    def end(self):
+        """Write everything left, then a new line."""
+        if self.display is True:
+            self.pending.append(self.decoder.decode(b'', final=True))
+        self.pending.append('\n')
+        self.flush()
+
+
+class _Errors:
+    """Lines of stderr: the first ones and a ring buffer of the last ones, nothing else is kept."""
+
+    def __init__(self):
+        import codecs
+        from collections import deque
+
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.head = []
+        self.tail = deque(maxlen=ERRORS_LINES)
+        self.num = 0
+        self.line = ''
+
+    def feed(self, data: bytes):
+        """Receive a chunk of stderr."""
+        lines = (self.line + self.decoder.decode(data)).split('\n')
+        # A line without its end yet, cut if it's endless
+        self.line = lines.pop()[-FLUSH_SIZE:]
+        for line in lines:
+            self._add(line + '\n')
+
+    def display(self):
+        """Print the first lines, then the last ones if there are more."""
+        if self.line:
+            self._add(self.line + '\n')
+            self.line = ''
+        if self.num == 0:
+            return
+
+        print(style("Command returned errors :", fg='red'))
+        print(''.join(self.head), end='')
+        if self.num > ERRORS_LINES:
+            print(style('... and more ({} lines), the last ones:'.format(self.num - ERRORS_LINES), fg='red'))
+            print(''.join(self.tail), end='')
+
+    def _add(self, line: str):
+        if self.num < ERRORS_LINES:
+            self.head.append(line)
+        else:
+            self.tail.append(line)
+        self.num += 1
+
+
+def pump(process: subprocess.Popen, on_stdout, on_stderr, on_idle=None):
+    """Read stdout and stderr of the process as they come, until both are closed. on_idle is called between reads."""
+    on_idle = on_idle or (lambda: None)
+    streams = [(process.stdout, on_stdout), (process.stderr, on_stderr)]
+    streams = [(stream, callback) for stream, callback in streams if stream is not None]
+    if os.name == 'nt':
+        # Pipes can't be selected on Windows
+        return _pump_threads(streams, on_idle)
+
+    import selectors
+
+    with selectors.DefaultSelector() as selector:
+        for stream, callback in streams:
+            selector.register(stream, selectors.EVENT_READ, callback)
+        while selector.get_map():
+            for key, _ in selector.select(FLUSH_DELAY):
+                data = os.read(key.fd, FLUSH_SIZE)
+                if not data:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    continue
+                key.data(data)
+            on_idle()
+
+
+def _pump_threads(streams: list, on_idle):
+    import threading
+
+    lock = threading.Lock()
+
+    def _read(stream, callback):
+        for data in iter(lambda: stream.read1(FLUSH_SIZE), b''):
+            with lock:
+                callback(data)
+        stream.close()
+
+    threads = [threading.Thread(target=_read, args=stream, daemon=True) for stream in streams]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(FLUSH_DELAY)
+            with lock:
+                on_idle()
@@ -2,11 +2,26 @@
 """Simple Config Reader."""
 
 from collections.abc import Iterable
-from os import path
+from copy import deepcopy
+from hashlib import sha1
+import json
+from os import fstat, path
 from sys import stderr
-import anyconfig
-from jsonschema.exceptions import _Error
-from stakkr.file_utils import get_file, find_project_dir
+from yaml import load
+from stakkr.file_utils import get_file, get_stakkr_dir, find_project_dir, read_json, write_json
+from stakkr.services_index import get_services_index
+
+try:
+    from yaml import CSafeLoader as Loader
+except ImportError:  # pragma: no cover
+    from yaml import SafeLoader as Loader
+
+# Bump it when the way the config is compiled changes, to invalidate caches
+__cache_version__ = 4
+# Compiled validators, by key of schema files
+__validators__ = dict()
+# Config sessions of the current process, by config file given in the command line
+__sessions__ = dict()
 
 
 class Config:
@@ -22,9 +37,13 @@ class Config:
         Then the given config file
         """
         self.config_file, self.project_dir = get_config_and_project_dir(config_file)
-        self._build_config_files_list()
-        self._build_config_schemas_list()
+        # Built when the config is read, from the index of services packs
+        self.config_files = []
+        self.spec_files = []
         self.error = ''
+        # Files are read and parsed only once
+        self._contents = dict()
+        self._parsed = dict()
 
     def display_errors(self):
         """Display errors in STDOUT."""
@@ -41,37 +60,286 @@ class Config:
         Parse the configs and validate it.
 
         It could be either local or from a local services
-        (first local then packages by alphabetical order).
+        (first local then packages by alphabetical order, as indexed).
+
+        The compiled config is cached in .stakkr/cache of the project, and
+        reused as long as none of the files it is built from changes, and no
+        services pack has been added or removed.
         """
-        schema = anyconfig.multi_load(self.spec_files)
-        config = anyconfig.multi_load(self.config_files)
+        config = self._read_cached_config()
+        if config is not None:
+            return config
+
+        self._build_files_lists()
+        spec_key, cache_key = self._get_cache_keys()
+        config = self._compile(self.config_files, self.spec_files, spec_key)
+        if config is False:
+            return False
+
+        self._write_cache('config.json', cache_key, config, files=[self.config_files, self.spec_files])
+
+        return config
+
+    def load(self, filename: str):
+        """Parse a YAML file (only once)."""
+        if filename not in self._parsed:
+            self._parsed[filename] = load(self._get_contents([filename])[filename][1], Loader=Loader)
+
+        return self._parsed[filename]
+
+    def _compile(self, config_files: list, spec_files: list, spec_key: str):
+        """Merge the configs, then validate the sections that changed since last time."""
+        validator = self._get_validator(spec_files, spec_key)
+        config = self._load_files(config_files)
+        self._drop_disabled_services(config, validator.schema)
         # Make sure the compiled configuration is valid
-        try:
-            anyconfig.validate(config, schema, safe=False)
-        except _Error as error:
-            error_path = ' -> '.join(map(str, error.path))
-            self.error = '{} ({})'.format(error.message, error_path)
+        known_sections = self._read_cache('validation.json', spec_key)
+        error, sections = validator.validate(config, known_sections)
+        if error is not None:
+            self.error = error
             return False
 
+        self._write_cache('validation.json', spec_key, sections)
+
         config['project_dir'] = path.realpath(path.dirname(self.config_file))
         if config['project_name'] == '':
             config['project_name'] = path.basename(config['project_dir'])
 
         return config
 
-    def _build_config_files_list(self):
-        self.config_files = [
-            # Stakkr default config
-            get_file('static', 'config_default.yml'),
-            '{}/services/*/config_default.yml'.format(self.project_dir)]
-        # Stakkr main config file finally with user's values
-        self.config_files += [self.config_file]
+    def _get_cache_keys(self):
+        """Keys of the schemas, and of the whole config (files and packs installed)."""
+        spec_key = _get_cache_key(self._get_contents(self.spec_files))
+        seed = spec_key + get_services_index(self.project_dir).get_key()
+
+        return spec_key, _get_cache_key(self._get_contents(self.config_files), seed)
+
+    def _read_cached_config(self):
+        """
+        Get the config from the cache, without parsing the user's config to know
+        which packs to load: if it didn't change, the files are the same as last time.
+        """
+        try:
+            cache = read_json(self._get_cache_file('config.json'), {})
+        except OSError:
+            return None
+
+        # The cache could be the one of another config file of the project
+        if not isinstance(cache.get('files'), list) or len(cache['files']) != 2 \
+                or cache['files'][0][-1:] != [self.config_file]:
+            return None
+
+        self.config_files, self.spec_files = cache['files']
+        try:
+            if self._get_cache_keys()[1] == cache.get('key'):
+                return cache.get('data')
+        except OSError:
+            # A file has been removed
+            pass
+
+        return None
+
+    def _get_enabled_services(self):
+        """Services enabled in the user's config (read before the defaults, to know which packs to load)."""
+        user_config = self.load(self.config_file)
+        services = user_config.get('services') if isinstance(user_config, dict) else None
+        if not isinstance(services, dict):
+            return []
+
+        return [service for service, options in services.items()
+                if isinstance(options, dict) and options.get('enabled') is True]
+
+    def _drop_disabled_services(self, config: dict, schema: dict):
+        """Remove the disabled services of packs that were not loaded: they can't be validated."""
+        if not isinstance(config.get('services'), dict):
+            return
+
+        services_index = get_services_index(self.project_dir)
+        known_services = schema.get('properties', {}).get('services', {}).get('properties', {})
+        for service in list(config['services']):
+            if service not in known_services and services_index.get_service_pack(service) is not None \
+                    and service not in self._get_enabled_services():
+                del config['services'][service]
+
+    def _get_validator(self, spec_files: list, spec_key: str):
+        """Get the compiled validator of the schemas, build it only once per process."""
+        if spec_key in __validators__:
+            return __validators__[spec_key]
+
+        schema = self._read_cache('schema.json', spec_key)
+        if schema is None:
+            schema = _add_shared_properties(self._load_files(spec_files))
+            self._write_cache('schema.json', spec_key, schema)
+
+        __validators__[spec_key] = Validator(schema)
+
+        return __validators__[spec_key]
+
+    def _get_contents(self, files: list):
+        """Read files (only once), return their modification time and content by file name."""
+        for filename in files:
+            if filename not in self._contents:
+                with open(filename, 'rb') as stream:
+                    self._contents[filename] = (fstat(stream.fileno()).st_mtime_ns, stream.read())
+
+        return {filename: self._contents[filename] for filename in files}
+
+    def _load_files(self, files: list):
+        """Parse and merge files, in the given order (last one wins)."""
+        merged = dict()
+        for filename in files:
+            _merge_dicts(merged, self.load(filename))
+
+        return merged
+
+    def _get_cache_file(self, cache_name: str):
+        return get_stakkr_dir(self.project_dir, 'cache') + '/' + cache_name
+
+    def _read_cache(self, cache_name: str, cache_key: str):
+        try:
+            cache = read_json(self._get_cache_file(cache_name), {})
+        except OSError:
+            return None
+
+        if cache.get('key') != cache_key:
+            return None
+
+        return cache.get('data')
+
+    def _write_cache(self, cache_name: str, cache_key: str, data: dict, **extra):
+        # Some YAML values (dates, keys that are not strings) can't be stored in JSON
+        try:
+            if json.loads(json.dumps(data)) != data:
+                return
+        except (TypeError, ValueError):
+            return
+
+        try:
+            write_json(self._get_cache_file(cache_name), dict(extra, key=cache_key, data=data))
+        except OSError:
+            pass
+
+    def _build_files_lists(self):
+        """
+        Stakkr defaults and schema, then the ones of the services packs that
+        provide an enabled service, finally the user's config.
+        """
+        services_index = get_services_index(self.project_dir)
+        packs = {services_index.get_service_pack(service) for service in self._get_enabled_services()}
+        packs_defaults, packs_schemas = services_index.get_config_files(packs - {None})
+        self.config_files = [get_file('static', 'config_default.yml')] + packs_defaults + [self.config_file]
+        self.spec_files = [get_file('static', 'config_schema.yml')] + packs_schemas
+
 
-    def _build_config_schemas_list(self):
-        self.spec_files = [
-            # Stakkr config validation
-            get_file('static', 'config_schema.yml'),
-            '{}/services/*/config_schema.yml'.format(self.project_dir)]
+class Session:
+    """
+    Config shared by all the modules of a process (cli, aliases, actions, compose).
+
+    The project dir is resolved only once, and each file is read and parsed only once.
+    """
+
+    def __init__(self, config_file: str):
+        """Resolve the config file and the project dir."""
+        self.reader = Config(config_file)
+        self.config_file = self.reader.config_file
+        self.project_dir = self.reader.project_dir
+        self._config = None
+
+    def get_config(self):
+        """Return the merged and validated config, or False if it's invalid."""
+        if self._config is None:
+            self._config = self.reader.read()
+
+        return self._config
+
+    def get_user_config(self):
+        """Return the config file as written by the user, without defaults nor validation."""
+        from yaml import error
+
+        try:
+            config = self.reader.load(self.config_file)
+        except (error.YAMLError, FileNotFoundError):
+            return {}
+
+        return config if isinstance(config, dict) else {}
+
+
+class Validator:
+    """
+    Compiled validator of the merged schemas.
+
+    The config is validated by top-level section (and by service for
+    ``services``). A section is skipped when it has not changed since the last
+    successful validation, the keys of the config are always checked.
+    """
+
+    def __init__(self, schema: dict):
+        """Compile the schema."""
+        from jsonschema.validators import validator_for
+
+        self.schema = schema
+        self.validator = validator_for(schema)(schema)
+
+    def validate(self, config: dict, known_sections: dict = None):
+        """Validate a config, return an error (or None) and the hashes of the valid sections."""
+        known_sections = {} if known_sections is None else known_sections
+        sections = dict()
+        for section, value, schema, section_path in self._iter_sections(config):
+            section_hash = _hash_data(value)
+            if section_hash is not None and known_sections.get(section) == section_hash:
+                sections[section] = section_hash
+                continue
+
+            error = self._get_error(value, schema, section_path)
+            if error is not None:
+                return error, None
+            # A section that can't be hashed is validated each time
+            if section_hash is not None:
+                sections[section] = section_hash
+
+        return None, sections
+
+    def _get_error(self, value, schema: dict, section_path: list):
+        from jsonschema.exceptions import best_match
+
+        error = best_match(self.validator.descend(value, schema))
+        if error is None:
+            return None
+
+        error_path = ' -> '.join(map(str, section_path + list(error.path)))
+
+        return '{} ({})'.format(error.message, error_path)
+
+    def _iter_sections(self, config: dict):
+        """Yield sections to validate (name, value, schema, path), keys first."""
+        error = self._get_error(config, _get_shell_schema(self.schema), [])
+        if error is not None or not isinstance(config, dict):
+            yield '', config, self.schema, []
+            return
+
+        properties = self.schema.get('properties', {})
+        for section, value in config.items():
+            schema = properties.get(section)
+            if schema is None:
+                continue
+
+            if section != 'services' or not isinstance(value, dict):
+                yield section, value, schema, [section]
+                continue
+
+            yield 'services', value, _get_shell_schema(schema), ['services']
+            services_properties = schema.get('properties', {})
+            for service, service_value in value.items():
+                if service in services_properties:
+                    yield 'services.' + service, service_value, services_properties[service], ['services', service]
+
+
+def get_session(config_file: str = None):
+    """Get the config session of the current process for a config file."""
+    if config_file not in __sessions__:
+        __sessions__[config_file] = Session(config_file)
+
+    return __sessions__[config_file]
 
 
 def get_config_and_project_dir(config_file: str):
@@ -84,3 +352,52 @@ def get_config_and_project_dir(config_file: str):
         config_file = '{}/stakkr.yml'.format(project_dir)
 
     return config_file, project_dir
+
+
+def _get_cache_key(contents: dict, seed: str = ''):
+    """Build a key from paths, modification times and contents of files."""
+    key = sha1('{}:{}'.format(__cache_version__, seed).encode())
+    for filename, (mtime, content) in contents.items():
+        key.update('{}:{}:{}:'.format(filename, mtime, len(content)).encode())
+        key.update(sha1(content).digest())
+
+    return key.hexdigest()
+
+
+def _merge_dicts(base: dict, other: dict):
+    """Merge recursively other into base. Values that are not dicts are replaced."""
+    if not isinstance(other, dict):
+        return
+
+    for key, value in other.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            _merge_dicts(base[key], value)
+            continue
+
+        base[key] = deepcopy(value)
+
+
+def _add_shared_properties(schema: dict):
+    """Properties of all services (stakkr's and the packs' ones), defined once in stakkr's schema."""
+    services = schema.get('properties', {}).get('services', {}).get('properties', {})
+    for service_schema in services.values():
+        if isinstance(service_schema, dict):
+            service_schema.setdefault('properties', {})['ready'] = {'$ref': '#/definitions/ready'}
+
+    return schema
+
+
+def _get_shell_schema(schema: dict):
+    """Copy a schema without the definition of its properties, to validate only its keys."""
+    if not isinstance(schema.get('properties'), dict):
+        return schema
+
+    return dict(schema, properties={key: {} for key in schema['properties']})
+
+
+def _hash_data(data):
+    """A hash of the data, None if it can't be serialized (keys of several types)."""
+    try:
+        return sha1(json.dumps(data, sort_keys=True, default=repr).encode()).hexdigest()
+    except TypeError:
+        return None
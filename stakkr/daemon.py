@@ -0,0 +1,290 @@
+# coding: utf-8
+"""
+Stakkr daemon.
+
+Keeps in memory, for each project, its config and its running containers.
+Containers are updated from the docker events stream instead of being listed
+by each command. Commands ask the daemon through a unix socket with
+DaemonClient, and do the work themselves when the daemon is not running.
+"""
+
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+from click import style
+
+# Events that change the list of running containers
+__events__ = ('start', 'die', 'destroy', 'rename')
+
+
+def get_socket_path():
+    """Path of the daemon socket, one daemon per user, in a directory that only the user can write to."""
+    if 'STAKKR_DAEMON_SOCKET' in os.environ:
+        return os.environ['STAKKR_DAEMON_SOCKET']
+
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        user = os.getuid() if hasattr(os, 'getuid') else os.environ.get('USERNAME', 'user')
+        return '{}/stakkr-{}.sock'.format(os.environ['XDG_RUNTIME_DIR'], user)
+
+    return os.path.expanduser('~/.stakkr/daemon.sock')
+
+
+def is_trusted(socket_path: str):
+    """
+    True if the socket belongs to the user, in a directory of the user that nobody
+    else can write to: another user could have created it to send its own config.
+    """
+    if hasattr(os, 'getuid') is False:
+        return True
+
+    try:
+        socket_stats = os.stat(socket_path)
+    except OSError:
+        return False
+
+    return socket_stats.st_uid == os.getuid() and _is_private_dir(os.path.dirname(os.path.abspath(socket_path)))
+
+
+def get_daemon_client():
+    """
+    Return a client if a daemon seems to be running (and is not disabled with STAKKR_DAEMON=0), else None.
+    A socket that doesn't belong to the user is ignored.
+    """
+    if os.environ.get('STAKKR_DAEMON', '1') == '0' or not hasattr(socket, 'AF_UNIX'):
+        return None
+
+    socket_path = get_socket_path()
+    if is_trusted(socket_path) is False:
+        return None
+
+    return DaemonClient(socket_path)
+
+
+class DaemonClient:
+    """Send requests to the daemon."""
+
+    def __init__(self, socket_path: str = None, timeout: float = 5):
+        """Set the socket to use."""
+        self.socket_path = get_socket_path() if socket_path is None else socket_path
+        self.timeout = timeout
+
+    def query(self, action: str, **params):
+        """
+        Send a request and return its result.
+
+        Raise a ConnectionError if the daemon does not answer and
+        a RuntimeError if the daemon could not do what was asked.
+        """
+        if is_trusted(self.socket_path) is False:
+            raise ConnectionError('stakkr daemon is not available ({} does not exist or is not trusted)'.format(
+                self.socket_path))
+
+        request = json.dumps(dict(params, action=action)).encode() + b'\n'
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(self.timeout)
+                sock.connect(self.socket_path)
+                sock.sendall(request)
+                response = json.loads(sock.makefile('rb').readline().decode())
+        except (OSError, ValueError) as error:
+            raise ConnectionError('stakkr daemon is not available ({})'.format(error))
+
+        if response.get('ok') is not True:
+            raise RuntimeError(response.get('error', 'Unknown error from stakkr daemon'))
+
+        return response.get('data')
+
+
+class Daemon:
+    """Answer requests of the commands, watch docker events."""
+
+    def __init__(self, socket_path: str = None, watch_events: bool = True):
+        """Set the socket to listen on."""
+        self.socket_path = get_socket_path() if socket_path is None else socket_path
+        self.watch_events = watch_events
+        self.projects = dict()
+        self.server = None
+        self._lock = threading.RLock()
+
+    def serve(self):
+        """Listen on the socket until stopped."""
+        socket_dir = os.path.dirname(os.path.abspath(self.socket_path))
+        os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+        if _is_private_dir(socket_dir) is False:
+            raise RuntimeError('{} must belong to you and be writable only by you'.format(socket_dir))
+
+        self._remove_stale_socket()
+
+        self.server = _Server(self.socket_path, _RequestHandler)
+        self.server.daemon = self
+        os.chmod(self.socket_path, 0o600)
+        if self.watch_events is True:
+            threading.Thread(target=self._watch_events, daemon=True).start()
+
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            os.remove(self.socket_path)
+
+    def shutdown(self):
+        """Stop serving, can be called from a request."""
+        threading.Thread(target=self.server.shutdown).start()
+
+    def handle(self, request: dict):
+        """Run the action of a request and return its result."""
+        action = getattr(self, '_action_{}'.format(request.pop('action', None)), None)
+        if action is None:
+            raise ValueError('Unknown action')
+
+        return action(**request)
+
+    def handle_event(self, event: dict):
+        """Update the containers of the project of a container that started or stopped."""
+        if event.get('Type') != 'container' or event.get('Action', event.get('status')) not in __events__:
+            return
+
+        from stakkr.docker_actions import get_compose_project
+
+        attributes = event.get('Actor', {}).get('Attributes', {})
+        with self._lock:
+            projects = list(self.projects.values())
+
+        for project in projects:
+            project_name = project['config']['project_name']
+            if get_compose_project(project_name) == attributes.get('com.docker.compose.project'):
+                project['registry'].update(project_name, event['id'])
+
+    def _action_config(self, config: str):
+        return self._get_project(config)['config']
+
+    def _action_container(self, config: str, service: str):
+        ct_info = self._get_project(config)['registry'].get(compose_name=service)
+
+        return None if ct_info is None else ct_info.to_dict()
+
+    def _action_containers(self, config: str):
+        registry = self._get_project(config)['registry']
+        cts = registry.snapshot()
+
+        return {'running': registry.running, 'containers': [ct_info.to_dict() for ct_info in cts.values()]}
+
+    def _action_ping(self):
+        return {'pid': os.getpid(), 'projects': sorted(self.projects.keys())}
+
+    def _action_stop(self):
+        self.shutdown()
+
+    def _get_project(self, config_file: str):
+        """
+        Get the config and the containers of a project. The config is read again
+        (from the cache of the project if it can) only when one of its files changed.
+        """
+        from stakkr.configreader import Config
+        from stakkr.docker_actions import ContainerRegistry
+
+        with self._lock:
+            project = self.projects.get(config_file)
+        if project is not None and project['files_key'] == _get_files_key(project['project_dir'], project['files']):
+            return project
+
+        reader = Config(config_file)
+        config = reader.read()
+        if config is False:
+            raise RuntimeError(reader.error)
+
+        files = reader.config_files + reader.spec_files
+        with self._lock:
+            project = self.projects.get(config_file)
+            if project is None or project['config']['project_name'] != config['project_name']:
+                project = {'registry': ContainerRegistry()}
+                project['registry'].refresh(config['project_name'])
+                self.projects[config_file] = project
+            project.update(config=config, project_dir=reader.project_dir, files=files,
+                           files_key=_get_files_key(reader.project_dir, files))
+
+        return project
+
+    def _refresh_all(self):
+        with self._lock:
+            projects = list(self.projects.values())
+
+        for project in projects:
+            project['registry'].refresh(project['config']['project_name'])
+
+    def _remove_stale_socket(self):
+        if os.path.exists(self.socket_path) is False:
+            return
+
+        try:
+            DaemonClient(self.socket_path, timeout=1).query('ping')
+        except ConnectionError:
+            os.remove(self.socket_path)
+            return
+
+        raise RuntimeError('stakkr daemon is already running ({})'.format(self.socket_path))
+
+    def _watch_events(self):
+        """Read docker events forever, reconnect if docker restarts."""
+        from stakkr.docker_actions import create_api_client
+
+        while True:
+            try:
+                events = create_api_client().events(decode=True, filters={'type': 'container'})
+                # Containers could have changed while we were not watching
+                self._refresh_all()
+                for event in events:
+                    self.handle_event(event)
+            except Exception as error:
+                print(style('[DAEMON]', fg='yellow') + ' Docker events: {}'.format(error), file=sys.stderr)
+            # Docker closed the stream or can't be reached: don't list the containers in a loop
+            time.sleep(1)
+
+
+def _get_files_key(project_dir: str, files: list):
+    """Modification times and sizes of the files of a config, and the packs installed."""
+    from stakkr.services_index import get_services_index
+
+    # Packs could have been added or removed since the last request
+    key = [get_services_index(project_dir).check().get_key()]
+    for filename in files:
+        try:
+            stats = os.stat(filename)
+            key.append((filename, stats.st_mtime_ns, stats.st_size))
+        except OSError:
+            key.append((filename, None, None))
+
+    return key
+
+
+def _is_private_dir(directory: str):
+    if hasattr(os, 'getuid') is False:
+        return True
+
+    try:
+        stats = os.stat(directory)
+    except OSError:
+        return False
+
+    return stats.st_uid == os.getuid() and stats.st_mode & 0o022 == 0
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """One JSON request per line, one JSON response per line."""
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode())
+            response = {'ok': True, 'data': self.server.daemon.handle(request)}
+        except Exception as error:
+            response = {'ok': False, 'error': str(error)}
+
+        self.wfile.write(json.dumps(response).encode() + b'\n')
@@ -2,8 +2,137 @@
 """Docker functions to get info about containers."""
 
 import re
+from threading import RLock
 from docker.errors import NotFound, NullResource
-__st__ = {'cts_info': dict(), 'running_cts': 0}
+__clients__ = dict()
+__clients_lock__ = RLock()
+
+
+class ContainerInfo:
+    """Immutable details of a container. Items can be read like a dict ct_info['name']."""
+
+    __slots__ = ('id', 'name', 'compose_name', 'ports', 'image', 'image_id', 'traefik_host', 'ip', 'running')
+
+    def __init__(self, **info):
+        """Set all details, they can't be changed after."""
+        for field in self.__slots__:
+            object.__setattr__(self, field, info[field])
+
+    def __setattr__(self, name: str, value):
+        raise AttributeError('ContainerInfo is read-only')
+
+    def __contains__(self, item_name: str):
+        return item_name in self.__slots__
+
+    def __eq__(self, other):
+        if isinstance(other, (ContainerInfo, dict)):
+            return self.to_dict() == dict(other)
+
+        return NotImplemented
+
+    def __getitem__(self, item_name: str):
+        if item_name not in self.__slots__:
+            raise KeyError(item_name)
+
+        return getattr(self, item_name)
+
+    def __repr__(self):
+        return 'ContainerInfo({})'.format(self.to_dict())
+
+    def keys(self):
+        """Names of the details, to convert it to a dict."""
+        return self.__slots__
+
+    def to_dict(self):
+        """Return details as a dict."""
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+class ContainerRegistry:
+    """
+    Running containers of a project, indexed by compose name, docker name and id.
+
+    refresh() lists the containers from docker and replaces the whole content,
+    snapshot() gives a copy that won't change on the next refresh.
+    Thread safe: a refresh never exposes a partial list of containers.
+    """
+
+    def __init__(self):
+        """Start empty, nothing is read from docker before a refresh."""
+        self._lock = RLock()
+        self._by_name = dict()
+        self._by_compose_name = dict()
+        self._by_id = dict()
+
+    def add(self, ct_info: ContainerInfo):
+        """Add (or replace) a single container."""
+        with self._lock:
+            self._remove(ct_info.id)
+            self._by_name[ct_info.name] = ct_info
+            self._by_id[ct_info.id] = ct_info
+            self._by_compose_name.setdefault(ct_info.compose_name, ct_info)
+
+    @property
+    def running(self):
+        """Number of running containers known."""
+        with self._lock:
+            return len(self._by_id)
+
+    def get(self, compose_name: str = None, name: str = None, ct_id: str = None):
+        """Get a container by compose name, docker name or id. None if it's not known."""
+        with self._lock:
+            if compose_name is not None:
+                return self._by_compose_name.get(compose_name)
+            if name is not None:
+                return self._by_name.get(name)
+
+            return self._by_id.get(ct_id)
+
+    def refresh(self, project_name: str):
+        """Read running containers from docker, return their number and a snapshot."""
+        cts_info = _list_containers(project_name)
+        with self._lock:
+            self._by_name, self._by_compose_name, self._by_id = dict(), dict(), dict()
+            for ct_info in sorted(cts_info, key=lambda ct_info: ct_info.name):
+                self.add(ct_info)
+
+            return self.running, self.snapshot()
+
+    def update(self, project_name: str, ct_id: str):
+        """Inspect a single container (that just started or stopped) and update the registry."""
+        ct_info = _extract_container_info(project_name, ct_id)
+        with self._lock:
+            if ct_info is None or ct_info.running is False:
+                self._remove(ct_id)
+            else:
+                self.add(ct_info)
+
+        return ct_info
+
+    def remove(self, ct_id: str):
+        """Forget a container (it stopped)."""
+        with self._lock:
+            self._remove(ct_id)
+
+    def snapshot(self):
+        """Copy of containers info, by docker name."""
+        with self._lock:
+            return dict(self._by_name)
+
+    def _remove(self, ct_id: str):
+        ct_info = self._by_id.pop(ct_id, None)
+        if ct_info is None:
+            return
+
+        self._by_name.pop(ct_info.name, None)
+        if self._by_compose_name.get(ct_info.compose_name) is ct_info:
+            del self._by_compose_name[ct_info.compose_name]
+            same_service = [ct for ct in self._by_name.values() if ct.compose_name == ct_info.compose_name]
+            if same_service:
+                self._by_compose_name[ct_info.compose_name] = min(same_service, key=lambda ct: ct.name)
+
+
+__registry__ = ContainerRegistry()
 
 
 def add_container_to_network(container: str, network: str):
@@ -17,37 +146,53 @@ def add_container_to_network(container: str, network: str):
     return True
 
 
-def block_ct_ports(service: str, ports: list, project_name: str) -> tuple:
-    """Run iptables commands to block a list of port on a specific container."""
+def block_ct_ports(service: str, ports: list, project_name: str, subnet: str = None) -> tuple:
+    """Block a list of ports on a specific container, with all iptables rules in a single exec."""
+    ct_info = __registry__.get(compose_name=service)
+    if ct_info is None:
+        return False, '{} is not started, no port to block'.format(service)
+
+    subnet = get_subnet(project_name) if subnet is None else subnet
+    api_client = get_api_client()
     try:
-        container = get_client().containers.get(get_ct_item(service, 'id'))
-    except (LookupError, NullResource):
+        exec_id = api_client.exec_create(ct_info['id'], ['sh', '-c', _get_iptables_script(subnet, ports)], user='root')
+        output = api_client.exec_start(exec_id)
+        exit_code = api_client.exec_inspect(exec_id)['ExitCode']
+    except (NotFound, NullResource):
         return False, '{} is not started, no port to block'.format(service)
 
-    _, iptables = container.exec_run(['which', 'iptables'])
-    iptables = iptables.decode().strip()
-    if iptables == '':
+    if exit_code == 127:
         return True, "Can't block ports on {}, is iptables installed ?".format(service)
 
-    _allow_contact_subnet(project_name, container)
-
-    # Now for each port, add an iptable rule
-    for port in ports:
-        rule = ['OUTPUT', '-p', 'tcp', '--dport', str(port), '-j', 'REJECT']
-        try:
-            container.exec_run([iptables, '-D'] + rule)
-        finally:
-            container.exec_run([iptables, '-A'] + rule)
+    if exit_code != 0:
+        return True, "Can't block ports on {}: {}".format(service, output.decode(errors='replace').strip())
 
     ports_list = ', '.join(map(str, ports))
 
     return False, 'Blocked ports {} on container {}'.format(ports_list, service)
 
 
+def block_cts_ports(project_name: str, services_ports: dict) -> dict:
+    """Block ports on many containers concurrently, return the result of block_ct_ports by service."""
+    if not services_ports:
+        return dict()
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Same network for all containers
+    subnet = get_subnet(project_name)
+    services = sorted(services_ports)
+    with ThreadPoolExecutor(max_workers=min(len(services), 8)) as executor:
+        results = executor.map(
+            lambda service: block_ct_ports(service, services_ports[service], project_name, subnet), services)
+
+    return dict(zip(services, results))
+
+
 def check_cts_are_running(project_name: str):
     """Throw an error if cts are not running."""
-    get_running_containers(project_name)
-    if not __st__['running_cts']:
+    __registry__.refresh(project_name)
+    if not __registry__.running:
         raise SystemError('Have you started stakkr with the start action ?')
 
 
@@ -59,6 +204,16 @@ def container_running(container: str):
         return False
 
 
+def create_api_client():
+    """Create a new API client, for example to read a stream without blocking the shared one."""
+    from docker import APIClient, utils
+    params = utils.kwargs_from_env()
+    base_url = None if 'base_url' not in params else params['base_url']
+    tls = None if 'tls' not in params else params['tls']
+
+    return APIClient(base_url=base_url, tls=tls)
+
+
 def create_network(network: str):
     """Create a Network."""
     if network_exists(network):
@@ -69,36 +224,35 @@ def create_network(network: str):
 
 def get_api_client():
     """Return the API client or initialize it."""
-    if 'api_client' not in __st__:
-        from docker import APIClient, utils
-        params = utils.kwargs_from_env()
-        base_url = None if 'base_url' not in params else params['base_url']
-        tls = None if 'tls' not in params else params['tls']
-
-        __st__['api_client'] = APIClient(base_url=base_url, tls=tls)
+    with __clients_lock__:
+        if 'api_client' not in __clients__:
+            __clients__['api_client'] = create_api_client()
 
-    return __st__['api_client']
+    return __clients__['api_client']
 
 
 def get_client():
-    """Return the client or initialize it."""
-    if 'client' not in __st__:
-        from docker import client
-        __st__['client'] = client.from_env()
+    """Return the client or initialize it, on top of the API client (same connections, version asked once)."""
+    with __clients_lock__:
+        if 'client' not in __clients__:
+            from docker import DockerClient
+            api_client = get_api_client()
+            __clients__['client'] = DockerClient(version=api_client.api_version)
+            __clients__['client'].api = api_client
+
+    return __clients__['client']
 
-    return __st__['client']
+
+def get_compose_project(project_name: str):
+    """Project name as normalized by docker-compose in its labels."""
+    return re.sub(r'[^-_a-z0-9]', '', project_name.lower())
 
 
 def get_ct_item(compose_name: str, item_name: str):
     """Get a value from a container, such as name or IP."""
-    if 'cts_info' not in __st__:
-        raise LookupError('Before getting an info from a ct, run check_cts_are_running()')
-
-    for _, ct_data in __st__['cts_info'].items():
-        if ct_data['compose_name'] == compose_name:
-            return ct_data[item_name]
+    ct_info = __registry__.get(compose_name=compose_name)
 
-    return ''
+    return '' if ct_info is None else ct_info[item_name]
 
 
 def get_ct_name(container: str):
@@ -110,6 +264,11 @@ def get_ct_name(container: str):
     return ct_name
 
 
+def get_registry():
+    """Return the registry of containers of the current process."""
+    return __registry__
+
+
 def get_network_name(project_name: str):
     """Find the full network name."""
     try:
@@ -123,8 +282,10 @@ def get_network_name(project_name: str):
 
 def get_subnet(project_name: str):
     """Find the subnet of the current project."""
-    network_name = get_network_name(project_name)
-    network_info = get_client().networks.get(network_name).attrs
+    try:
+        network_info = get_api_client().inspect_network('{}_stakkr'.format(project_name).lower())
+    except NotFound:
+        raise RuntimeError("Couldn't identify network (check your project name)")
 
     return network_info['IPAM']['Config'][0]['Subnet'].split('/')[0]
 
@@ -148,26 +309,28 @@ def get_switch_ip():
 
 def get_running_containers(project_name: str) -> tuple:
     """Get the number of running containers and theirs details for the current stakkr instance."""
-    from requests import exceptions
+    return __registry__.refresh(project_name)
+
 
+def get_service_container(project_name: str, service: str):
+    """Get the details of the running container of a compose service (single API call), None if not running."""
     filters = {
-        'name': '{}_'.format(project_name),
         'status': 'running',
-        'network': '{}_stakkr'.format(project_name).lower()}
+        'label': [
+            'com.docker.compose.project={}'.format(get_compose_project(project_name)),
+            'com.docker.compose.service={}'.format(service)]}
 
-    try:
-        cts = get_client().containers.list(filters=filters)
-    except exceptions.ConnectionError:
-        raise exceptions.ConnectionError('Make sure docker is installed and running')
-
-    __st__['cts_info'] = dict()
-    for container in cts:
-        container_info = _extract_container_info(project_name, container.id)
-        __st__['cts_info'][container_info['name']] = container_info
+    cts = get_api_client().containers(filters=filters)
+    if not cts:
+        return None
 
-    __st__['running_cts'] = len(cts)
+    container_info = _extract_container_info_from_list(project_name, cts[0])
+    if container_info is None:
+        container_info = _extract_container_info(project_name, cts[0]['Id'])
+    if container_info is not None:
+        __registry__.add(container_info)
 
-    return __st__['running_cts'], __st__['cts_info']
+    return container_info
 
 
 def get_running_containers_names(project_name: str) -> list:
@@ -202,20 +365,45 @@ def network_exists(network: str):
         return False
 
 
-def _allow_contact_subnet(project_name: str, container: str) -> bool:
-    _, iptables = container.exec_run(['which', 'iptables'])
-    iptables = iptables.decode().strip()
-    if iptables == '':
-        return False
+def _get_iptables_script(subnet: str, ports: list):
+    """
+    Render the iptables rules of a container as a single shell script: allow the
+    internal network, then reject each port. Rules are deleted before being added
+    to never be duplicated.
+    """
+    rules = [['OUTPUT', '-d', subnet + '/24', '-j', 'ACCEPT']]
+    rules += [['OUTPUT', '-p', 'tcp', '--dport', str(port), '-j', 'REJECT'] for port in ports]
+
+    script = ['IPTABLES=$(command -v iptables) || exit 127']
+    for rule in rules:
+        script.append('$IPTABLES -D {} 2>/dev/null'.format(' '.join(rule)))
+        script.append('$IPTABLES -A {} || exit 1'.format(' '.join(rule)))
+
+    return '\n'.join(script)
+
+
+def _list_containers(project_name: str):
+    """List running containers of a project, return their details."""
+    from requests import exceptions
+
+    filters = {
+        'name': '{}_'.format(project_name),
+        'status': 'running',
+        'network': '{}_stakkr'.format(project_name).lower()}
 
-    subnet = get_subnet(project_name) + '/24'
-    # Allow internal network
     try:
-        container.exec_run([iptables, '-D', 'OUTPUT', '-d', subnet, '-j', 'ACCEPT'])
-    finally:
-        container.exec_run([iptables, '-A', 'OUTPUT', '-d', subnet, '-j', 'ACCEPT'])
+        cts = get_api_client().containers(filters=filters)
+    except exceptions.ConnectionError:
+        raise exceptions.ConnectionError('Make sure docker is installed and running')
+
+    # The list already gives what we need, inspect only containers with missing fields
+    cts_info = [_extract_container_info_from_list(project_name, ct_data) for ct_data in cts]
+    to_inspect = [ct_data['Id'] for ct_data, ct_info in zip(cts, cts_info) if ct_info is None]
+    cts_info = [ct_info for ct_info in cts_info if ct_info is not None]
+    cts_info += _inspect_containers(project_name, to_inspect)
+
+    return cts_info
 
-    return True
 
 def _extract_container_info(project_name: str, ct_id: str):
     """Get a hash of info about a container : name, ports, image, ip ..."""
@@ -224,20 +412,44 @@ def _extract_container_info(project_name: str, ct_id: str):
     except NotFound:
         return None
 
-    cts_info = {
-        'id': ct_id,
-        'name': ct_data['Name'].lstrip('/'),
-        'compose_name': ct_data['Config']['Labels']['com.docker.compose.service'],
-        'ports': _extract_host_ports(ct_data),
-        'image': ct_data['Config']['Image'],
-        'traefik_host': _get_traefik_host(ct_data['Config']['Labels']),
-        'ip': _get_ip_from_networks(project_name, ct_data['NetworkSettings']['Networks']),
-        'running': ct_data['State']['Running']
-        }
+    cts_info = ContainerInfo(
+        id=ct_id,
+        name=ct_data['Name'].lstrip('/'),
+        compose_name=ct_data['Config']['Labels']['com.docker.compose.service'],
+        ports=_extract_host_ports(ct_data),
+        image=ct_data['Config']['Image'],
+        image_id=ct_data['Image'],
+        traefik_host=_get_traefik_host(ct_data['Config']['Labels']),
+        ip=_get_ip_from_networks(project_name, ct_data['NetworkSettings']['Networks']),
+        running=ct_data['State']['Running']
+        )
 
     return cts_info
 
 
+def _extract_container_info_from_list(project_name: str, ct_data: dict):
+    """Same as _extract_container_info, from an item of the containers list. None if a field is missing."""
+    required = {'Id', 'Names', 'Image', 'ImageID', 'Labels', 'Ports', 'State', 'NetworkSettings'}
+    if required > set(ct_data) or 'com.docker.compose.service' not in ct_data['Labels']:
+        return None
+
+    # The image has been removed or re-tagged, the list only gives its id
+    if ct_data['Image'].startswith('sha256:'):
+        return None
+
+    return ContainerInfo(
+        id=ct_data['Id'],
+        name=ct_data['Names'][0].lstrip('/'),
+        compose_name=ct_data['Labels']['com.docker.compose.service'],
+        ports=_extract_host_ports_from_list(ct_data['Ports']),
+        image=ct_data['Image'],
+        image_id=ct_data['ImageID'],
+        traefik_host=_get_traefik_host(ct_data['Labels']),
+        ip=_get_ip_from_networks(project_name, ct_data['NetworkSettings'].get('Networks', {})),
+        running=ct_data['State'] == 'running'
+        )
+
+
 def _extract_host_ports(config: list):
     ports = []
     for _, host_ports in config['HostConfig']['PortBindings'].items():
@@ -246,6 +458,17 @@ def _extract_host_ports(config: list):
     return ports
 
 
+def _extract_host_ports_from_list(ports: list):
+    host_ports = []
+    for port in ports:
+        host_port = str(port['PublicPort']) if 'PublicPort' in port else None
+        # The same port is listed for IPv4 and IPv6
+        if host_port is not None and host_port not in host_ports:
+            host_ports.append(host_port)
+
+    return host_ports
+
+
 def _get_ip_from_networks(project_name: str, networks: list):
     """Get the ip of a network."""
     network_settings = {}
@@ -255,6 +478,19 @@ def _get_ip_from_networks(project_name: str, networks: list):
     return network_settings['IPAddress'] if 'IPAddress' in network_settings else ''
 
 
+def _inspect_containers(project_name: str, cts_ids: list):
+    """Inspect containers concurrently, ignore the ones that disappeared meanwhile."""
+    if not cts_ids:
+        return []
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=min(len(cts_ids), 8)) as executor:
+        cts_info = executor.map(lambda ct_id: _extract_container_info(project_name, ct_id), cts_ids)
+
+    return [ct_info for ct_info in cts_info if ct_info is not None]
+
+
 def _container_in_network(container: str, expected_network: str):
     """Return True if a container is in a network else false. Used by add_container_to_network."""
     try:
@@ -0,0 +1,214 @@
+# coding: utf-8
+"""
+Docker exec through the API.
+
+Run a command in a container with exec_create / exec_start and stream it over
+the hijacked socket, instead of spawning the docker CLI. Supports TTY (local
+terminal in raw mode, resized on SIGWINCH), piped stdin and returns the exit
+code of the command.
+"""
+
+import os
+import selectors
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+
+
+def api_available():
+    """The API engine needs to poll stdin with the socket, which only works on unix."""
+    return sys.platform != 'win32' and hasattr(socket, 'AF_UNIX')
+
+
+class DockerExec:
+    """A command to run in a container, created when the object is built."""
+
+    def __init__(self, container: str, cmd: list, user: str = 'root', workdir: str = None, tty: bool = False,
+                 stdin=None, stdout=None, stderr=None):
+        """
+        Create the exec instance (it's not started yet).
+
+        Raise a DockerException if docker can't create it, so the caller can fall back
+        on the CLI without having run anything.
+        """
+        from stakkr.docker_actions import get_api_client
+
+        self.stdin = sys.stdin if stdin is None else stdin
+        self.stdout = _get_binary_stream(sys.stdout if stdout is None else stdout)
+        self.stderr = _get_binary_stream(sys.stderr if stderr is None else stderr)
+        # Like the CLI, a TTY is only possible if we are in a terminal
+        self.tty = tty is True and _isatty(self.stdin)
+        self.api = get_api_client()
+        self.exec_id = self.api.exec_create(
+            container, [str(arg) for arg in cmd], stdin=True, tty=self.tty, user=user, workdir=workdir)['Id']
+
+    def run(self):
+        """Start the command, stream its input and output and return its exit code."""
+        sock = self.api.exec_start(self.exec_id, tty=self.tty, socket=True)
+        raw_sock = getattr(sock, '_sock', sock)
+        try:
+            if self.tty is True:
+                self._run_tty(raw_sock)
+            else:
+                self._pump(raw_sock, Demuxer({1: self.stdout, 2: self.stderr}))
+        finally:
+            sock.close()
+            raw_sock.close()
+
+        return self._get_exit_code()
+
+    def resize(self):
+        """Give the size of the local terminal to the TTY of the command."""
+        try:
+            columns, lines = os.get_terminal_size(self.stdin.fileno())
+            self.api.exec_resize(self.exec_id, height=lines, width=columns)
+        except Exception:
+            # The command could have exited, or the terminal is gone
+            pass
+
+    def _run_tty(self, raw_sock: socket.socket):
+        import termios
+        import tty
+
+        stdin_fd = self.stdin.fileno()
+        old_attrs = termios.tcgetattr(stdin_fd)
+        old_handler = None
+        if threading.current_thread() is threading.main_thread():
+            old_handler = signal.signal(signal.SIGWINCH, lambda signum, frame: self.resize())
+
+        try:
+            tty.setraw(stdin_fd)
+            self.resize()
+            self._pump(raw_sock, _RawWriter(self.stdout))
+        finally:
+            termios.tcsetattr(stdin_fd, termios.TCSADRAIN, old_attrs)
+            if old_handler is not None:
+                signal.signal(signal.SIGWINCH, old_handler)
+
+    def _pump(self, raw_sock: socket.socket, writer):
+        """Send stdin to the socket and the socket to stdout / stderr, until the command exits."""
+        selector = selectors.DefaultSelector()
+        selector.register(raw_sock, selectors.EVENT_READ, 'socket')
+        stdin_fd = _get_fileno(self.stdin)
+        if stdin_fd is not None:
+            try:
+                selector.register(stdin_fd, selectors.EVENT_READ, 'stdin')
+            except (PermissionError, ValueError):
+                # Regular files can't be polled, but reading them never blocks
+                threading.Thread(target=_copy_input, args=(stdin_fd, raw_sock), daemon=True).start()
+
+        try:
+            while True:
+                for key, _ in selector.select():
+                    if key.data == 'stdin' and _send_input(stdin_fd, raw_sock) is False:
+                        selector.unregister(stdin_fd)
+                    if key.data == 'socket' and writer.feed(raw_sock.recv(65536)) is False:
+                        return
+        finally:
+            selector.close()
+
+    def _get_exit_code(self):
+        # Docker sets the exit code just after the output is closed
+        for _ in range(50):
+            result = self.api.exec_inspect(self.exec_id)
+            if result.get('Running') is not True and result.get('ExitCode') is not None:
+                return result['ExitCode']
+            time.sleep(0.01)
+
+        if result.get('ExitCode') is not None:
+            return result['ExitCode']
+
+        # Never a success we don't know about: 255, like ssh when it fails itself
+        self.stderr.write(b'The exit code of the command is unknown (docker did not give it)\n')
+        self.stderr.flush()
+
+        return 255
+
+
+class Demuxer:
+    """Split the multiplexed stream of docker (8 bytes header + payload) to stdout / stderr."""
+
+    def __init__(self, outputs: dict):
+        """Outputs (binary streams) by stream: 1 for stdout, 2 for stderr. Others go to stdout."""
+        self.outputs = outputs
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes):
+        """Write complete frames, return False at the end of the stream."""
+        if not data:
+            return False
+
+        self.buffer += data
+        written = set()
+        while len(self.buffer) >= 8:
+            stream, size = struct.unpack('>BxxxL', self.buffer[:8])
+            if len(self.buffer) < 8 + size:
+                break
+
+            output = self.outputs.get(stream, self.outputs[1])
+            output.write(bytes(self.buffer[8:8 + size]))
+            written.add(output)
+            del self.buffer[:8 + size]
+
+        for output in written:
+            output.flush()
+
+        return True
+
+
+class _RawWriter:
+    """With a TTY the stream is not multiplexed."""
+
+    def __init__(self, output):
+        self.output = output
+
+    def feed(self, data: bytes):
+        if not data:
+            return False
+
+        self.output.write(data)
+        self.output.flush()
+
+        return True
+
+
+def _copy_input(stdin_fd: int, raw_sock: socket.socket):
+    while _send_input(stdin_fd, raw_sock) is True:
+        pass
+
+
+def _send_input(stdin_fd: int, raw_sock: socket.socket):
+    """Send a chunk of stdin, return False at its end (the command receives an EOF)."""
+    data = os.read(stdin_fd, 65536)
+    try:
+        if not data:
+            raw_sock.shutdown(socket.SHUT_WR)
+            return False
+
+        raw_sock.sendall(data)
+    except OSError:
+        # The command exited without reading all its input
+        return False
+
+    return True
+
+
+def _get_binary_stream(stream):
+    return getattr(stream, 'buffer', stream)
+
+
+def _get_fileno(stream):
+    try:
+        return stream.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def _isatty(stream):
+    try:
+        return stream.isatty()
+    except (AttributeError, ValueError):
+        return False
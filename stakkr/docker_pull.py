@@ -0,0 +1,189 @@
+# coding: utf-8
+"""
+Pull the images of the services through the docker API, several at a time.
+
+An image is pulled only when the digest of its tag in the registry differs
+from the local one. The progress of all pulls is displayed on a single line
+(bytes downloaded / bytes to download) and the time each image took is kept
+into .stakkr/pulls.json.
+"""
+
+import sys
+import threading
+from time import perf_counter, time
+import click
+from stakkr import docker_actions as docker
+from stakkr import file_utils
+
+
+class ImagesPull:
+    """Pull a list of images, with a maximum number of pulls at the same time."""
+
+    def __init__(self, images: list, concurrency: int = 4, verbose: bool = False, stream=None):
+        """Images are pulled only once, even if several services use them."""
+        self.images = sorted(set(images))
+        self.concurrency = max(1, concurrency)
+        self.verbose = verbose
+        self.progress = _Progress(len(self.images), sys.stderr if stream is None else stream)
+
+    def run(self):
+        """Pull the images, return the result of each one: status (pulled, up to date), digest and time."""
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = dict(zip(self.images, executor.map(self._pull_image, self.images)))
+        self.progress.close()
+
+        errors = ['{} ({})'.format(image, result['error']) for image, result in results.items() if 'error' in result]
+        if errors:
+            raise RuntimeError("Can't pull images: {}".format(', '.join(errors)))
+
+        return results
+
+    def _pull_image(self, image: str):
+        from docker.errors import DockerException
+
+        start = perf_counter()
+        try:
+            local_digests = _get_local_digests(image)
+            remote_digest = _get_remote_digest(image)
+            if remote_digest is not None and remote_digest in local_digests:
+                result = {'status': 'up to date', 'digest': remote_digest}
+            else:
+                self._download(image)
+                result = {'status': 'pulled', 'digest': remote_digest}
+        except (DockerException, RuntimeError) as error:
+            result = {'status': 'error', 'error': str(error)}
+
+        result['seconds'] = round(perf_counter() - start, 3)
+        self.progress.image_done(image)
+        if self.verbose is True:
+            click.echo(click.style('[VERBOSE]', fg='green') + ' {} {} in {:.2f}s'.format(
+                image, result['status'], result['seconds']), file=sys.stderr)
+
+        return result
+
+    def _download(self, image: str):
+        from docker.utils import parse_repository_tag
+
+        repository, tag = parse_repository_tag(image)
+        events = docker.get_api_client().pull(repository, tag=tag or 'latest', stream=True, decode=True)
+        for event in events:
+            if 'error' in event:
+                raise RuntimeError(event['error'])
+
+            self.progress.update(image, event)
+
+
+def get_services_images(compose_file: str, services: list = None):
+    """Images of the services (all or some) defined in a compose file, by service. Services built have no image."""
+    from yaml import load
+    from stakkr.configreader import Loader
+
+    with open(compose_file) as stream:
+        compose_services = (load(stream, Loader=Loader) or {}).get('services', {})
+
+    return {service: conf['image'] for service, conf in compose_services.items()
+            if 'image' in conf and (not services or service in services)}
+
+
+def pull_services_images(config: dict, services: list = None, verbose: bool = False):
+    """
+    Pull the images of the enabled services (all or some), with pull.concurrency
+    pulls at a time. Return None if the images can't be listed.
+    """
+    from stakkr.stakkr_compose import get_rendered_compose_file
+
+    compose_file = get_rendered_compose_file(config)
+    if compose_file is None:
+        return None
+
+    images = get_services_images(compose_file, services)
+    results = ImagesPull(list(images.values()), config.get('pull', {}).get('concurrency', 4), verbose).run()
+    _save_timings(config['project_dir'], results)
+
+    return results
+
+
+def _get_local_digests(image: str):
+    """Digests of the local image, without the repository (empty if it's not there)."""
+    from docker.errors import ImageNotFound
+
+    try:
+        repo_digests = docker.get_api_client().inspect_image(image).get('RepoDigests') or []
+    except ImageNotFound:
+        return []
+
+    return [repo_digest.split('@')[-1] for repo_digest in repo_digests]
+
+
+def _get_remote_digest(image: str):
+    """Digest of the tag in the registry, None if it can't be read (the image is pulled anyway)."""
+    from docker.errors import APIError
+
+    try:
+        return docker.get_api_client().inspect_distribution(image)['Descriptor']['digest']
+    except (APIError, KeyError):
+        return None
+
+
+def _save_timings(project_dir: str, results: dict):
+    pulls_file = file_utils.get_stakkr_dir(project_dir) + '/pulls.json'
+    try:
+        pulls = file_utils.read_json(pulls_file, {})
+        for image, result in results.items():
+            pulls[image] = dict(result, date=int(time()))
+        file_utils.write_json(pulls_file, pulls)
+    except OSError:
+        pass
+
+
+class _Progress:
+    """Bytes downloaded for all the images, displayed on a single line."""
+
+    def __init__(self, images_count: int, stream):
+        self.images_count = images_count
+        self.images_done = 0
+        self.layers = dict()
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.last_display = 0
+        self.displayed = False
+
+    def update(self, image: str, event: dict):
+        """Read a pull event: the progress of a layer download."""
+        detail = event.get('progressDetail') or {}
+        layer = (image, event.get('id'))
+        with self.lock:
+            if event.get('status') == 'Downloading' and detail.get('total'):
+                self.layers[layer] = (detail.get('current', 0), detail['total'])
+            elif event.get('status') in ('Download complete', 'Already exists') and layer in self.layers:
+                self.layers[layer] = (self.layers[layer][1], self.layers[layer][1])
+
+            if perf_counter() - self.last_display > 0.1:
+                self._display()
+
+    def image_done(self, image: str):
+        """An image has been pulled (or is up to date)."""
+        with self.lock:
+            self.images_done += 1
+            self._display()
+
+    def close(self):
+        """End the line."""
+        if self.displayed is True:
+            self.stream.write('\n')
+            self.stream.flush()
+
+    def _display(self):
+        if self.stream.isatty() is False:
+            return
+
+        current = sum(layer[0] for layer in self.layers.values())
+        total = sum(layer[1] for layer in self.layers.values())
+        self.stream.write('\r{} {}/{} images, {:.1f} / {:.1f} MB'.format(
+            click.style('[PULLING]', fg='green'), self.images_done, self.images_count,
+            current / 1024 / 1024, total / 1024 / 1024))
+        self.stream.flush()
+        self.last_display = perf_counter()
+        self.displayed = True
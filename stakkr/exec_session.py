@@ -0,0 +1,329 @@
+# coding: utf-8
+"""
+Persistent exec sessions (exec.engine: session).
+
+Like SSH ControlMaster: the first command run in a container starts a
+session, a local process keeping a shell (sh) in the container, created once
+with the exec API. It listens on a unix socket in .stakkr/sessions/ and the
+next commands go through it instead of creating an exec each time. Each
+command runs in a subshell, without input, its stdout, stderr and exit code
+come back in frames. A session ends when it's idle for exec.session_timeout
+seconds, when its shell exits (the container stopped) or with stakkr stop.
+"""
+
+import json
+import os
+import socket
+import socketserver
+import struct
+import sys
+import time
+
+# Frames sent by the session: kind (1 byte), size (4 bytes), payload
+STDOUT, STDERR, EXIT, ERROR, CLOSED = 1, 2, 3, 4, 5
+
+
+def input_needed(stdin=None):
+    """
+    Data given as input (a pipe, a socket, a file ...): the command must run
+    with a real exec to read it. Not a terminal (without TTY, commands don't
+    read it), /dev/null or a closed stdin.
+    """
+    import stat
+
+    stdin = sys.stdin if stdin is None else stdin
+    try:
+        stats = os.fstat(stdin.fileno())
+    except (AttributeError, OSError, ValueError):
+        return False
+
+    if stat.S_ISCHR(stats.st_mode):
+        # A terminal, /dev/null or another device
+        return stdin.isatty() is False and stats.st_rdev != os.stat(os.devnull).st_rdev
+
+    return True
+
+
+def get_socket_path(project_dir: str, container: str, user: str):
+    """Sockets are named from a hash: the path of a unix socket is limited to ~100 chars."""
+    from hashlib import sha256
+    from stakkr.file_utils import get_stakkr_dir
+
+    name = sha256('{}\0{}'.format(container, user).encode()).hexdigest()[:16]
+
+    return '{}/{}.sock'.format(get_stakkr_dir(project_dir, 'sessions'), name)
+
+
+def run(project_dir: str, container: str, user: str, command: str, workdir: str, idle_timeout: float,
+        stdout, stderr):
+    """
+    Run a shell command in the session of a container (started if needed) and
+    write its output to stdout / stderr (binary streams). Return its exit code.
+    Raise a ConnectionError if the session can't be started (nothing was run).
+    """
+    socket_path = get_socket_path(project_dir, container, user)
+    request = json.dumps({'action': 'run', 'command': command, 'workdir': workdir}).encode() + b'\n'
+    # A session whose shell exited (container restarted) ends: start a new one
+    for _ in range(2):
+        sock = _connect(socket_path) or _start_session(socket_path, container, user, idle_timeout)
+        with sock:
+            sock.sendall(request)
+            exit_code = _read_frames(sock, stdout, stderr)
+        if exit_code is not None:
+            return exit_code
+        # The session ends: its socket must be gone before another one starts
+        _wait_removed(socket_path)
+
+    raise ConnectionError('The session of {} ended'.format(container))
+
+
+def close_sessions(project_dir: str):
+    """Close the sessions of a project, return how many were running."""
+    from glob import glob
+
+    closed = 0
+    for socket_path in glob('{}/.stakkr/sessions/*.sock'.format(project_dir)):
+        sock = _connect(socket_path, timeout=2)
+        if sock is None:
+            _remove(socket_path)
+            continue
+
+        with sock:
+            try:
+                sock.sendall(json.dumps({'action': 'close'}).encode() + b'\n')
+                sock.recv(64)
+            except OSError:
+                # Busy with a long command: it will end at its idle timeout
+                pass
+        closed += 1
+
+    return closed
+
+
+class Session:
+    """A shell in a container, running the commands received on a unix socket, one at a time."""
+
+    def __init__(self, socket_path: str, container: str, user: str, idle_timeout: float):
+        """The shell is started by serve."""
+        self.socket_path = socket_path
+        self.container = container
+        self.user = user
+        self.idle_timeout = idle_timeout
+        self.running = False
+        self.shell = None
+
+    def serve(self):
+        """Start the shell, listen on the socket until closed, idle or the shell exits."""
+        from stakkr.docker_actions import get_api_client
+
+        if _connect(self.socket_path) is not None:
+            # Another session started at the same time
+            return
+
+        _remove(self.socket_path)
+        api = get_api_client()
+        exec_id = api.exec_create(self.container, ['sh'], stdin=True, tty=False, user=self.user)['Id']
+        sock = api.exec_start(exec_id, socket=True)
+        self.shell = getattr(sock, '_sock', sock)
+
+        server = _Server(self.socket_path, _RequestHandler)
+        server.session = self
+        server.timeout = self.idle_timeout
+        os.chmod(self.socket_path, 0o600)
+        self.running = True
+        try:
+            while self.running is True:
+                server.handle_request()
+        finally:
+            server.server_close()
+            _remove(self.socket_path)
+            self.shell.close()
+            sock.close()
+
+    def run(self, command: str, workdir: str, send):
+        """
+        Run a command in a subshell and send its output as it comes. The end of each
+        stream is a random marker, the one of stdout is followed by the exit code.
+        Return the exit code, raise a ConnectionError if the shell exited.
+        """
+        import secrets
+        import shlex
+        from stakkr.docker_exec import Demuxer
+
+        token = secrets.token_hex(16)
+        cd = 'cd {} && '.format(shlex.quote(workdir)) if workdir else ''
+        script = '({}exec {}) </dev/null; printf "%s:%d\\n" {} $?; printf "%s\\n" {} >&2\n'.format(
+            cd, command, token, token)
+        outputs = {STDOUT: _MarkedOutput(token, STDOUT, send), STDERR: _MarkedOutput(token, STDERR, send)}
+        demuxer = Demuxer(outputs)
+        try:
+            self.shell.sendall(script.encode())
+            while any(output.end is None for output in outputs.values()):
+                if demuxer.feed(self.shell.recv(65536)) is False:
+                    raise ConnectionError('The shell of the session exited')
+        except OSError:
+            self.running = False
+            raise ConnectionError('The shell of the session exited')
+
+        return int(outputs[STDOUT].end[1:])
+
+
+class _MarkedOutput:
+    """A stream of the shell: sent to the client until the end marker of the command."""
+
+    def __init__(self, token: str, kind: int, send):
+        self.token = token.encode()
+        self.kind = kind
+        self.send = send
+        self.pending = b''
+        # What follows the marker on its line, once received
+        self.end = None
+
+    def write(self, data: bytes):
+        self.pending += data
+        index = self.pending.find(self.token)
+        if index == -1:
+            # The end could be the beginning of the marker
+            keep = len(self.token) - 1
+            self._send(self.pending[:-keep])
+            self.pending = self.pending[-keep:]
+            return
+
+        self._send(self.pending[:index])
+        self.pending = self.pending[index:]
+        line_end = self.pending.find(b'\n')
+        if line_end != -1:
+            self.end = self.pending[len(self.token):line_end].decode()
+            self.pending = b''
+
+    def flush(self):
+        """Data is sent as it comes."""
+
+    def _send(self, data: bytes):
+        if data:
+            self.send(self.kind, data)
+
+
+class _Server(socketserver.UnixStreamServer):
+    def handle_timeout(self):
+        """Idle for too long."""
+        self.session.running = False
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """A JSON request (run a command or close), answered by frames."""
+
+    def handle(self):
+        session = self.server.session
+        self.sent = False
+        try:
+            request = json.loads(self.rfile.readline().decode())
+            if request.get('action') == 'close':
+                session.running = False
+                return self._send(EXIT, b'0')
+
+            exit_code = session.run(request['command'], request.get('workdir'), self._send)
+            self._send(EXIT, str(exit_code).encode())
+        except ConnectionError as error:
+            # Nothing was run if nothing was sent, the client can start another session
+            self._send(ERROR if self.sent else CLOSED, str(error).encode())
+        except Exception as error:
+            self._send(ERROR, str(error).encode())
+
+    def _send(self, kind: int, data: bytes):
+        self.sent = self.sent or kind in (STDOUT, STDERR)
+        try:
+            self.wfile.write(struct.pack('>BL', kind, len(data)) + data)
+            self.wfile.flush()
+        except OSError:
+            # The client is gone, the command goes on until its end marker
+            pass
+
+
+def _connect(socket_path: str, timeout: float = None):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+
+    return sock
+
+
+def _read_frames(sock: socket.socket, stdout, stderr):
+    """Write the output received, return the exit code, None if the session ended without running the command."""
+    stream = sock.makefile('rb')
+    received = False
+    while True:
+        header = stream.read(5)
+        if len(header) < 5 and received is False:
+            # Closed before answering: the session was ending when we connected
+            return None
+        if len(header) < 5:
+            raise RuntimeError('The session ended during the command')
+
+        received = True
+
+        kind, size = struct.unpack('>BL', header)
+        payload = stream.read(size)
+        if kind == EXIT:
+            return int(payload)
+        if kind == CLOSED:
+            return None
+        if kind == ERROR:
+            raise RuntimeError('Session error: {}'.format(payload.decode()))
+
+        output = stdout if kind == STDOUT else stderr
+        output.write(payload)
+        output.flush()
+
+
+def _remove(socket_path: str):
+    try:
+        os.remove(socket_path)
+    except OSError:
+        pass
+
+
+def _wait_removed(socket_path: str, timeout: float = 2):
+    from time import perf_counter
+
+    deadline = perf_counter() + timeout
+    while os.path.exists(socket_path) and perf_counter() < deadline:
+        time.sleep(0.01)
+
+
+def _start_session(socket_path: str, container: str, user: str, idle_timeout: float):
+    """Start a session in the background and connect to it."""
+    import subprocess
+    from time import perf_counter
+
+    log_file = socket_path[:-len('.sock')] + '.log'
+    with open(log_file, 'ab') as log:
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'stakkr.exec_session', socket_path, container, user, str(idle_timeout)],
+            stdin=subprocess.DEVNULL, stdout=log, stderr=log, start_new_session=True)
+
+    deadline = perf_counter() + 10
+    while perf_counter() < deadline:
+        sock = _connect(socket_path)
+        if sock is not None:
+            return sock
+        if process.poll() is not None and _connect(socket_path) is None:
+            raise ConnectionError("Can't start a session in {} (see {})".format(container, log_file))
+        time.sleep(0.02)
+
+    process.kill()
+    raise ConnectionError("The session of {} didn't start in 10s (see {})".format(container, log_file))
+
+
+def main():
+    """Run a session: python -m stakkr.exec_session socket_path container user idle_timeout"""
+    socket_path, container, user, idle_timeout = sys.argv[1:5]
+    Session(socket_path, container, user, float(idle_timeout)).serve()
+
+
+if __name__ == '__main__':
+    main()
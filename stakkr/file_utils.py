@@ -5,9 +5,15 @@ Files Utils to find dir, files, etc.
 Such as : static files locations or directories location
 """
 
-from os import getcwd, listdir
+import json
+import threading
+from contextlib import contextmanager
+from os import getcwd, getpid, listdir, makedirs, replace
 from os.path import dirname, realpath
 
+# Without flock (Windows), files are only locked between the threads of stakkr
+__lock__ = threading.Lock()
+
 
 def get_lib_basedir():
     """Return the base directory of stakkr, where all files are, to read services and config."""
@@ -24,6 +30,51 @@ def get_file(directory: str, filename: str):
     return get_dir(directory) + '/' + filename.lstrip('/')
 
 
+def get_stakkr_dir(project_dir: str, directory: str = ''):
+    """Return the directory of a project where stakkr keeps its caches and logs, create it if needed."""
+    stakkr_dir = '{}/.stakkr/{}'.format(project_dir, directory.strip('/')).rstrip('/')
+    makedirs(stakkr_dir, exist_ok=True)
+
+    return stakkr_dir
+
+
+def read_json(filename: str, default=None):
+    """Read a JSON file, return default if it does not exist or is corrupted."""
+    try:
+        with open(filename, 'r') as stream:
+            return json.load(stream)
+    except (OSError, ValueError):
+        return default
+
+
+def write_file(filename: str, content: str):
+    """Write a file atomically, so a concurrent reader never gets a partial file."""
+    tmp_file = '{}.{}.tmp'.format(filename, getpid())
+    with open(tmp_file, 'w') as stream:
+        stream.write(content)
+    replace(tmp_file, filename)
+
+
+def write_json(filename: str, data):
+    """Write a JSON file atomically."""
+    write_file(filename, json.dumps(data))
+
+
+@contextmanager
+def lock_file(filename: str):
+    """Hold an exclusive lock on filename (with flock on filename.lock), to read then write it safely."""
+    try:
+        import fcntl
+    except ImportError:
+        with __lock__:
+            yield
+        return
+
+    with open(filename + '.lock', 'a') as stream:
+        fcntl.flock(stream.fileno(), fcntl.LOCK_EX)
+        yield
+
+
 def find_project_dir():
     """Determine the project base dir, by searching a stakkr.yml file"""
     path = getcwd()
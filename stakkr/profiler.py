@@ -0,0 +1,133 @@
+# coding: utf-8
+"""
+Time the phases of a command (stakkr --profile or STAKKR_PROFILE=1).
+
+Each phase keeps its wall time, the CPU time of stakkr and the CPU time of
+the child processes (docker-compose ...) it waited for. A summary is displayed
+at the end of the command and appended to .stakkr/timings.jsonl.
+"""
+
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from time import perf_counter, time
+import click
+
+__profile__ = {'current': None}
+
+
+class Profile:
+    """Phases of a command, in the order they started. A phase run several times is summed."""
+
+    def __init__(self, command: str):
+        """Start the profile of a command."""
+        self.command = command
+        self.phases = dict()
+        self.lock = threading.Lock()
+        self.start = perf_counter()
+        self.start_times = os.times()
+
+    @contextmanager
+    def phase(self, name: str):
+        """Time what's run in the block. CPU times are the ones of the process, whatever the thread."""
+        with self.lock:
+            # Listed when it starts: a phase is after the ones it's part of
+            phase = self.phases.setdefault(name, {'calls': 0, 'wall': 0, 'cpu': 0, 'children_cpu': 0})
+
+        start = perf_counter()
+        start_times = os.times()
+        try:
+            yield
+        finally:
+            wall = perf_counter() - start
+            cpu, children_cpu = _get_cpu_times(start_times)
+            with self.lock:
+                phase['calls'] += 1
+                phase['wall'] += wall
+                phase['cpu'] += cpu
+                phase['children_cpu'] += children_cpu
+
+    def get_record(self):
+        """The profile as a dict, with the machine it ran on."""
+        from platform import node, platform, python_version
+
+        cpu, children_cpu = _get_cpu_times(self.start_times)
+        phases = [dict(_round_times(phase), name=name) for name, phase in self.phases.items()]
+
+        return dict(_round_times({'wall': perf_counter() - self.start, 'cpu': cpu, 'children_cpu': children_cpu}),
+                    date=int(time()), command=self.command, argv=sys.argv[1:],
+                    host=node(), platform=platform(), python=python_version(), phases=phases)
+
+    def display(self, stream=None):
+        """Print a table of the phases, then the total."""
+        record = self.get_record()
+        lines = ['{:<24} {:>6} {:>10} {:>10} {:>14}'.format('Phase', 'Calls', 'Wall (s)', 'CPU (s)', 'Children (s)')]
+        for phase in record['phases'] + [dict(record, name='total', calls='')]:
+            lines.append('{:<24} {:>6} {:>10.3f} {:>10.3f} {:>14.3f}'.format(
+                phase['name'], phase['calls'], phase['wall'], phase['cpu'], phase['children_cpu']))
+
+        click.echo(click.style('[PROFILE]', fg='green') + ' ' + self.command, file=stream or sys.stderr)
+        click.echo('\n'.join(lines), file=stream or sys.stderr)
+
+    def save(self, project_dir: str):
+        """Append the profile to .stakkr/timings.jsonl of the project."""
+        import json
+        from stakkr.file_utils import get_stakkr_dir
+
+        with open(get_stakkr_dir(project_dir) + '/timings.jsonl', 'a') as stream:
+            stream.write(json.dumps(self.get_record()) + '\n')
+
+
+def get_profile():
+    """Return the profile of the current command, None if it's not profiled."""
+    return __profile__['current']
+
+
+@contextmanager
+def phase(name: str):
+    """Time a phase of the current command, if it's profiled."""
+    profile = get_profile()
+    if profile is None:
+        yield
+        return
+
+    with profile.phase(name):
+        yield
+
+
+def start_profile(command: str):
+    """Profile the current command."""
+    __profile__['current'] = Profile(command)
+
+    return __profile__['current']
+
+
+def stop_profile():
+    """Stop profiling, return the profile (None if there was none)."""
+    profile, __profile__['current'] = __profile__['current'], None
+
+    return profile
+
+
+def wrap(name: str, func):
+    """Return a function that calls func in a phase, to be run in a thread for example."""
+    def _wrapped(*args, **kwargs):
+        with phase(name):
+            return func(*args, **kwargs)
+
+    return _wrapped
+
+
+def _round_times(times: dict):
+    return dict(times, **{key: round(times[key], 4) for key in ('wall', 'cpu', 'children_cpu')})
+
+
+def _get_cpu_times(start_times):
+    """CPU time (user + system) of stakkr and of its children since start_times."""
+    times = os.times()
+    cpu = times.user + times.system - start_times.user - start_times.system
+    children_cpu = times.children_user + times.children_system
+    children_cpu -= start_times.children_user + start_times.children_system
+
+    return cpu, children_cpu
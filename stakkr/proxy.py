@@ -2,7 +2,6 @@
 """Manage public proxy to expose containers."""
 
 import click
-from docker.errors import DockerException
 from stakkr import docker_actions as docker
 from stakkr.file_utils import get_dir
 
@@ -10,22 +9,32 @@ from stakkr.file_utils import get_dir
 class Proxy:
     """Main class that does actions asked by the cli."""
 
-    def __init__(self, http_port: int = 80, https_port: int = 443, ct_name: str = 'proxy_stakkr', version: str = 'latest'):
-        """Set the right values to start the proxy."""
+    def __init__(self, http_port: int = 80, https_port: int = 443, ct_name: str = 'proxy_stakkr',
+                 version: str = 'latest', pull: str = 'missing'):
+        """Set the right values to start the proxy. pull is the policy for the image: always, missing or never."""
         self.ports = {'http': http_port, 'https': https_port}
         self.ct_name = ct_name
         self.docker_client = docker.get_client()
         self.version = version
+        self.pull = pull
 
     def start(self, stakkr_network: str = None):
-        """Start stakkr proxy if stopped."""
+        """Start stakkr proxy if stopped, return True if it was started."""
+        started = False
         if docker.container_running(self.ct_name) is False:
             print(click.style('[STARTING]', fg='green') + ' traefik')
             self._start_container()
+            started = True
 
         # Connect it to network if asked
         if stakkr_network is not None:
-            docker.add_container_to_network(self.ct_name, stakkr_network)
+            self.connect(stakkr_network)
+
+        return started
+
+    def connect(self, stakkr_network: str):
+        """Connect the proxy (started) to the network of a project."""
+        docker.add_container_to_network(self.ct_name, stakkr_network)
 
     def stop(self):
         """Stop stakkr proxy."""
@@ -38,9 +47,11 @@ class Proxy:
 
     def _start_container(self):
         """Start proxy."""
+        from docker.errors import DockerException
+
         proxy_conf_dir = get_dir('static/proxy')
         try:
-            self.docker_client.images.pull('traefik:{}'.format(self.version))
+            self._pull_image()
             self.docker_client.containers.run(
                 'traefik:{}'.format(self.version), remove=True, detach=True,
                 hostname=self.ct_name, name=self.ct_name,
@@ -51,3 +62,20 @@ class Proxy:
                 ports={80: self.ports['http'], 8080: 8080, 443: self.ports['https']})
         except DockerException as error:
             raise RuntimeError("Can't start proxy ...({})".format(error))
+
+    def _pull_image(self):
+        """Pull the image of traefik, according to the pull policy."""
+        from docker.errors import ImageNotFound
+
+        image = 'traefik:{}'.format(self.version)
+        if self.pull == 'never':
+            return
+
+        if self.pull == 'missing':
+            try:
+                self.docker_client.images.get(image)
+                return
+            except ImageNotFound:
+                pass
+
+        self.docker_client.images.pull(image)
@@ -0,0 +1,182 @@
+# coding: utf-8
+"""
+Wait for the services to be ready, not only started.
+
+Each service is probed concurrently (asyncio), with the docker healthcheck of
+its container if it has one, else an HTTP GET on its service_url, else a TCP
+connection to its port. Probes are tried again with a growing delay, until a
+global timeout. The probe of a service can be set with its "ready" option.
+"""
+
+import asyncio
+from time import perf_counter
+from urllib.parse import urlsplit
+from stakkr import docker_actions as docker
+
+__probes__ = ('health', 'http', 'tcp', 'running')
+
+
+class Probe:
+    """How to know that a service is ready."""
+
+    def __init__(self, service: str, kind: str, ct_id: str = None, address: tuple = None, http_host: str = None,
+                 path: str = '/', fallback=None):
+        """
+        address is (host, port) for tcp and http probes, http_host the Host header sent.
+        fallback is the probe used instead of the healthcheck when the container has none.
+        """
+        if kind not in __probes__:
+            raise ValueError('Unknown probe "{}" for {} (valid: {})'.format(kind, service, ', '.join(__probes__)))
+
+        self.service = service
+        self.kind = kind
+        self.ct_id = ct_id
+        self.address = address
+        self.http_host = http_host
+        self.path = path
+        self.fallback = fallback
+
+    async def resolve(self, loop):
+        """Return the probe to use: itself, or its fallback if the container has no healthcheck."""
+        if self.fallback is None:
+            return self
+
+        status = await loop.run_in_executor(None, _get_health_status, self.ct_id)
+
+        return self if status is not None else self.fallback
+
+    async def check(self, loop):
+        """Probe the service once, return True if it's ready."""
+        if self.kind == 'running':
+            return True
+
+        if self.kind == 'health':
+            status = await loop.run_in_executor(None, _get_health_status, self.ct_id)
+            return status == 'healthy'
+
+        try:
+            reader, writer = await asyncio.open_connection(*self.address)
+        except OSError:
+            return False
+
+        try:
+            return True if self.kind == 'tcp' else await self._http_ok(reader, writer)
+        finally:
+            writer.close()
+
+    async def _http_ok(self, reader, writer):
+        """Any answer but a server error is fine, except a 404 from the proxy (the service isn't registered yet)."""
+        request = 'GET {} HTTP/1.0\r\nHost: {}\r\nConnection: close\r\n\r\n'.format(self.path, self.http_host)
+        writer.write(request.encode())
+        try:
+            status_line = await reader.readline()
+            status = int(status_line.split()[1])
+        except (OSError, IndexError, ValueError):
+            return False
+
+        return status < 500 and status != 404
+
+
+def get_probe(ct_info: dict, service_config: dict, proxy_config: dict):
+    """
+    Build the probe of a running service from its config ("ready" option: probe,
+    port and path) and its container. The probe "auto" (by default) uses the
+    docker healthcheck if the container has one, else service_url, a port (from
+    "ready" or published) or only checks the container runs, in that order.
+    """
+    ready = service_config.get('ready', {})
+    kind = ready.get('probe', 'auto')
+    service = ct_info['compose_name']
+    if kind == 'auto':
+        fallback = get_probe(ct_info, dict(service_config, ready=dict(ready, probe=_guess_probe(
+            ct_info, service_config, ready))), proxy_config)
+        return Probe(service, 'health', ct_id=ct_info['id'], fallback=fallback)
+
+    if kind == 'health':
+        return Probe(service, kind, ct_id=ct_info['id'])
+
+    if kind == 'http':
+        return _get_http_probe(ct_info, service_config, proxy_config, ready)
+
+    if kind == 'tcp':
+        if 'port' not in ready and not ct_info['ports']:
+            raise ValueError('The probe "tcp" of {} needs a port: it publishes none, set ready.port'.format(service))
+        address = (ct_info['ip'], ready['port']) if 'port' in ready else ('127.0.0.1', int(ct_info['ports'][0]))
+        return Probe(service, kind, address=address)
+
+    return Probe(service, kind)
+
+
+def wait_for(probes: list, timeout: float, max_delay: float = 2):
+    """
+    Probe services concurrently until they are ready. Return for each service
+    the probe used and the time it took to be ready (None if it's not).
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(_wait_all(loop, probes, timeout, max_delay))
+    finally:
+        loop.close()
+
+
+async def _wait_all(loop, probes: list, timeout: float, max_delay: float):
+    start = perf_counter()
+    results = await asyncio.gather(*[_wait_service(loop, probe, start + timeout, max_delay) for probe in probes])
+
+    return {probe.service: result for probe, result in zip(probes, results)}
+
+
+async def _wait_service(loop, probe: Probe, deadline: float, max_delay: float):
+    start = perf_counter()
+    probe = await probe.resolve(loop)
+    delay = 0.1
+    while True:
+        try:
+            ready = await asyncio.wait_for(probe.check(loop), max(deadline - perf_counter(), 0.01))
+        except asyncio.TimeoutError:
+            ready = False
+
+        if ready is True:
+            return {'probe': probe.kind, 'seconds': perf_counter() - start}
+
+        if perf_counter() + delay > deadline:
+            return {'probe': probe.kind, 'seconds': None}
+
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+
+def _get_health_status(ct_id: str):
+    from docker.errors import NotFound
+
+    try:
+        state = docker.get_api_client().inspect_container(ct_id)['State']
+    except NotFound:
+        return None
+
+    return state.get('Health', {}).get('Status')
+
+
+def _get_http_probe(ct_info: dict, service_config: dict, proxy_config: dict, ready: dict):
+    """Through the proxy if it's enabled (as the user would do), else to the container."""
+    if bool(proxy_config['enabled']) is True and ct_info['traefik_host'] != 'No traefik rule':
+        address = ('127.0.0.1', int(proxy_config['http_port']))
+        http_host = ct_info['traefik_host'].split(',')[0].lower()
+    else:
+        address = (ct_info['ip'], ready.get('port', 80))
+        http_host = ct_info['ip']
+
+    url = urlsplit(service_config.get('service_url', 'http://{}').format(http_host))
+    path = ready.get('path', url.path or '/')
+
+    return Probe(ct_info['compose_name'], 'http', address=address, http_host=http_host, path=path)
+
+
+def _guess_probe(ct_info: dict, service_config: dict, ready: dict):
+    if 'service_url' in service_config and service_config['service_url'].startswith('http'):
+        return 'http'
+
+    if 'port' in ready or ct_info['ports']:
+        return 'tcp'
+
+    return 'running'
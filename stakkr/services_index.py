@@ -0,0 +1,175 @@
+# coding: utf-8
+"""
+Index of the services available for a project.
+
+Services come from stakkr (static/services) and from the packs installed into
+services/ of the project. The index keeps for each pack its services, its
+config_default.yml / config_schema.yml and their signatures (size and
+modification time, contents are hashed by the config cache), in
+.stakkr/services.json. It's built again after services-add / services-update,
+or when a directory of the packs changes (a pack, a file added or removed).
+"""
+
+from hashlib import sha1
+from os import listdir, path, stat
+from stakkr import file_utils, profiler
+
+# Bump it when the format of the index changes
+__index_version__ = 2
+# Indexes of the current process, by project dir
+__indexes__ = dict()
+
+
+class ServicesIndex:
+    """Services and packs of a project, read from .stakkr/services.json."""
+
+    def __init__(self, project_dir: str):
+        """Load the index, build it if it's missing or outdated."""
+        self.project_dir = project_dir
+        self.services_dir = '{}/services'.format(project_dir)
+        self.index = None
+
+    def get_config_files(self, packs_names: list = None):
+        """Return config_default.yml and config_schema.yml files of the packs (all or some), by pack name."""
+        packs = self._get_index()['packs']
+        packs_names = sorted(packs if packs_names is None else set(packs_names) & set(packs))
+        defaults = [packs[pack]['config_default'] for pack in packs_names if packs[pack]['config_default']]
+        schemas = [packs[pack]['config_schema'] for pack in packs_names if packs[pack]['config_schema']]
+
+        return defaults, schemas
+
+    def get_key(self):
+        """Key of the index: it changes when a pack or a service is added or removed."""
+        return self._get_index()['key']
+
+    def get_packs(self):
+        """Return the packs installed with their services, config files and signatures."""
+        return self._get_index()['packs']
+
+    def get_service_pack(self, service: str):
+        """Return the name of the pack that provides a service, None if it's a stakkr's one or unknown."""
+        return self._get_index()['services_packs'].get(service)
+
+    def get_service_file(self, service: str):
+        """Return the compose file of a service, None if no pack provides it."""
+        return self._get_index()['services'].get(service)
+
+    def get_services(self):
+        """Return all available services (compose file by name), packs override stakkr's ones."""
+        return dict(self._get_index()['services'])
+
+    def check(self):
+        """Load the index again if a directory changed since it was loaded."""
+        if self.index is not None and self.index.get('key') != self._get_key():
+            self.index = None
+
+        return self
+
+    def rebuild(self):
+        """Build the index from the files, and save it."""
+        self.index = _build_index(self.services_dir)
+        self.index['key'] = self._get_key()
+        try:
+            file_utils.write_json(self._get_index_file(), self.index)
+        except OSError:
+            pass
+
+        return self.index
+
+    def _get_index(self):
+        if self.index is not None:
+            return self.index
+
+        with profiler.phase('services index'):
+            try:
+                index = file_utils.read_json(self._get_index_file(), {})
+            except OSError:
+                index = {}
+
+            if index.get('version') == __index_version__ and index.get('key') == self._get_key():
+                self.index = index
+                return self.index
+
+            return self.rebuild()
+
+    def _get_index_file(self):
+        return file_utils.get_stakkr_dir(self.project_dir) + '/services.json'
+
+    def _get_key(self):
+        """Modification times of the directories where services and packs are."""
+        dirs = [file_utils.get_dir('static') + '/services', self.services_dir]
+        for pack in _list_dir(self.services_dir):
+            dirs += [self.services_dir + '/' + pack, self.services_dir + '/' + pack + '/docker-compose']
+
+        key = []
+        for directory in dirs:
+            try:
+                key.append('{}:{}'.format(directory, stat(directory).st_mtime_ns))
+            except OSError:
+                key.append('{}:'.format(directory))
+
+        return sha1('\n'.join(key).encode()).hexdigest()
+
+
+def get_services_index(project_dir: str):
+    """
+    Get the index of services of a project, loaded (and checked) once per process.
+    A process that runs for long (the daemon) calls check() before reading the config again.
+    """
+    if project_dir not in __indexes__:
+        __indexes__[project_dir] = ServicesIndex(project_dir)
+
+    return __indexes__[project_dir]
+
+
+def rebuild_services_index(project_dir: str):
+    """Build again the index of a project, after packs have been added or updated."""
+    return get_services_index(project_dir).rebuild()
+
+
+def _build_index(services_dir: str):
+    # Stakkr's services first, then the packs by name: the last one wins
+    services = _get_services_from_dir(file_utils.get_dir('static') + '/services')
+    services_packs = dict()
+    packs = dict()
+    for pack in _list_dir(services_dir):
+        pack_dir = services_dir + '/' + pack
+        if path.isdir(pack_dir) is False:
+            continue
+
+        packs[pack] = {
+            'path': pack_dir,
+            'services': _get_services_from_dir(pack_dir + '/docker-compose'),
+            'config_default': _get_file(pack_dir + '/config_default.yml'),
+            'config_schema': _get_file(pack_dir + '/config_schema.yml')}
+        files = list(packs[pack]['services'].values())
+        files += [packs[pack]['config_default'], packs[pack]['config_schema']]
+        packs[pack]['signatures'] = {filename: _get_signature(filename) for filename in files if filename is not None}
+        services.update(packs[pack]['services'])
+        services_packs.update({service: pack for service in packs[pack]['services']})
+
+    return {'version': __index_version__, 'packs': packs, 'services': services, 'services_packs': services_packs}
+
+
+def _get_file(filename: str):
+    return filename if path.isfile(filename) else None
+
+
+def _get_services_from_dir(services_dir: str):
+    """Compose files of a directory, by service name."""
+    services_files = [filename for filename in _list_dir(services_dir) if filename.endswith('.yml')]
+
+    return {filename[:-4]: '{}/{}'.format(services_dir, filename) for filename in services_files}
+
+
+def _get_signature(filename: str):
+    file_stat = stat(filename)
+
+    return '{}:{}'.format(file_stat.st_size, file_stat.st_mtime_ns)
+
+
+def _list_dir(directory: str):
+    try:
+        return sorted(listdir(directory))
+    except OSError:
+        return []
@@ -6,22 +6,38 @@ CLI Main Entry Point.
 Wraps docker-compose and build it from what has been taken from config.
 """
 
-import glob
+from hashlib import sha1
 import os
+import re
 import subprocess
 import sys
+import threading
 import click
-from stakkr import file_utils
-from stakkr.configreader import Config
+from stakkr import file_utils, profiler
+from stakkr.configreader import get_session
+from stakkr.services_index import get_services_index
+
+# Bump it when the way the compose file is rendered changes
+__render_version__ = 1
+# The images pull and compose can both need the rendered file, at the same time
+__render_lock__ = threading.Lock()
+# Sections used by stakkr only: not given to compose (a change doesn't render the compose file again)
+__stakkr_sections__ = ('aliases', 'compose', 'exec', 'pull', 'wait', 'watch')
 
 
 @click.command(help="Wrapper for docker-compose",
                context_settings=dict(ignore_unknown_options=True))
 @click.option('--config-file', '-c', help="Set stakkr config file location (default stakkr.yml)")
+@click.option('--profile', is_flag=True, envvar='STAKKR_PROFILE',
+              help="Time each phase, save it into .stakkr/timings.jsonl (or set STAKKR_PROFILE=1)")
 @click.argument('command', nargs=-1, type=click.UNPROCESSED)
-def cli(config_file: str = None, command: tuple = ()):
+def cli(config_file: str = None, command: tuple = (), profile: bool = False):
     """Command line entry point."""
-    config, config_file = _get_config(config_file)
+    if profile is True:
+        profiler.start_profile('stakkr-compose ' + ' '.join(command[:1]))
+
+    with profiler.phase('config'):
+        config, config_file = _get_config(config_file)
 
     # Set main config and services as env variables
     _set_env_from_config(config)
@@ -30,84 +46,162 @@ def cli(config_file: str = None, command: tuple = ()):
     _set_env_for_proxy(config['proxy'])
 
     # set the base command
-    base_cmd = _get_base_command(config)
+    with profiler.phase('render'):
+        base_cmd = _get_base_command(config)
 
     msg = click.style('[VERBOSE] ', fg='green')
     msg += 'Compose command: ' + ' '.join(base_cmd + list(command))
     click.echo(msg, err=True)
-    subprocess.call(base_cmd + list(command))
+    with profiler.phase('docker-compose'):
+        subprocess.call(base_cmd + list(command))
 
+    profile = profiler.stop_profile()
+    if profile is not None:
+        profile.display()
+        profile.save(config['project_dir'])
 
-def _add_local_services(project_dir: str, available_services: list):
-    """Get services in the virtualenv services/ directory, so specific to that stakkr."""
-    services_dir = project_dir + '/services/*/docker-compose'
-    for service_dir in glob.glob(services_dir):
-        conf_files = _get_services_from_dir(service_dir)
-        for conf_file in conf_files:
-            available_services[conf_file[:-4]] = service_dir + '/' + conf_file
 
-    return available_services
+def get_available_services(project_dir: str):
+    """Get services bundled with stakkr and the ones of the packs installed in services/ (from the index)."""
+    return get_services_index(project_dir).get_services()
 
 
-def get_available_services(project_dir: str):
-    """Get standard services bundled with stakkr."""
-    services_dir = file_utils.get_dir('static') + '/services/'
-    conf_files = _get_services_from_dir(services_dir)
+def _get_base_command(config: dict):
+    """Build the docker-compose file to be run as a command, from the rendered file if possible."""
+    rendered_file = get_rendered_compose_file(config)
+    compose_files = get_compose_files(config) if rendered_file is None else [rendered_file]
 
-    services = dict()
-    for conf_file in conf_files:
-        services[conf_file[:-4]] = services_dir + conf_file
+    return _get_compose_command(config, compose_files)
 
-    services = _add_local_services(project_dir, services)
 
-    return services
+def _get_compose_command(config: dict, compose_files: list):
+    cmd = ['docker-compose']
+    for compose_file in compose_files:
+        cmd.append('-f')
+        cmd.append(compose_file)
 
+    return cmd + ['-p', config['project_name']]
 
-def _get_base_command(config: dict):
-    """Build the docker-compose file to be run as a command."""
+
+def get_compose_files(config: dict):
+    """Main compose file, then the files of the enabled services."""
     main_file = 'docker-compose.yml'
     # Set the network subnet ?
     if config['subnet'] != '':
         main_file = 'docker-compose.subnet.yml'
-    cmd = ['docker-compose', '-f', file_utils.get_file('static', main_file)]
 
     # What to load
     activated_services = _get_enabled_services_files(
         config['project_dir'],
         [svc for svc, opts in config['services'].items() if opts['enabled'] is True])
-    # Create the command
-    services = []
-    for service in activated_services:
-        services.append('-f')
-        services.append(service)
 
-    return cmd + services + ['-p', config['project_name']]
+    return [file_utils.get_file('static', main_file)] + activated_services
+
+
+def get_environment(config: dict):
+    """Environment variables used in the services yaml, built from the config."""
+    environment = _get_env_from_config(config)
+    environment.update(_get_env_for_proxy(config['proxy']))
+
+    return environment
+
+
+def get_rendered_compose_file(config: dict):
+    """
+    Merge and interpolate the compose files (with docker-compose config) into
+    .stakkr/docker-compose.yml. It's rendered again only when the config,
+    a compose file (or one it extends), an env_file or a variable they use changes.
+
+    Return None if it can't be rendered, the compose files have to be used directly.
+    """
+    compose_files = get_compose_files(config)
+    environment = get_environment(config)
+    with __render_lock__:
+        return _render_compose_file(config, compose_files, environment)
+
+
+def _render_compose_file(config: dict, compose_files: list, environment: dict):
+    try:
+        rendered_file = file_utils.get_stakkr_dir(config['project_dir']) + '/docker-compose.yml'
+        header = '# Rendered by stakkr-compose, key: {}\n'.format(_get_render_key(compose_files, environment))
+        if _read_first_line(rendered_file) == header:
+            return rendered_file
+
+        result = subprocess.run(
+            _get_compose_command(config, compose_files) + ['config'], env=dict(os.environ, **environment),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            return None
+
+        file_utils.write_file(rendered_file, header + result.stdout.decode())
+    except OSError:
+        return None
+
+    return rendered_file
+
+
+class ComposeProject:
+    """
+    Drive docker-compose from its python API, in the stakkr process.
+
+    It uses the config already read, and gives the environment to compose
+    in memory, instead of running stakkr-compose then docker-compose.
+    """
+
+    def __init__(self, config: dict):
+        """Load the compose project of the enabled services."""
+        from compose.cli.command import get_project
+        from compose.config.environment import Environment
+
+        rendered_file = get_rendered_compose_file(config)
+        self.files = get_compose_files(config) if rendered_file is None else [rendered_file]
+        environment = Environment(os.environ.copy())
+        environment.update(get_environment(config))
+        self.project = get_project(
+            os.path.dirname(self.files[0]), config_path=self.files,
+            project_name=config['project_name'], environment=environment)
+
+    def pull(self, services: list = None, verbose: bool = False):
+        """Pull images (of services, or all)."""
+        self.project.pull(service_names=services or None, silent=verbose is False)
+
+    def up(self, services: list = None, recreate: bool = False):
+        """Same as docker-compose up -d --remove-orphans with --force-recreate or --no-recreate."""
+        from compose.service import ConvergenceStrategy
+
+        strategy = ConvergenceStrategy.always if recreate is True else ConvergenceStrategy.never
+        self.project.up(service_names=services or None, detached=True, strategy=strategy, remove_orphans=True)
+
+    def stop(self, services: list = None):
+        """Stop containers (of services, or all)."""
+        self.project.stop(service_names=services or None)
 
 
 def _get_config(config_file: str):
     """Read main stakkr.yml file."""
-    config_reader = Config(config_file)
-    config = config_reader.read()
+    session = get_session(config_file)
+    config = session.get_config()
 
     if config is False:
-        config_reader.display_errors()
+        session.reader.display_errors()
         sys.exit(1)
 
-    return config, config_reader.config_file
+    return config, session.config_file
 
 
 def _get_enabled_services_files(project_dir: str, configured_services: list):
-    """Compile all available services : standard and local install."""
-    available_services = get_available_services(project_dir)
+    """Get the compose files of the enabled services : standard and local install."""
+    services_index = get_services_index(project_dir)
 
     services_files = []
     for service in configured_services:
-        if service not in available_services:
+        service_file = services_index.get_service_file(service)
+        if service_file is None:
             msg = 'Error: service "{}" has no configuration file. '.format(service)
             msg += 'Check your config'
             click.secho(msg, fg='red')
             sys.exit(1)
-        services_files.append(available_services[service])
+        services_files.append(service_file)
 
     return services_files
 
@@ -119,11 +213,75 @@ def _get_gid(gid: int):
     return '1000' if os.name == 'nt' else str(os.getgid())
 
 
-def _get_services_from_dir(services_dir: str):
-    if os.path.isdir(services_dir) is False:
-        return []
+def _read_first_line(filename: str):
+    try:
+        with open(filename, 'r') as stream:
+            return stream.readline()
+    except OSError:
+        return None
+
 
-    return [service for service in os.listdir(services_dir) if service.endswith('.yml')]
+def _get_render_key(compose_files: list, environment: dict):
+    """
+    Hash of the environment from the config, the compose files (and the ones
+    they extend), the env_file they read and the other variables they use.
+    """
+    key = sha1('{}:{}'.format(__render_version__, sorted(environment.items())).encode())
+    variables = set()
+    # Paths are relative to the first compose file, and to an extended file in what it declares
+    files = [(compose_file, os.path.dirname(compose_files[0])) for compose_file in compose_files]
+    env_files = set()
+    for compose_file, base_dir in files:
+        with open(compose_file, 'rb') as stream:
+            content = stream.read()
+        key.update('{}:{}:'.format(compose_file, len(content)).encode())
+        key.update(content)
+        variables.update(re.findall(r'\$\{?([A-Za-z_][A-Za-z0-9_]*)', content.decode(errors='replace')))
+
+        extended, read = _get_included_files(content, base_dir, dict(os.environ, **environment))
+        known = [filename for filename, _ in files]
+        files += [(filename, os.path.dirname(filename)) for filename in extended if filename not in known]
+        env_files.update(read)
+
+    for env_file in sorted(env_files):
+        with open(env_file, 'rb') as stream:
+            key.update('{}:'.format(env_file).encode() + stream.read())
+
+    for variable in sorted(variables - set(environment)):
+        key.update('{}={}:'.format(variable, os.environ.get(variable)).encode())
+
+    return key.hexdigest()
+
+
+def _get_included_files(content: bytes, base_dir: str, variables: dict):
+    """Compose files extended by the services of a compose file and their env_file, with the variables replaced."""
+    if b'extends' not in content and b'env_file' not in content:
+        return [], []
+
+    from yaml import YAMLError, load
+    from stakkr.configreader import Loader
+
+    try:
+        services = load(content, Loader=Loader).get('services') or {}
+    except (AttributeError, YAMLError):
+        return [], []
+
+    extended, env_files = [], []
+    for service in services.values():
+        extends = service.get('extends') if isinstance(service, dict) else None
+        if isinstance(extends, dict) and 'file' in extends:
+            extended.append(extends['file'])
+        env_file = service.get('env_file', []) if isinstance(service, dict) else []
+        for entry in [env_file] if isinstance(env_file, (str, dict)) else env_file:
+            env_files.append(entry.get('path') if isinstance(entry, dict) else entry)
+
+    def _path(value: str):
+        value = re.sub(r'\$\{([A-Za-z_][A-Za-z0-9_]*)(?::?-([^}]*))?\}|\$([A-Za-z_][A-Za-z0-9_]*)',
+                       lambda match: variables.get(match.group(1) or match.group(3)) or match.group(2) or '', value)
+
+        return os.path.normpath(os.path.join(base_dir, os.path.expanduser(value)))
+
+    return [_path(str(path)) for path in extended], [_path(str(path)) for path in env_files if path]
 
 
 def _get_uid(uid: int):
@@ -133,37 +291,50 @@ def _get_uid(uid: int):
     return '1000' if os.name == 'nt' else str(os.getuid())
 
 
-def _set_env_for_proxy(config: dict):
-    """Define environment variables to be used in services yaml."""
-    os.environ['PROXY_ENABLED'] = str(config['enabled'])
-    os.environ['PROXY_DOMAIN'] = str(config['domain'])
+def _get_env_for_proxy(config: dict):
+    return {'PROXY_ENABLED': str(config['enabled']), 'PROXY_DOMAIN': str(config['domain'])}
 
 
-def _set_env_for_services(services: dict):
+def _get_env_for_services(services: dict):
+    environment = dict()
     for service, params in services.items():
         if params['enabled'] is False:
             continue
 
         for param, value in params.items():
             env_var = 'DOCKER_{}_{}'.format(service, param).upper()
-            os.environ[env_var] = str(value)
+            environment[env_var] = str(value)
 
+    return environment
 
-def _set_env_from_config(config: dict):
-    """Define environment variables to be used in services yaml."""
-    os.environ['COMPOSE_BASE_DIR'] = config['project_dir']
-    os.environ['COMPOSE_PROJECT_NAME'] = config['project_name']
+
+def _get_env_from_config(config: dict):
+    environment = {'COMPOSE_BASE_DIR': config['project_dir'], 'COMPOSE_PROJECT_NAME': config['project_name']}
     for parameter, value in config.items():
         if parameter == 'services':
-            _set_env_for_services(value)
+            environment.update(_get_env_for_services(value))
+            continue
+        if parameter in __stakkr_sections__:
             continue
 
-        os.environ['DOCKER_{}'.format(parameter.upper())] = str(value)
+        environment['DOCKER_{}'.format(parameter.upper())] = str(value)
 
     # Do that at the end, else the value in config will overwrite the possible
     # default value
-    os.environ['DOCKER_UID'] = _get_uid(config['uid'])
-    os.environ['DOCKER_GID'] = _get_gid(config['gid'])
+    environment['DOCKER_UID'] = _get_uid(config['uid'])
+    environment['DOCKER_GID'] = _get_gid(config['gid'])
+
+    return environment
+
+
+def _set_env_for_proxy(config: dict):
+    """Define environment variables to be used in services yaml."""
+    os.environ.update(_get_env_for_proxy(config))
+
+
+def _set_env_from_config(config: dict):
+    """Define environment variables to be used in services yaml."""
+    os.environ.update(_get_env_from_config(config))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,352 @@
+# coding: utf-8
+"""
+Watch the files of a project and run aliases when they change (stakkr watch).
+
+Triggers (watch.triggers in stakkr.yml) map globs, relative to the project
+dir, to an alias. Changes come from inotify (through ctypes, Linux only) or
+from a scan of the files every second. Events are coalesced: an alias runs
+once the files stopped changing for watch.debounce seconds, with all the
+files changed meanwhile. Paths ignored by git are skipped, and an alias never
+runs twice at the same time: changes received while it runs make it run
+again once, after.
+"""
+
+import os
+import re
+import threading
+from time import perf_counter
+from click import echo, style
+
+# Never watched
+__excluded__ = ('.git', '.stakkr')
+
+
+class Trigger:
+    """Globs of files (** for any directories) that run an alias."""
+
+    def __init__(self, alias: str, paths: list):
+        """Paths are globs relative to the project dir."""
+        self.alias = alias
+        self.paths = paths
+        self.regex = re.compile('|'.join('(?:{})'.format(_glob_to_regex(path)) for path in paths))
+
+    def matches(self, path: str):
+        """True if the path (relative to the project dir) matches one of the globs."""
+        return self.regex.fullmatch(path) is not None
+
+
+class Watcher:
+    """Wait for changes, coalesce them and run the aliases of the triggers matched."""
+
+    def __init__(self, project_dir: str, triggers: list, run_alias, debounce: float = 0.3, poll: bool = False):
+        """run_alias(alias) runs an alias and returns its exit code. poll to scan the files instead of inotify."""
+        self.project_dir = project_dir
+        self.triggers = triggers
+        self.run_alias = run_alias
+        self.debounce = debounce
+        self.roots = get_roots(project_dir, [path for trigger in triggers for path in trigger.paths])
+        ignored_dirs = get_ignored_dirs(project_dir)
+        self.source = None if poll is True else _get_inotify(project_dir, self.roots, ignored_dirs)
+        self.source = self.source or _Polling(project_dir, self.roots, ignored_dirs)
+        self.running = set()
+        self.queued = dict()
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def run(self, stop: threading.Event = None):
+        """Watch until stop is set (forever by default), then wait for the aliases running."""
+        stop = threading.Event() if stop is None else stop
+        pending = set()
+        last_change = perf_counter()
+        try:
+            while stop.is_set() is False:
+                paths = self.source.read(self.debounce if pending else 1)
+                if paths:
+                    pending |= paths
+                    last_change = perf_counter()
+                if pending and perf_counter() - last_change >= self.debounce:
+                    self.dispatch(pending)
+                    pending = set()
+        finally:
+            self.source.close()
+            self.wait()
+
+    def wait(self):
+        """Wait for the aliases running, and the runs queued after them."""
+        while True:
+            with self.lock:
+                threads = list(self.threads)
+            if not threads:
+                return
+            for thread in threads:
+                thread.join()
+
+    def dispatch(self, paths: set):
+        """Run the aliases whose globs match some paths (not ignored by git)."""
+        paths = sorted(path for path in paths if path.split('/')[0] not in __excluded__)
+        matches = {trigger.alias: [] for trigger in self.triggers}
+        for trigger in self.triggers:
+            matches[trigger.alias] += [path for path in paths if path == '*' or trigger.matches(path)]
+        ignored = get_ignored(self.project_dir, {path for changed in matches.values() for path in changed} - {'*'})
+
+        for alias, changed in matches.items():
+            changed = [path for path in changed if path not in ignored]
+            if changed:
+                self._start(alias, changed)
+
+    def _start(self, alias: str, paths: list):
+        with self.lock:
+            if alias in self.running:
+                # Once more after the run in progress, with all the files changed meanwhile
+                self.queued.setdefault(alias, []).extend(paths)
+                return
+
+            self.running.add(alias)
+            thread = threading.Thread(target=self._run, args=(alias, paths), daemon=True)
+            self.threads.append(thread)
+        thread.start()
+
+    def _run(self, alias: str, paths: list):
+        files = 'files changed' if paths != ['*'] else 'too many changes to know which ones'
+        echo(style('[WATCH]', fg='green') + ' {} ({} {}{})'.format(
+            alias, len(set(paths)) if paths != ['*'] else '', files, ': ' + paths[0] if len(paths) == 1 else ''))
+        start = perf_counter()
+        try:
+            exit_code = self.run_alias(alias)
+        except Exception as error:
+            echo(style('[ERROR]', fg='red') + ' {}: {}'.format(alias, error), err=True)
+        else:
+            result = style('[DONE]', fg='green') if exit_code == 0 else style('[FAILED]', fg='red')
+            echo(result + ' {} in {:.2f}s (exit code {})'.format(alias, perf_counter() - start, exit_code))
+
+        with self.lock:
+            self.running.discard(alias)
+            self.threads.remove(threading.current_thread())
+            paths = self.queued.pop(alias, None)
+        if paths is not None:
+            self._start(alias, paths)
+
+
+def get_triggers(config: dict, aliases: dict):
+    """Triggers of watch.triggers, raise a ValueError if an alias doesn't exist."""
+    triggers = []
+    for trigger in config.get('watch', {}).get('triggers', []):
+        if not isinstance(aliases.get(trigger['alias']), dict):
+            raise ValueError('watch: the alias "{}" does not exist'.format(trigger['alias']))
+        triggers.append(Trigger(trigger['alias'], trigger['paths']))
+
+    return triggers
+
+
+def get_roots(project_dir: str, globs: list):
+    """Directories to watch (recursively): the longest one without wildcard of each glob, that exists."""
+    roots = set()
+    for glob in globs:
+        fixed = []
+        # The last part is the name of the files
+        for part in glob.split('/')[:-1]:
+            if re.search(r'[*?[]', part):
+                break
+            fixed.append(part)
+
+        root = '/'.join(fixed)
+        while root and os.path.isdir(os.path.join(project_dir, root)) is False:
+            root = os.path.dirname(root)
+        roots.add(root)
+
+    # A root in another root is already watched
+    return sorted(root for root in roots if not any(
+        other != root and (other == '' or root.startswith(other + '/')) for other in roots))
+
+
+def get_ignored(project_dir: str, paths: set):
+    """Paths ignored by git (git check-ignore), none if it's not a git repository."""
+    import subprocess
+
+    if not paths:
+        return set()
+
+    try:
+        result = subprocess.run(['git', 'check-ignore', '--stdin', '-z'], cwd=project_dir, stdout=subprocess.PIPE,
+                                input=''.join(path + '\0' for path in paths).encode(), stderr=subprocess.DEVNULL)
+    except OSError:
+        return set()
+
+    return set(result.stdout.decode().split('\0')) - {''}
+
+
+def get_ignored_dirs(project_dir: str):
+    """Directories ignored by git (vendor/, node_modules/ ...), with a / at the end."""
+    import subprocess
+
+    try:
+        result = subprocess.run(['git', 'ls-files', '--others', '--ignored', '--exclude-standard', '--directory', '-z'],
+                                cwd=project_dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError:
+        return set()
+
+    return {path for path in result.stdout.decode().split('\0') if path.endswith('/')}
+
+
+def _glob_to_regex(glob: str):
+    """* and ? don't match /, **/ matches any directories."""
+    regex = ''
+    for part in re.split(r'(\*\*/|\*\*|\*|\?)', glob):
+        regex += {'**/': '(?:.*/)?', '**': '.*', '*': '[^/]*', '?': '[^/]'}.get(part, re.escape(part))
+
+    return regex
+
+
+def _walk(project_dir: str, roots: list, ignored_dirs: set):
+    """Directories and their files (relative to the project dir) under the roots, without the ignored directories."""
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(os.path.join(project_dir, root)):
+            relative = os.path.relpath(dirpath, project_dir)
+            relative = '' if relative == '.' else relative + '/'
+            dirnames[:] = [dirname for dirname in dirnames
+                           if dirname not in __excluded__ and relative + dirname + '/' not in ignored_dirs]
+            yield relative.rstrip('/'), [relative + filename for filename in filenames]
+
+
+def _get_inotify(project_dir: str, roots: list, ignored_dirs: set):
+    """An inotify watch, None if it's not available (not Linux, too many directories)."""
+    try:
+        return _Inotify(project_dir, roots, ignored_dirs)
+    except (AttributeError, OSError) as error:
+        echo(style('[WATCH]', fg='yellow') + ' inotify is not available ({}), files are scanned'.format(error))
+        return None
+
+
+class _Inotify:
+    """inotify through ctypes: a watch for each directory under the roots."""
+
+    # IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    MASK = 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+
+    def __init__(self, project_dir: str, roots: list, ignored_dirs: set):
+        import ctypes
+        import ctypes.util
+
+        self.project_dir = project_dir
+        self.ignored_dirs = ignored_dirs
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+        self.dirs = dict()
+        try:
+            for root in roots:
+                self._add_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def read(self, timeout: float):
+        """Paths changed (relative to the project dir), waiting at most timeout seconds. * if events were lost."""
+        import select
+        import struct
+
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return changed
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, size = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + size].rstrip(b'\0').decode(errors='replace')
+            offset += 16 + size
+            if mask & self.IN_Q_OVERFLOW:
+                changed.add('*')
+                continue
+            if mask & self.IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            if wd not in self.dirs:
+                continue
+
+            path = '/'.join(filter(None, (self.dirs[wd], name)))
+            changed.add(path)
+            if mask & self.IN_ISDIR and mask & (0x80 | 0x100) and self._is_watched(path):
+                # A new directory: watch it, what it has is new too
+                changed |= self._add_tree(path)
+
+        return changed
+
+    def close(self):
+        """Remove all the watches."""
+        os.close(self.fd)
+
+    def _is_watched(self, directory: str):
+        if os.path.basename(directory) in __excluded__:
+            return False
+
+        if get_ignored(self.project_dir, {directory}):
+            self.ignored_dirs.add(directory + '/')
+            return False
+
+        return True
+
+    def _add_tree(self, root: str):
+        files = set()
+        for directory, filenames in _walk(self.project_dir, [root], self.ignored_dirs):
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.path.join(self.project_dir, directory).encode(), self.MASK | 0x01000000)
+            if wd < 0:
+                import ctypes
+
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch: ' + os.strerror(ctypes.get_errno()))
+            self.dirs[wd] = directory
+            files |= set(filenames)
+
+        return files
+
+
+class _Polling:
+    """Scan the files under the roots, compare their modification times and sizes."""
+
+    def __init__(self, project_dir: str, roots: list, ignored_dirs: set, interval: float = 1):
+        self.project_dir = project_dir
+        self.roots = roots
+        self.ignored_dirs = ignored_dirs
+        self.interval = interval
+        self.files = self._scan()
+        self.last_scan = perf_counter()
+
+    def read(self, timeout: float):
+        """Paths changed since the last scan, scanning again at most every interval seconds."""
+        from time import sleep
+
+        sleep(max(min(timeout, self.last_scan + self.interval - perf_counter()), 0))
+        if perf_counter() - self.last_scan < self.interval:
+            return set()
+
+        files = self._scan()
+        self.last_scan = perf_counter()
+        changed = {path for path in set(files) | set(self.files) if files.get(path) != self.files.get(path)}
+        self.files = files
+
+        return changed
+
+    def close(self):
+        """Nothing to release."""
+
+    def _scan(self):
+        files = dict()
+        for _, filenames in _walk(self.project_dir, self.roots, self.ignored_dirs):
+            for filename in filenames:
+                try:
+                    stats = os.stat(os.path.join(self.project_dir, filename))
+                except OSError:
+                    continue
+                files[filename] = (stats.st_mtime_ns, stats.st_size)
+
+        return files
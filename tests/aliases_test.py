@@ -0,0 +1,161 @@
+import io
+import os
+import sys
+import threading
+import time
+import unittest
+from stakkr.aliases import PrefixedOutput, RunCache, get_steps, run_steps
+from tests.temp_files import make_temp_dir, write_file
+
+base_dir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, base_dir + '/../')
+
+
+# https://docs.python.org/3/library/unittest.html#assert-methods
+class AliasesTest(unittest.TestCase):
+    def test_steps_sequential(self):
+        steps = get_steps('test', {'exec': [
+            {'container': 'php', 'args': ['php', '-v']},
+            {'container': 'redis', 'args': ['redis-cli', 'flushall']}]})
+        self.assertEqual(['1', '2'], [step['id'] for step in steps])
+        self.assertEqual([[], ['1']], [step['depends_on'] for step in steps])
+        self.assertEqual('redis', steps[1]['container'])
+
+    def test_steps_parallel(self):
+        steps = get_steps('test', {'parallel': True, 'exec': [
+            {'id': 'php', 'container': 'php', 'args': ['true']},
+            {'id': 'redis', 'container': 'redis', 'args': ['true']},
+            {'id': 'varnish', 'container': 'varnish', 'args': ['true'], 'depends_on': ['php']}]})
+        self.assertEqual([[], [], ['php']], [step['depends_on'] for step in steps])
+
+    def test_steps_invalid(self):
+        with self.assertRaisesRegex(ValueError, 'Alias test: step "php" depends on unknown steps: apache'):
+            get_steps('test', {'parallel': True, 'exec': [
+                {'id': 'php', 'container': 'php', 'args': ['true'], 'depends_on': ['apache']}]})
+
+        with self.assertRaisesRegex(ValueError, 'Alias test: the id "php" is used by several steps'):
+            get_steps('test', {'parallel': True, 'exec': [
+                {'id': 'php', 'container': 'php', 'args': ['true']},
+                {'id': 'php', 'container': 'php', 'args': ['false']}]})
+
+        # Without parallel, steps run in order: depends_on would be ignored
+        with self.assertRaisesRegex(ValueError, 'Alias test: "id" and "depends_on" need "parallel: true"'):
+            get_steps('test', {'exec': [
+                {'container': 'php', 'args': ['true']},
+                {'container': 'php', 'args': ['true'], 'depends_on': [1]}]})
+
+        with self.assertRaisesRegex(ValueError, 'Alias test: steps wait for each other: a, b'):
+            get_steps('test', {'parallel': True, 'exec': [
+                {'id': 'a', 'container': 'php', 'args': ['true'], 'depends_on': ['b']},
+                {'id': 'b', 'container': 'php', 'args': ['true'], 'depends_on': ['a']},
+                {'id': 'c', 'container': 'php', 'args': ['true']}]})
+
+    def test_run_steps_concurrently(self):
+        steps = get_steps('test', {'parallel': True, 'exec': [
+            {'id': 'a', 'container': 'php', 'args': [0.2]},
+            {'id': 'b', 'container': 'php', 'args': [0.2]},
+            {'id': 'c', 'container': 'php', 'args': [0], 'depends_on': ['a', 'b']}]})
+        ends = dict()
+
+        def _run(step):
+            time.sleep(step['args'][0])
+            ends[step['id']] = time.perf_counter()
+            return 0
+
+        start = time.perf_counter()
+        self.assertEqual({'a': 0, 'b': 0, 'c': 0}, run_steps(steps, _run))
+        self.assertLess(time.perf_counter() - start, 0.35)
+        self.assertGreaterEqual(ends['c'], max(ends['a'], ends['b']))
+
+    def test_run_steps_failure(self):
+        steps = get_steps('test', {'exec': [
+            {'container': 'php', 'args': [0]},
+            {'container': 'php', 'args': [2]},
+            {'container': 'php', 'args': [0]}]})
+
+        self.assertEqual({'1': 0, '2': 2, '3': None}, run_steps(steps, lambda step: step['args'][0]))
+
+    def test_prefixed_output(self):
+        stream = io.StringIO()
+        lock = threading.Lock()
+        out, err = PrefixedOutput('[a] ', stream, lock), PrefixedOutput('[b] ', stream, lock)
+        out.write(b'one\ntw')
+        err.write(b'error\n')
+        out.write(b'o\nthree')
+        out.close()
+        err.close()
+
+        self.assertEqual('[a] one\n[b] error\n[a] two\n[a] three\n', stream.getvalue())
+
+    def test_run_cache(self):
+        project_dir = make_temp_dir(self)
+        os.makedirs(project_dir + '/www/vendor')
+        write_file(project_dir + '/www/composer.lock', 'v1')
+        conf = {'inputs': ['www/*.lock'], 'outputs': ['www/vendor'],
+                'exec': [{'container': 'php', 'args': ['composer', 'install']}]}
+
+        # No output yet
+        RunCache(project_dir, 'composer', conf).save()
+        self.assertFalse(RunCache(project_dir, 'composer', conf).is_up_to_date())
+
+        write_file(project_dir + '/www/vendor/autoload.php', '<?php')
+        RunCache(project_dir, 'composer', conf).save()
+        self.assertTrue(RunCache(project_dir, 'composer', conf).is_up_to_date())
+        # Other arguments, or other commands
+        self.assertFalse(RunCache(project_dir, 'composer', conf, ('--no-dev',)).is_up_to_date())
+        self.assertFalse(RunCache(project_dir, 'composer', dict(conf, exec=[
+            {'container': 'php', 'args': ['composer', 'update']}])).is_up_to_date())
+
+        # Same size, other content
+        write_file(project_dir + '/www/composer.lock', 'v2')
+        self.assertFalse(RunCache(project_dir, 'composer', conf).is_up_to_date())
+        RunCache(project_dir, 'composer', conf).save()
+        self.assertTrue(RunCache(project_dir, 'composer', conf).is_up_to_date())
+
+        os.remove(project_dir + '/www/vendor/autoload.php')
+        self.assertFalse(RunCache(project_dir, 'composer', conf).is_up_to_date())
+
+    def test_run_cache_missing_inputs(self):
+        """An alias whose inputs are missing runs again"""
+        project_dir = make_temp_dir(self)
+        write_file(project_dir + '/package.json', '{}')
+        conf = {'inputs': ['package.json'], 'exec': [{'container': 'node', 'args': ['npm', 'install']}]}
+        RunCache(project_dir, 'npm', conf).save()
+        self.assertTrue(RunCache(project_dir, 'npm', conf).is_up_to_date())
+
+        os.remove(project_dir + '/package.json')
+        self.assertFalse(RunCache(project_dir, 'npm', conf).is_up_to_date())
+        RunCache(project_dir, 'npm', conf).save()
+        self.assertFalse(RunCache(project_dir, 'npm', conf).is_up_to_date())
+        self.assertNotIn('npm', RunCache(project_dir, 'npm', conf).runs)
+
+    def test_run_cache_concurrent_saves(self):
+        """Aliases ending at the same time (stakkr watch) don't lose the runs of the others"""
+        project_dir = make_temp_dir(self)
+        os.makedirs(project_dir + '/www/vendor')
+        write_file(project_dir + '/www/composer.lock', 'v1')
+        write_file(project_dir + '/www/vendor/autoload.php', '<?php')
+        confs = {'alias{}'.format(num): {'inputs': ['www/*.lock'], 'outputs': ['www/vendor'],
+                                         'exec': [{'container': 'php', 'args': ['true', num]}]} for num in range(10)}
+        # All read before any save
+        caches = [RunCache(project_dir, alias, conf) for alias, conf in confs.items()]
+        threads = [threading.Thread(target=cache.save) for cache in caches]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for alias, conf in confs.items():
+            self.assertTrue(RunCache(project_dir, alias, conf).is_up_to_date(), alias)
+
+    def test_run_cache_without_inputs(self):
+        project_dir = make_temp_dir(self)
+        conf = {'exec': [{'container': 'php', 'args': ['true']}]}
+        RunCache(project_dir, 'test', conf).save()
+
+        self.assertFalse(RunCache(project_dir, 'test', conf).is_up_to_date())
+        self.assertFalse(os.path.exists(project_dir + '/.stakkr'))
+
+
+if __name__ == "__main__":
+    unittest.main()
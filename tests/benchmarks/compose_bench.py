@@ -0,0 +1,62 @@
+"""
+Benchmark stakkr start / stop, end to end, with both compose engines:
+in-process (compose.engine: api) and stakkr-compose + docker-compose (cli).
+
+It needs docker and the images of tests/static/stakkr.yml (pulled by a first
+start). Run it with:
+    python -m tests.benchmarks.compose_bench
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+base_dir = os.path.abspath(os.path.dirname(__file__) + '/..')
+ROUNDS = 3
+
+
+def bench(engine: str, rounds: int = ROUNDS):
+    """Return the best times of start and stop for an engine."""
+    config_file = _write_config(engine)
+    try:
+        _stakkr(config_file, 'stop')
+        timings = {'start': [], 'stop': []}
+        for _ in range(rounds):
+            for action in ('start', 'stop'):
+                timings[action].append(_stakkr(config_file, action, '--no-proxy'))
+    finally:
+        os.remove(config_file)
+
+    return {action: min(action_timings) for action, action_timings in timings.items()}
+
+
+def main():
+    """Print the timings of both engines."""
+    for engine in ('cli', 'api'):
+        timings = bench(engine)
+        print('compose.engine: {} | start: {:.2f}s | stop: {:.2f}s'.format(engine, timings['start'], timings['stop']))
+
+
+def _stakkr(config_file: str, *args):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-m', 'stakkr.cli', '-c', config_file] + list(args),
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    return time.perf_counter() - start
+
+
+def _write_config(engine: str):
+    """Same config as the tests, in the same directory (same project), with an engine."""
+    with open(base_dir + '/static/stakkr.yml') as stream:
+        config = stream.read()
+
+    config_file = base_dir + '/static/stakkr.compose_bench.yml'
+    with open(config_file, 'w') as stream:
+        stream.write(config + '\ncompose:\n  engine: {}\n'.format(engine))
+
+    return config_file
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+Benchmark stakkr commands end to end, against the fake docker daemon of
+tests/fake_docker.py, with 1, 10 and 100 containers.
+
+Each command runs as the user would run it (a new stakkr process), in a
+project with a pack of N services, all started. The daemon answers with a
+fixed latency per call, so we measure how stakkr scales, not docker.
+status runs also with the daemon (stakkr daemon) started: it answers from
+memory. start / stop need docker-compose (python API or binary), they are skipped
+without it. Results are appended to .stakkr/e2e_bench.jsonl (or the file
+given as argument). Run it with:
+    python -m tests.benchmarks.e2e_bench [results_file]
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from importlib.util import find_spec
+from platform import node, python_version
+from tempfile import mkdtemp
+from tests.fake_docker import FakeDockerServer
+from tests.temp_files import write_file
+
+base_dir = os.path.abspath(os.path.dirname(__file__) + '/../..')
+CONTAINERS = (1, 10, 100)
+# A round-trip to the docker socket, with a daemon having some work to do
+LATENCY = 0.002
+ROUNDS = 3
+
+
+def bench(num_containers: int, latency: float = LATENCY, rounds: int = ROUNDS):
+    """Return the best time and the number of API calls of each command, None if it can't run."""
+    project_dir = _write_project(num_containers)
+    results = {}
+    try:
+        with FakeDockerServer('bench', num_containers, latency) as server:
+            env = dict(os.environ, DOCKER_HOST=server.base_url, STAKKR_DAEMON='0',
+                       PYTHONPATH=base_dir + os.pathsep + os.environ.get('PYTHONPATH', ''))
+            config_file = project_dir + '/stakkr.yml'
+            # Warm the caches (config, services index, rendered compose file) like a second run
+            _stakkr(config_file, env, 'status')
+
+            commands = {
+                'status': ['status'],
+                'exec': ['exec', '--no-tty', 'service0', 'true'],
+                'services': ['services']}
+            for command, args in commands.items():
+                results[command] = _bench_command(server, config_file, env, args, rounds)
+
+            socket_path = os.path.dirname(project_dir) + '/daemon.sock'
+            daemon_env = dict(env, STAKKR_DAEMON='1', STAKKR_DAEMON_SOCKET=socket_path)
+            daemon = _start_daemon(daemon_env)
+            try:
+                # The daemon reads the config and lists the containers on the first command
+                _stakkr(config_file, daemon_env, 'status')
+                results['status_daemon'] = _bench_command(server, config_file, daemon_env, ['status'], rounds)
+            finally:
+                daemon.terminate()
+                daemon.wait()
+
+            results['stop'] = results['start'] = None
+            if _compose_available() is True:
+                for command in ('stop', 'start') * rounds:
+                    timing = _bench_command(server, config_file, env, [command, '--no-proxy'], 1)
+                    if results[command] is None or timing['seconds'] < results[command]['seconds']:
+                        results[command] = timing
+    finally:
+        shutil.rmtree(os.path.dirname(project_dir))
+
+    return results
+
+
+def main():
+    """Print the results and save them."""
+    results_file = sys.argv[1] if len(sys.argv) > 1 else base_dir + '/.stakkr/e2e_bench.jsonl'
+    record = {'date': int(time.time()), 'host': node(), 'python': python_version(), 'latency': LATENCY,
+              'results': {}}
+
+    print('stakkr commands, {:.0f} ms per API call (best of {})'.format(LATENCY * 1000, ROUNDS))
+    for num_containers in CONTAINERS:
+        results = bench(num_containers)
+        record['results'][num_containers] = results
+        print('  {} containers:'.format(num_containers))
+        for command, result in results.items():
+            if result is None:
+                print('    - {}: skipped (needs docker-compose)'.format(command.ljust(13)))
+                continue
+
+            print('    - {}: {:.1f} ms ({} API calls)'.format(
+                command.ljust(13), result['seconds'] * 1000, result['api_calls']))
+
+    os.makedirs(os.path.dirname(results_file), exist_ok=True)
+    with open(results_file, 'a') as stream:
+        stream.write(json.dumps(record) + '\n')
+    print('Results appended to ' + results_file)
+
+
+def _bench_command(server: FakeDockerServer, config_file: str, env: dict, args: list, rounds: int):
+    timings = []
+    for _ in range(rounds):
+        calls = sum(server.calls.values())
+        timing = _stakkr(config_file, env, *args)
+        timings.append((timing, sum(server.calls.values()) - calls))
+
+    best, api_calls = min(timings)
+
+    return {'seconds': best, 'api_calls': api_calls}
+
+
+def _compose_available():
+    return find_spec('compose') is not None or shutil.which('docker-compose') is not None
+
+
+def _start_daemon(env: dict):
+    daemon = subprocess.Popen([sys.executable, '-m', 'stakkr.cli', 'daemon'], env=env,
+                              stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.perf_counter() + 10
+    while os.path.exists(env['STAKKR_DAEMON_SOCKET']) is False:
+        if daemon.poll() is not None or time.perf_counter() > deadline:
+            daemon.kill()
+            raise RuntimeError("stakkr daemon didn't start")
+        time.sleep(0.01)
+
+    return daemon
+
+
+def _stakkr(config_file: str, env: dict, *args):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-m', 'stakkr.cli', '-c', config_file] + list(args), env=env,
+                            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    timing = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError('stakkr {} failed: {}'.format(' '.join(args), result.stderr.decode()[-500:]))
+
+    return timing
+
+
+def _write_project(num_containers: int):
+    """A project "bench" with a pack of N services, all enabled, and no proxy."""
+    project_dir = mkdtemp() + '/bench'
+    pack_dir = project_dir + '/services/bench'
+    os.makedirs(pack_dir + '/docker-compose')
+    services = ['service{}'.format(num) for num in range(num_containers)]
+
+    schema = {'properties': {'services': {'properties': {service: {'type': 'object'} for service in services}}}}
+    defaults = {'services': {service: {
+        'enabled': True, 'version': 'latest', 'ram': '64M',
+        'service_name': service, 'service_url': 'http://{}'} for service in services}}
+    write_file(pack_dir + '/config_schema.yml', json.dumps(schema))
+    write_file(pack_dir + '/config_default.yml', json.dumps(defaults))
+    for service in services:
+        write_file('{}/docker-compose/{}.yml'.format(pack_dir, service), json.dumps({
+            'version': '2.2', 'services': {service: {
+                'image': 'edyan/php:7.2', 'container_name': '${COMPOSE_PROJECT_NAME}_' + service,
+                'networks': ['stakkr'],
+                'labels': ['traefik.frontend.rule=Host:{}.${{COMPOSE_PROJECT_NAME}}.localhost'.format(service)]}}}))
+    write_file(project_dir + '/stakkr.yml', 'proxy:\n  enabled: false\n')
+
+    return project_dir
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""
+Benchmark the containers listing used by stakkr status, with 50 containers.
+
+The Docker API is simulated with a fixed latency per call, so we measure what
+stakkr does, not how fast the daemon is. Run it with:
+    python -m tests.benchmarks.status_bench
+"""
+
+import time
+from unittest import mock
+from stakkr import docker_actions
+from tests.fake_docker import FakeApiClient
+
+NUM_CONTAINERS = 50
+# A round-trip to the docker socket, with a daemon having some work to do
+LATENCY = 0.005
+
+
+def bench(sparse: bool, rounds: int = 5):
+    """Return the best time and the number of API calls of get_running_containers."""
+    timings = []
+    for _ in range(rounds):
+        client = FakeApiClient(NUM_CONTAINERS, LATENCY, sparse)
+        with mock.patch.object(docker_actions, 'get_api_client', return_value=client):
+            start = time.perf_counter()
+            num, _ = docker_actions.get_running_containers('bench')
+            timings.append(time.perf_counter() - start)
+        assert num == NUM_CONTAINERS
+
+    return min(timings), client.calls
+
+
+def main():
+    """Display results."""
+    print('stakkr status with {} containers, {:.0f} ms per API call'.format(NUM_CONTAINERS, LATENCY * 1000))
+    for title, sparse in [('From the list', False), ('List + inspect (fallback)', True)]:
+        timing, calls = bench(sparse)
+        print('  - {}: {:.1f} ms ({} API calls)'.format(title.ljust(26), timing * 1000, calls))
+    print('  - {}: {:.1f} ms ({} API calls)'.format(
+        'Serial inspects (estimate)'.ljust(26), LATENCY * (NUM_CONTAINERS + 1) * 1000, NUM_CONTAINERS + 1))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Count what a stakkr command costs: docker API calls (by endpoint, as the fake
+daemon of tests/fake_docker.py receives them) and processes spawned.
+
+    with CallBudget(server) as budget:
+        budget.run('-c', config, 'status')
+        budget.assert_budget(api_calls=2, processes=0)
+
+Each run is like a new stakkr process: new docker clients (so the API version
+is asked again), a new registry of containers and no daemon. Commands run
+in-process with click's runner.
+"""
+
+import os
+import subprocess
+from collections import Counter
+from unittest import mock
+from click.testing import CliRunner
+from stakkr import docker_actions
+
+
+class CallBudget:
+    """Run stakkr commands against a fake docker daemon, count their API calls and processes."""
+
+    def __init__(self, server):
+        """server is a started FakeDockerServer."""
+        self.server = server
+        self.api_calls = Counter()
+        self.processes = []
+        self.patches = []
+        self.cwd = None
+
+    def __enter__(self):
+        self.cwd = os.getcwd()
+        self.patches = [
+            mock.patch.dict(os.environ, DOCKER_HOST=self.server.base_url, STAKKR_DAEMON='0'),
+            mock.patch.object(subprocess, 'Popen', side_effect=self._popen)]
+        for patch in self.patches:
+            patch.start()
+
+        return self
+
+    def __exit__(self, *args):
+        for patch in reversed(self.patches):
+            patch.stop()
+        # Commands go to the project directory
+        os.chdir(self.cwd)
+
+    def run(self, *args, input=None):
+        """Run a stakkr command, count only what it does. Return the result of the click runner."""
+        from stakkr.cli import stakkr
+
+        calls_before = Counter(self.server.calls)
+        self.processes = []
+        with mock.patch.dict(docker_actions.__clients__, clear=True), \
+                mock.patch.object(docker_actions, '__registry__', docker_actions.ContainerRegistry()):
+            result = CliRunner().invoke(stakkr, list(args), obj={}, input=input)
+        self.api_calls = Counter(self.server.calls)
+        self.api_calls.subtract(calls_before)
+        self.api_calls = +self.api_calls
+
+        return result
+
+    def assert_budget(self, api_calls: int, processes: int = 0):
+        """Raise an AssertionError if the last command made more API calls or spawned more processes."""
+        total = sum(self.api_calls.values())
+        if total > api_calls:
+            raise AssertionError('{} API calls, budget is {}: {}'.format(total, api_calls, dict(self.api_calls)))
+
+        if len(self.processes) > processes:
+            raise AssertionError('{} processes spawned, budget is {}: {}'.format(
+                len(self.processes), processes, self.processes))
+
+    def _popen(self, args, *popen_args, **kwargs):
+        self.processes.append(args)
+
+        return _Popen(args, *popen_args, **kwargs)
+
+
+_Popen = subprocess.Popen
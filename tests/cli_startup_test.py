@@ -0,0 +1,81 @@
+"""Make sure the CLI starts fast: no heavy import before a command needs it"""
+
+import os
+import subprocess
+import sys
+import unittest
+
+base_dir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, base_dir + '/../')
+
+# Modules that must only be loaded by the commands that need them
+HEAVY_MODULES = ['clint', 'docker', 'git', 'jsonschema', 'requests']
+
+
+# https://docs.python.org/3/library/unittest.html#assert-methods
+class CliStartupTest(unittest.TestCase):
+    def test_import_cli_is_light(self):
+        modules = _imported_modules(['-c', 'import stakkr.cli'])
+        for heavy in HEAVY_MODULES:
+            self.assertNotIn(heavy, modules)
+
+    def test_help_with_aliases_is_light(self):
+        config = base_dir + '/static/config_aliases.yml'
+        res, modules = _run_cli(['-c', config, '--help'])
+        self.assertEqual(0, res.returncode)
+        self.assertRegex(res.stdout.decode(), r'.*phpver\s+Get the current php version.*')
+        for heavy in HEAVY_MODULES:
+            self.assertNotIn(heavy, modules)
+
+    def test_alias_help_is_light(self):
+        config = base_dir + '/static/config_aliases.yml'
+        res, modules = _run_cli(['-c', config, 'phptest', '--help'])
+        self.assertEqual(0, res.returncode)
+        self.assertRegex(res.stdout.decode(), r'.*Do a test.*')
+        for heavy in HEAVY_MODULES:
+            self.assertNotIn(heavy, modules)
+
+    def test_unknown_command(self):
+        config = base_dir + '/static/config_aliases.yml'
+        res, _ = _run_cli(['-c', config, 'hello-world'])
+        self.assertEqual(2, res.returncode)
+        self.assertRegex(res.stderr.decode(), r"Error: No such command ['\"]+hello-world['\"]+.")
+
+    def test_heavy_modules_not_loaded(self):
+        """Whatever imports them, they are not in sys.modules, nor yaml (needed only to read a config)"""
+        code = 'import sys, stakkr.cli; print(" ".join(sys.modules))'
+        res = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        modules = {module.split('.')[0] for module in res.stdout.decode().split()}
+        self.assertEqual([], [heavy for heavy in HEAVY_MODULES + ['yaml'] if heavy in modules])
+
+
+def _imported_modules(args: list):
+    """Return the top level packages imported by a python command."""
+    res = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + args,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    return _top_level_modules(res.stderr.decode())
+
+
+def _run_cli(args: list):
+    res = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-m', 'stakkr.cli'] + args,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    return res, _top_level_modules(res.stderr.decode())
+
+
+def _top_level_modules(importtime_output: str):
+    modules = set()
+    for line in importtime_output.splitlines():
+        if not line.startswith('import time:') or line.endswith('package'):
+            continue
+
+        modules.add(line.split('|')[-1].strip().split('.')[0])
+
+    return modules
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,6 +2,7 @@ import io
 import os
 import re
 import sys
+import threading
 import unittest
 
 from contextlib import redirect_stdout
@@ -178,6 +179,41 @@ class CommandTest(unittest.TestCase):
         res = f.getvalue()
         self.assertEqual('', res)
 
+    def test_command_exit_code(self):
+        f = io.StringIO()
+        with redirect_stdout(f):
+            self.assertEqual(0, launch_cmd_displays_output(self.cmd_ok, False, False))
+            self.assertEqual(3, launch_cmd_displays_output(['sh', '-c', 'exit 3'], False, False))
+
+    def test_command_stress_both_streams(self):
+        # TODO make it work under windows
+        if os.name == 'nt':
+            return
+
+        # 4 MB on each stream, interleaved: waiting for stdout to end before reading stderr would block
+        script = (
+            'import sys\n'
+            'line = "x" * 1023 + "\\n"\n'
+            'for num in range(4096):\n'
+            '    sys.stdout.write(line)\n'
+            '    sys.stderr.write("error {} ".format(num) + line)\n')
+        f = io.StringIO()
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            launch_cmd_displays_output([sys.executable, '-c', script], False, True)))
+        with redirect_stdout(f):
+            thread.start()
+            thread.join(60)
+        self.assertFalse(thread.is_alive(), 'The command blocked')
+        self.assertEqual([0], results)
+
+        res = f.getvalue()
+        self.assertEqual('.' * 4096 + '\n', res[:4097])
+        self.assertIn('error 0 x', res)
+        self.assertIn('... and more (4091 lines), the last ones:', res)
+        self.assertIn('error 4095 x', res)
+        self.assertNotIn('error 4090 x', res)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,150 @@
+import os
+import sys
+import unittest
+from unittest import mock
+from stakkr.actions import StakkrActions
+from tests.call_budget import CallBudget
+from tests.fake_docker import FakeDockerServer
+
+base_dir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, base_dir + '/../')
+
+# Docker API calls allowed per command, docker-compose excluded (see setUp).
+# Each run asks the API version once: new process, new client.
+BUDGETS = {
+    # version, containers list
+    'status': 2,
+    # version, containers list, exec create / start / inspect
+    'exec': 5,
+    # same as exec: the shell is found with the exec
+    'console': 5,
+    # version, containers list: the command goes through the session already started
+    'exec_session': 2,
+    # version, containers list (for all steps), then per step: exec create / start / inspect
+    'alias': 8,
+    # same, 3 steps
+    'alias_parallel': 11,
+    # inputs didn't change: nothing to run
+    'alias_cached': 0,
+    # no docker at all
+    'services': 0,
+    # version, containers list, an inspect per service (healthcheck)
+    'wait': 6,
+    # version, containers list x2, proxy inspect
+    'stop': 4,
+    # version, containers list x3, inspect x3, image inspect x2 and pull (proxy), create, start, network x3
+    'start': 15,
+    # stop + start
+    'restart': 18,
+    # version, containers list x2
+    'stop_no_proxy': 3,
+    # version, containers list x3
+    'start_no_proxy': 4}
+
+
+# https://docs.python.org/3/library/unittest.html#assert-methods
+class CommandsBudgetTest(unittest.TestCase):
+    """Docker API calls and processes of each command, against the fake docker daemon"""
+
+    def setUp(self):
+        self.config = base_dir + '/static/config_budget.yml'
+        self.server = FakeDockerServer('static').start()
+        network = self.server.add_network('static_stakkr', '192.168.1.0/24')
+        for service in ('php', 'maildev'):
+            self.server.add_container(service, network=network)['State']['Health'] = {'Status': 'healthy'}
+        self.server.exec_handler = lambda container, config, stdin: (b'/bin/sh\n', b'', 0)
+
+        # docker-compose (its own client) is out of the budget: it only starts / stops the containers
+        self.patches = [
+            mock.patch.object(StakkrActions, '_compose_up', lambda *args: self._set_running(True)),
+            mock.patch.object(StakkrActions, '_get_compose_project', lambda *args: mock.Mock(
+                stop=lambda services: self._set_running(False)))]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.server.stop()
+
+    def test_status(self):
+        self._assert_budget(BUDGETS['status'], 'status')
+
+    def test_exec(self):
+        self._assert_budget(BUDGETS['exec'], 'exec', '--no-tty', 'php', 'php', '-v')
+
+    def test_exec_session(self):
+        from stakkr.exec_session import close_sessions
+
+        self.server.shell = ['sh']
+        self.addCleanup(close_sessions, base_dir + '/static')
+        args = ('exec', '--engine', 'session', '--no-tty', 'php', 'echo', 'hello')
+        with CallBudget(self.server) as budget:
+            # Starts the session (the fake container runs a local sh too)
+            self.assertEqual('hello\n', budget.run('-c', self.config, *args).output)
+            self.assertIn('stakkr.exec_session', budget.processes[0])
+
+        self.assertEqual('hello\n', self._assert_budget(BUDGETS['exec_session'], *args))
+
+    def test_console(self):
+        self._assert_budget(BUDGETS['console'], 'console', '--no-tty', 'php')
+
+    def test_alias(self):
+        self._assert_budget(BUDGETS['alias'], 'phpver', '--no-tty')
+
+    def test_alias_parallel(self):
+        output = self._assert_budget(BUDGETS['alias_parallel'], 'clear')
+        lines = output.splitlines()
+        self.assertEqual(3, len(lines), output)
+        # The step "after" waits for the two others
+        self.assertEqual('[after  ] /bin/sh', lines[-1])
+        self.assertIn('[php    ] /bin/sh', lines)
+        self.assertIn('[maildev] /bin/sh', lines)
+
+    def test_alias_cached(self):
+        self._assert_budget(BUDGETS['alias'] - 3, 'build', '--force', '--no-tty')
+        output = self._assert_budget(BUDGETS['alias_cached'], 'build', '--no-tty')
+        self.assertIn("build: inputs didn't change", output)
+
+    def test_services(self):
+        self._assert_budget(BUDGETS['services'], 'services')
+
+    def test_wait(self):
+        self._assert_budget(BUDGETS['wait'], 'wait')
+
+    def test_stop_start(self):
+        self._assert_budget(BUDGETS['stop'], 'stop')
+        self._assert_budget(BUDGETS['start'], 'start')
+        self._assert_budget(BUDGETS['restart'], 'restart')
+
+    def test_stop_start_no_proxy(self):
+        self._assert_budget(BUDGETS['stop_no_proxy'], 'stop', '--no-proxy')
+        self._assert_budget(BUDGETS['start_no_proxy'], 'start', '--no-proxy')
+
+    def test_start_failed(self):
+        """The proxy started with the services is stopped if they don't start"""
+        from stakkr import docker_actions
+
+        self._assert_budget(BUDGETS['stop'], 'stop')
+        with mock.patch.object(StakkrActions, '_compose_up', side_effect=SystemError('compose failed')), \
+                CallBudget(self.server) as budget:
+            result = budget.run('-c', self.config, 'start')
+            self.assertNotEqual(0, result.exit_code)
+            self.assertFalse(docker_actions.container_running('proxy_stakkr'))
+
+    def _assert_budget(self, api_calls: int, *args):
+        with CallBudget(self.server) as budget:
+            result = budget.run('-c', self.config, *args)
+            self.assertEqual(0, result.exit_code, result.output)
+            budget.assert_budget(api_calls=api_calls, processes=0)
+
+        return result.output
+
+    def _set_running(self, running: bool):
+        for container in self.server.containers.values():
+            if container['Name'].startswith('/static_'):
+                self.server._set_running(container, running)
+
+
+if __name__ == "__main__":
+    unittest.main()
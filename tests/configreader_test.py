@@ -4,8 +4,11 @@ import os
 import re
 import sys
 import unittest
+from shutil import rmtree
+from unittest import mock
 import pytest
-from stakkr.configreader import Config
+from stakkr.configreader import Config, Validator, get_session
+from tests.temp_files import make_temp_dir, write_file
 base_dir = os.path.abspath(os.path.dirname(__file__))
 sys.path.insert(0, base_dir + '/../')
 
@@ -79,6 +82,220 @@ class ConfigReaderTest(unittest.TestCase):
         self.assertTrue('project_name' in config)
         self.assertEqual('testnet', config['project_name'])
 
+    def test_cached_config(self):
+        """Second read must come from the cache, without parsing YAML"""
+        project_dir = _create_project(self)
+        config = Config(project_dir + '/stakkr.yml').read()
+        self.assertTrue(os.path.isfile(project_dir + '/.stakkr/cache/config.json'))
+
+        with mock.patch('stakkr.configreader.load', side_effect=AssertionError('YAML parsed')):
+            self.assertEqual(config, Config(project_dir + '/stakkr.yml').read())
+
+    def test_cache_invalidated(self):
+        """Changing a file or adding / removing a services pack invalidates the cache"""
+        project_dir = _create_project(self)
+        config = _read_in_new_process(project_dir + '/stakkr.yml')
+        self.assertEqual(['php'], sorted(config['services'].keys() - {'portainer'}))
+
+        _create_pack(project_dir, 'extra', 'redis')
+        config = _read_in_new_process(project_dir + '/stakkr.yml')
+        # No service enabled from that pack, it's not loaded
+        self.assertEqual(['php'], sorted(config['services'].keys() - {'portainer'}))
+
+        write_file(project_dir + '/stakkr.yml', 'services: {redis: {enabled: true}}')
+        config = _read_in_new_process(project_dir + '/stakkr.yml')
+        self.assertEqual(['redis'], sorted(config['services'].keys() - {'portainer'}))
+        self.assertTrue(config['services']['redis']['enabled'])
+
+        write_file(project_dir + '/stakkr.yml', 'services: {php: {enabled: true}}')
+        rmtree(project_dir + '/services/extra')
+        config = _read_in_new_process(project_dir + '/stakkr.yml')
+        self.assertEqual(['php'], sorted(config['services'].keys() - {'portainer'}))
+
+    def test_only_enabled_packs_are_loaded(self):
+        """Disabled services of packs not loaded are not validated, but still available"""
+        from stakkr.stakkr_compose import get_available_services
+
+        project_dir = _create_project(self)
+        _create_pack(project_dir, 'extra', 'redis')
+        write_file(project_dir + '/stakkr.yml', 'services: {php: {enabled: true}, redis: {enabled: false, port: 1}}')
+        reader = Config(project_dir + '/stakkr.yml')
+        config = reader.read()
+        self.assertEqual('', reader.error)
+        self.assertEqual(['php'], sorted(config['services'].keys() - {'portainer'}))
+        self.assertNotIn(project_dir + '/services/extra/config_schema.yml', reader.spec_files)
+        self.assertIn('redis', get_available_services(project_dir))
+
+        # A service that no pack provides is still an error
+        write_file(project_dir + '/stakkr.yml', 'services: {php: {enabled: true}, mongo: {enabled: false}}')
+        self.assertFalse(Config(project_dir + '/stakkr.yml').read())
+
+    def test_ready_in_packs(self):
+        """Services of packs accept the ready probe of stakkr's schema, and it's validated"""
+        project_dir = _create_project(self)
+        write_file(project_dir + '/stakkr.yml', 'services: {php: {enabled: true, ready: {probe: tcp, port: 9000}}}')
+        config = Config(project_dir + '/stakkr.yml').read()
+        self.assertEqual({'probe': 'tcp', 'port': 9000}, config['services']['php']['ready'])
+
+        write_file(project_dir + '/stakkr.yml', 'services: {php: {enabled: true, ready: {probe: ping}}}')
+        reader = Config(project_dir + '/stakkr.yml')
+        self.assertFalse(reader.read())
+        self.assertRegex(reader.error, r"'ping' is not one of .* \(services -> php -> ready -> probe\)")
+
+    def test_validator_error_path(self):
+        """Errors in a service section keep the full path"""
+        validator = Validator(_get_schema())
+        error, sections = validator.validate({'services': {'php': {'enabled': 'yes'}}, 'proxy': {}})
+        self.assertIsNone(sections)
+        self.assertEqual("'yes' is not of type 'boolean' (services -> php -> enabled)", error)
+
+        error, _ = validator.validate({'services': {'toto': {}}})
+        self.assertEqual("Additional properties are not allowed ('toto' was unexpected) (services)", error)
+
+        error, _ = validator.validate({'toto': {}})
+        self.assertRegex(error, r"Additional properties are not allowed \('toto' was unexpected\) \(\)")
+
+    def test_validator_skips_valid_sections(self):
+        """Only changed sections are validated again"""
+        validator = Validator(_get_schema())
+        config = {'services': {'php': {'enabled': True}, 'maildev': {'enabled': False}}, 'proxy': {}}
+        error, sections = validator.validate(config)
+        self.assertIsNone(error)
+        self.assertEqual({'services', 'services.php', 'services.maildev', 'proxy'}, set(sections.keys()))
+
+        config['services']['php']['enabled'] = False
+        get_error = Validator._get_error
+        with mock.patch.object(Validator, '_get_error', autospec=True, side_effect=get_error) as mocked:
+            error, _ = validator.validate(config, sections)
+        self.assertIsNone(error)
+        validated = [call[0][1] for call in mocked.call_args_list]
+        # root keys, services keys and php only
+        self.assertEqual([config, config['services'], config['services']['php']], validated)
+
+    def test_validator_unhashable_sections(self):
+        """A section that can't be hashed is validated each time and never cached"""
+        validator = Validator(_get_schema())
+        config = {'services': {'php': {'enabled': True}}, 'proxy': {}}
+        get_error = Validator._get_error
+        with mock.patch('stakkr.configreader._hash_data', return_value=None), \
+                mock.patch.object(Validator, '_get_error', autospec=True, side_effect=get_error) as mocked:
+            error, sections = validator.validate(config, {'services.php': None, 'proxy': None})
+        self.assertIsNone(error)
+        self.assertEqual({}, sections)
+        validated = [call[0][1] for call in mocked.call_args_list]
+        self.assertIn(config['services']['php'], validated)
+        self.assertIn(config['proxy'], validated)
+
+    def test_read_skips_valid_sections(self):
+        """A second process (new validator) reuses the validation of previous reads"""
+        project_dir = _create_project(self)
+        Config(project_dir + '/stakkr.yml').read()
+        self.assertTrue(os.path.isfile(project_dir + '/.stakkr/cache/validation.json'))
+
+        write_file(project_dir + '/stakkr.yml', 'services: {php: {enabled: true}}\nsubnet: 192.168.1.0/24')
+        with mock.patch('stakkr.configreader.__validators__', {}), \
+                mock.patch.object(Validator, '_get_error', return_value=None) as mocked:
+            config = Config(project_dir + '/stakkr.yml').read()
+        self.assertEqual('192.168.1.0/24', config['subnet'])
+        # Keys of the config, then subnet
+        self.assertEqual(2, mocked.call_count)
+
+    def test_session(self):
+        """A session resolves the config once for the whole process"""
+        project_dir = _create_project(self)
+        with mock.patch.dict('stakkr.configreader.__sessions__', clear=True):
+            session = get_session(project_dir + '/stakkr.yml')
+            self.assertIs(session, get_session(project_dir + '/stakkr.yml'))
+            self.assertEqual(project_dir, session.project_dir)
+            self.assertEqual({'services': {'php': {'enabled': True}}}, session.get_user_config())
+            config = session.get_config()
+            self.assertIs(config, session.get_config())
+            self.assertEqual(7.2, config['services']['php']['version'])
+
+    def test_session_opens_files_once(self):
+        """Running a command opens each YAML file only once, with a cold or a warm cache"""
+        from stakkr.actions import StakkrActions
+        from tests.call_budget import CallBudget
+        from tests.fake_docker import FakeDockerServer
+
+        project_dir = _create_project(self)
+        project_name = os.path.basename(project_dir)
+        server = FakeDockerServer(project_name).start()
+        self.addCleanup(server.stop)
+        server.add_container('php', network=server.add_network(project_name.lower() + '_stakkr'), running=False)
+        start_services = mock.patch.object(StakkrActions, '_compose_up', lambda *args: [
+            server._set_running(container, True) for container in server.containers.values()])
+        commands = (['services'], ['start', '--no-proxy'], ['status'])
+        for command, cache in [(command, cache) for command in commands for cache in ('cold', 'warm')]:
+            if cache == 'cold':
+                rmtree(project_dir + '/.stakkr/cache', ignore_errors=True)
+            opened = []
+            real_open = open
+
+            def _open(file, *args, **kwargs):
+                if str(file).endswith('.yml'):
+                    opened.append(file)
+                return real_open(file, *args, **kwargs)
+
+            with CallBudget(server) as budget, start_services, \
+                    mock.patch.dict('stakkr.configreader.__sessions__', clear=True), \
+                    mock.patch('builtins.open', side_effect=_open):
+                result = budget.run('-c', project_dir + '/stakkr.yml', *command)
+
+            self.assertEqual(0, result.exit_code, result.output)
+            self.assertIn(project_dir + '/stakkr.yml', opened, (command, cache))
+            self.assertEqual(len(opened), len(set(opened)), (command, cache, opened))
+            if command == ['services']:
+                self.assertRegex(result.output, r'.*php \(.*7\.2.*\).*')
+        # status listed the container started by start
+        self.assertTrue(all(container['State']['Running'] for container in server.containers.values()))
+        self.assertEqual(1, budget.api_calls['containers_list'])
+
+
+def _get_schema():
+    """Simple schema with some services and a proxy"""
+    return {
+        '$schema': 'http://json-schema.org/draft-04/schema#',
+        'type': 'object',
+        'additionalProperties': False,
+        'properties': {
+            'services': {
+                'type': 'object',
+                'additionalProperties': False,
+                'properties': {
+                    'php': {'type': 'object', 'properties': {'enabled': {'type': 'boolean'}}},
+                    'maildev': {'type': 'object', 'properties': {'enabled': {'type': 'boolean'}}}}},
+            'proxy': {'type': 'object'}}}
+
+
+def _read_in_new_process(config_file: str):
+    """The index of services is checked once per process: like a new command, it's loaded again."""
+    with mock.patch.dict('stakkr.services_index.__indexes__', clear=True):
+        return Config(config_file).read()
+
+
+def _create_project(test: unittest.TestCase):
+    """Create a project with a minimal config and a services pack, removed at the end of the test"""
+    project_dir = make_temp_dir(test)
+    os.makedirs(project_dir + '/services/test/docker-compose')
+    write_file(project_dir + '/stakkr.yml', 'services: {php: {enabled: true}}')
+    write_file(project_dir + '/services/test/docker-compose/php.yml', 'services: {php: {image: edyan/php}}')
+    write_file(project_dir + '/services/test/config_default.yml', 'services: {php: {enabled: false, version: 7.2}}')
+    write_file(project_dir + '/services/test/config_schema.yml',
+               'properties: {services: {properties: {php: {type: object}}}}')
+
+    return project_dir
+
+
+def _create_pack(project_dir: str, pack: str, service: str):
+    """Add a services pack providing a single service, disabled by default"""
+    os.makedirs('{}/services/{}/docker-compose'.format(project_dir, pack))
+    write_file('{}/services/{}/docker-compose/{}.yml'.format(project_dir, pack, service), 'services: {}')
+    write_file('{}/services/{}/config_default.yml'.format(project_dir, pack),
+               'services: {%s: {enabled: false}}' % service)
+    write_file('{}/services/{}/config_schema.yml'.format(project_dir, pack),
+               'properties: {services: {properties: {%s: {type: object}}}}' % service)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,171 @@
+import os
+import shutil
+import sys
+import threading
+import time
+import unittest
+from tempfile import mkdtemp
+from unittest import mock
+from stakkr import docker_actions
+from stakkr.actions import StakkrActions
+from stakkr.daemon import Daemon, DaemonClient, get_daemon_client, get_socket_path
+from tests.fake_docker import FakeApiClient
+
+base_dir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, base_dir + '/../')
+
+
+# https://docs.python.org/3/library/unittest.html#assert-methods
+class DaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.project_dir = mkdtemp()
+        self.config_file = self.project_dir + '/stakkr.yml'
+        with open(self.config_file, 'w') as stream:
+            stream.write('project_name: bench\nservices: {}\n')
+
+        self.client = FakeApiClient(3, 0)
+        self.patcher = mock.patch.object(docker_actions, 'get_api_client', return_value=self.client)
+        self.patcher.start()
+
+        self.socket_path = self.project_dir + '/daemon.sock'
+        self.daemon = Daemon(self.socket_path, watch_events=False)
+        self.thread = threading.Thread(target=self.daemon.serve, daemon=True)
+        self.thread.start()
+        while os.path.exists(self.socket_path) is False:
+            time.sleep(0.01)
+
+    def tearDown(self):
+        DaemonClient(self.socket_path).query('stop')
+        self.thread.join(5)
+        self.patcher.stop()
+        shutil.rmtree(self.project_dir)
+
+    def test_ping(self):
+        data = DaemonClient(self.socket_path).query('ping')
+        self.assertEqual(os.getpid(), data['pid'])
+        self.assertEqual([], data['projects'])
+
+    def test_config_and_containers(self):
+        """Containers are listed once, then answered from memory"""
+        client = DaemonClient(self.socket_path)
+        config = client.query('config', config=self.config_file)
+        self.assertEqual('bench', config['project_name'])
+        self.assertEqual(1, self.client.calls)
+
+        containers = client.query('containers', config=self.config_file)
+        self.assertEqual(3, containers['running'])
+        self.assertEqual('service1', containers['containers'][1]['compose_name'])
+
+        ct_info = client.query('container', config=self.config_file, service='service2')
+        self.assertEqual('bench_service2', ct_info['name'])
+        self.assertIsNone(client.query('container', config=self.config_file, service='mysql'))
+        self.assertEqual(1, self.client.calls)
+
+    def test_config_read_again_if_changed(self):
+        """The config is read again only when one of its files changes"""
+        client = DaemonClient(self.socket_path)
+        self.assertIsNone(client.query('config', config=self.config_file)['uid'])
+        with mock.patch('stakkr.configreader.Config.read') as read:
+            client.query('containers', config=self.config_file)
+        read.assert_not_called()
+
+        with open(self.config_file, 'w') as stream:
+            stream.write('project_name: bench\nservices: {}\nuid: 1001\n')
+        self.assertEqual(1001, client.query('config', config=self.config_file)['uid'])
+        # Same project: containers are not listed again
+        self.assertEqual(1, self.client.calls)
+
+    def test_errors(self):
+        client = DaemonClient(self.socket_path)
+        with self.assertRaisesRegex(RuntimeError, 'Unknown action'):
+            client.query('hello')
+
+        with open(self.config_file, 'w') as stream:
+            stream.write('project_name: [bench]\n')
+        with self.assertRaisesRegex(RuntimeError, 'is not of type'):
+            client.query('config', config=self.config_file)
+
+    def test_handle_event(self):
+        """A container that dies is removed, without listing all containers again"""
+        client = DaemonClient(self.socket_path)
+        client.query('config', config=self.config_file)
+
+        ct_id = self.client.cts[1]['list']['Id']
+        self.client.cts[1]['inspect']['State']['Running'] = False
+        event = {'Type': 'container', 'Action': 'die', 'id': ct_id,
+                 'Actor': {'Attributes': {'com.docker.compose.project': 'bench'}}}
+        self.daemon.handle_event(dict(event, Action='exec_start'))
+        self.daemon.handle_event(dict(event, Actor={'Attributes': {'com.docker.compose.project': 'other'}}))
+        self.assertEqual(1, self.client.calls)
+
+        self.daemon.handle_event(event)
+        self.assertEqual(2, self.client.calls)
+        containers = client.query('containers', config=self.config_file)
+        self.assertEqual(2, containers['running'])
+        self.assertIsNone(client.query('container', config=self.config_file, service='service1'))
+
+    def test_actions_use_daemon(self):
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+        with mock.patch.dict(os.environ, {'STAKKR_DAEMON_SOCKET': self.socket_path}):
+            stakkr = StakkrActions({'CONFIG': self.config_file, 'VERBOSE': False, 'DEBUG': False})
+            with mock.patch('stakkr.configreader.Session.get_config') as get_config:
+                running, cts = stakkr.get_running_containers()
+            get_config.assert_not_called()
+
+        self.assertIsNotNone(stakkr.daemon)
+        self.assertEqual(3, running)
+        self.assertEqual('service0', cts['bench_service0']['compose_name'])
+        self.assertEqual('bench_service2', stakkr.get_container('service2')['name'])
+        self.assertEqual(1, self.client.calls)
+
+
+class DaemonClientTest(unittest.TestCase):
+    def test_no_daemon(self):
+        socket_path = mkdtemp() + '/daemon.sock'
+        with mock.patch.dict(os.environ, {'STAKKR_DAEMON_SOCKET': socket_path}):
+            self.assertIsNone(get_daemon_client())
+
+        with open(socket_path, 'w'):
+            pass
+        with mock.patch.dict(os.environ, {'STAKKR_DAEMON_SOCKET': socket_path, 'STAKKR_DAEMON': '0'}):
+            self.assertIsNone(get_daemon_client())
+
+        with self.assertRaises(ConnectionError):
+            DaemonClient(socket_path).query('ping')
+
+        shutil.rmtree(os.path.dirname(socket_path))
+
+    def test_untrusted_socket(self):
+        import socket
+
+        socket_dir = mkdtemp()
+        self.addCleanup(shutil.rmtree, socket_dir)
+        socket_path = socket_dir + '/daemon.sock'
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(socket_path)
+            sock.listen(1)
+            with mock.patch.dict(os.environ, {'STAKKR_DAEMON_SOCKET': socket_path}):
+                self.assertIsNotNone(get_daemon_client())
+                # Other users can write in the directory (like /tmp)
+                os.chmod(socket_dir, 0o777)
+                self.assertIsNone(get_daemon_client())
+                with self.assertRaises(ConnectionError):
+                    DaemonClient(socket_path).query('ping')
+
+                # Created by another user
+                os.chmod(socket_dir, 0o700)
+                with mock.patch('os.getuid', return_value=os.stat(socket_path).st_uid + 1):
+                    self.assertIsNone(get_daemon_client())
+
+    def test_socket_path(self):
+        with mock.patch.dict(os.environ, {'XDG_RUNTIME_DIR': '/run/user/1000'}):
+            os.environ.pop('STAKKR_DAEMON_SOCKET', None)
+            self.assertEqual('/run/user/1000/stakkr-{}.sock'.format(os.getuid()), get_socket_path())
+            # Never in /tmp, where anybody could create it first
+            del os.environ['XDG_RUNTIME_DIR']
+            self.assertEqual(os.path.expanduser('~/.stakkr/daemon.sock'), get_socket_path())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,7 +3,9 @@ import subprocess
 import sys
 from docker.errors import NotFound
 import unittest
+from unittest import mock
 from stakkr import docker_actions
+from tests.fake_docker import FakeApiClient
 
 
 base_dir = os.path.abspath(os.path.dirname(__file__))
@@ -124,6 +126,117 @@ class DockerActionsTest(unittest.TestCase):
     def test_get_container_info_not_exists(self):
         self.assertIs(None, docker_actions._extract_container_info('not_exists', 'not_exists'))
 
+    def test_get_running_containers_from_list(self):
+        """Containers info are built from the list, with a single API call"""
+        client = FakeApiClient(3, 0)
+        with mock.patch.object(docker_actions, 'get_api_client', return_value=client):
+            numcts, cts = docker_actions.get_running_containers('bench')
+
+        self.assertEqual(1, client.calls)
+        self.assertEqual(3, numcts)
+        self.assertEqual({
+            'id': '{:064x}'.format(1), 'name': 'bench_service1', 'compose_name': 'service1',
+            'ports': ['8001'], 'image': 'edyan/php:7.2', 'image_id': 'sha256:php72',
+            'traefik_host': 'service1.bench.localhost',
+            'ip': '192.168.1.3', 'running': True}, cts['bench_service1'])
+
+    def test_get_running_containers_inspect_missing(self):
+        """Containers with missing fields in the list are inspected"""
+        client = FakeApiClient(3, 0)
+        with mock.patch.object(docker_actions, 'get_api_client', return_value=client):
+            _, from_list = docker_actions.get_running_containers('bench')
+
+        client = FakeApiClient(3, 0, sparse=True)
+        with mock.patch.object(docker_actions, 'get_api_client', return_value=client):
+            numcts, inspected = docker_actions.get_running_containers('bench')
+
+        self.assertEqual(4, client.calls)
+        self.assertEqual(3, numcts)
+        self.assertEqual(from_list, inspected)
+
+    def test_get_service_container(self):
+        """A single container is resolved from its compose labels, in one call"""
+        client = FakeApiClient(10, 0)
+        with mock.patch.object(docker_actions, 'get_api_client', return_value=client):
+            ct_info = docker_actions.get_service_container('Bench', 'service3')
+            self.assertEqual(1, client.calls)
+            self.assertEqual('bench_service3', ct_info['name'])
+            self.assertEqual('bench_service3', docker_actions.get_ct_name('service3'))
+
+            self.assertIsNone(docker_actions.get_service_container('bench', 'mysql'))
+            self.assertIsNone(docker_actions.get_service_container('other', 'service3'))
+
+    def test_registry(self):
+        """Containers are indexed by compose name, name and id, snapshots don't change"""
+        registry = docker_actions.ContainerRegistry()
+        client = FakeApiClient(3, 0)
+        with mock.patch.object(docker_actions, 'get_api_client', return_value=client):
+            numcts, snapshot = registry.refresh('bench')
+        self.assertEqual(3, numcts)
+
+        ct_info = registry.get(compose_name='service1')
+        self.assertIs(ct_info, registry.get(name='bench_service1'))
+        self.assertIs(ct_info, registry.get(ct_id='{:064x}'.format(1)))
+        self.assertEqual('192.168.1.3', ct_info.ip)
+        self.assertEqual('192.168.1.3', ct_info['ip'])
+        self.assertTrue('compose_name' in ct_info)
+        with self.assertRaises(AttributeError):
+            ct_info.ip = '127.0.0.1'
+
+        registry.remove(ct_info.id)
+        self.assertIsNone(registry.get(compose_name='service1'))
+        self.assertEqual(2, len(registry.snapshot()))
+        self.assertEqual(3, len(snapshot))
+
+        client = FakeApiClient(1, 0)
+        with mock.patch.object(docker_actions, 'get_api_client', return_value=client):
+            registry.refresh('bench')
+        self.assertEqual(['bench_service0'], list(registry.snapshot().keys()))
+        self.assertIsNone(registry.get(compose_name='service2'))
+
+    def test_registry_concurrent_refresh(self):
+        """Readers never see a partial registry while it's refreshed"""
+        from concurrent.futures import ThreadPoolExecutor
+
+        registry = docker_actions.ContainerRegistry()
+        client = FakeApiClient(20, 0)
+
+        def _refresh(_):
+            registry.refresh('bench')
+            return len(registry.snapshot())
+
+        with mock.patch.object(docker_actions, 'get_api_client', return_value=client):
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                sizes = list(executor.map(_refresh, range(50)))
+
+        self.assertEqual([20] * 50, sizes)
+
+    def test_block_cts_ports(self):
+        """Rules are applied with one exec by container, the network is inspected once"""
+        client = FakeApiClient(5, 0)
+        client.inspect_network = mock.Mock(return_value={'IPAM': {'Config': [{'Subnet': '192.168.1.0/24'}]}})
+        client.exec_create = mock.Mock(side_effect=lambda ct_id, cmd, user: {'Id': ct_id, 'cmd': cmd})
+        client.exec_start = mock.Mock(return_value=b'')
+        client.exec_inspect = mock.Mock(side_effect=lambda exec_id: {
+            'ExitCode': 127 if exec_id['Id'] == client.cts[4]['list']['Id'] else 0})
+        services_ports = {'service{}'.format(num): list(range(10)) for num in range(5)}
+        services_ports['mysql'] = [25]
+        with mock.patch.object(docker_actions, 'get_api_client', return_value=client):
+            docker_actions.get_running_containers('bench')
+            results = docker_actions.block_cts_ports('bench', services_ports)
+
+        client.inspect_network.assert_called_once_with('bench_stakkr')
+        self.assertEqual(5, client.exec_create.call_count)
+        self.assertEqual((False, 'Blocked ports 0, 1, 2, 3, 4, 5, 6, 7, 8, 9 on container service0'),
+                         results['service0'])
+        self.assertEqual((True, "Can't block ports on service4, is iptables installed ?"), results['service4'])
+        self.assertEqual((False, 'mysql is not started, no port to block'), results['mysql'])
+
+        script = client.exec_create.call_args_list[0][0][1][2].splitlines()
+        self.assertEqual(1 + 2 * 11, len(script))
+        self.assertEqual('$IPTABLES -A OUTPUT -d 192.168.1.0/24 -j ACCEPT || exit 1', script[2])
+        self.assertEqual('$IPTABLES -D OUTPUT -p tcp --dport 0 -j REJECT 2>/dev/null', script[3])
+
     def test_guess_shell_sh(self):
         stop_remove_container('pytest')
 
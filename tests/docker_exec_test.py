@@ -0,0 +1,162 @@
+import io
+import os
+import pty
+import socket
+import struct
+import sys
+import termios
+import threading
+import unittest
+from unittest import mock
+from docker.errors import APIError
+from stakkr import docker_actions
+from stakkr.actions import StakkrActions, _get_shell_cmd
+from stakkr.docker_exec import Demuxer, DockerExec
+
+base_dir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, base_dir + '/../')
+
+
+class FakeExecApiClient:
+    """Run a fake command on the other side of a socket: echo stdin to stdout, then exit."""
+
+    def __init__(self, exit_code: int = 0, tty_fd: int = None):
+        self.exit_code = exit_code
+        self.created = None
+        self.resized = []
+        self.tty_fd = tty_fd
+        self.tty_attrs = None
+        self.thread = None
+
+    def exec_create(self, container: str, cmd: list, **kwargs):
+        self.created = dict(kwargs, container=container, cmd=cmd)
+        return {'Id': 'exec1'}
+
+    def exec_start(self, exec_id: str, tty: bool, socket: bool):
+        local, remote = _socketpair()
+        self.thread = threading.Thread(target=self._command, args=(remote, tty))
+        self.thread.start()
+
+        return local
+
+    def exec_resize(self, exec_id: str, height: int, width: int):
+        self.resized.append((height, width))
+        self.tty_attrs = termios.tcgetattr(self.tty_fd)
+
+    def exec_inspect(self, exec_id: str):
+        self.thread.join()
+        return {'Running': False, 'ExitCode': self.exit_code}
+
+    def _command(self, remote: socket.socket, tty: bool):
+        if tty is True:
+            # Like a shell that exits without waiting for input
+            remote.sendall(b'tty\r\n')
+            remote.close()
+            return
+
+        received = b''
+        while True:
+            data = remote.recv(1024)
+            if not data:
+                break
+            received += data
+
+        # Split a frame in 2 parts to check they are joined
+        frames = _frame(1, b'out:' + received) + _frame(2, b'err')
+        remote.sendall(frames[:6])
+        remote.sendall(frames[6:])
+        remote.close()
+
+
+# https://docs.python.org/3/library/unittest.html#assert-methods
+class DockerExecTest(unittest.TestCase):
+    def test_exec_piped_stdin(self):
+        """stdin is sent (then closed), stdout / stderr are split and the exit code returned"""
+        api = FakeExecApiClient(exit_code=3)
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, b'hello')
+        os.close(write_fd)
+        stdout, stderr = io.BytesIO(), io.BytesIO()
+        with open(read_fd, 'rb') as stdin, mock.patch.object(docker_actions, 'get_api_client', return_value=api):
+            docker_exec = DockerExec('bench_php', ['cat', 1], 'www-data', '/var', True, stdin, stdout, stderr)
+            return_code = docker_exec.run()
+
+        self.assertEqual(3, return_code)
+        self.assertEqual(b'out:hello', stdout.getvalue())
+        self.assertEqual(b'err', stderr.getvalue())
+        self.assertEqual({'container': 'bench_php', 'cmd': ['cat', '1'], 'stdin': True, 'tty': False,
+                          'user': 'www-data', 'workdir': '/var'}, api.created)
+
+    def test_exit_code_unknown(self):
+        """Never reported as a success"""
+        api = FakeExecApiClient(exit_code=None)
+        stdout, stderr = io.BytesIO(), io.BytesIO()
+        with open(os.devnull, 'rb') as stdin, mock.patch.object(docker_actions, 'get_api_client', return_value=api):
+            return_code = DockerExec('bench_php', ['true'], stdin=stdin, stdout=stdout, stderr=stderr).run()
+
+        self.assertEqual(255, return_code)
+        self.assertIn(b'The exit code of the command is unknown', stderr.getvalue())
+
+    def test_exec_tty(self):
+        """With a terminal, it's in raw mode during the command, then restored"""
+        master_fd, slave_fd = pty.openpty()
+        attrs = termios.tcgetattr(slave_fd)
+        api = FakeExecApiClient(tty_fd=slave_fd)
+        stdout = io.BytesIO()
+        with open(slave_fd, 'rb', buffering=0) as stdin:
+            with mock.patch.object(docker_actions, 'get_api_client', return_value=api):
+                docker_exec = DockerExec('bench_php', ['sh'], tty=True, stdin=stdin, stdout=stdout)
+                self.assertEqual(0, docker_exec.run())
+            self.assertEqual(attrs, termios.tcgetattr(slave_fd))
+        os.close(master_fd)
+
+        self.assertTrue(api.created['tty'])
+        self.assertEqual(1, len(api.resized))
+        self.assertFalse(api.tty_attrs[3] & termios.ICANON)
+        self.assertEqual(b'tty\r\n', stdout.getvalue())
+
+    def test_demuxer(self):
+        stdout, stderr = io.BytesIO(), io.BytesIO()
+        demuxer = Demuxer({1: stdout, 2: stderr})
+        frames = _frame(2, b'error') + _frame(1, b'a' * 100) + _frame(1, b'b')
+        for pos in range(0, len(frames), 7):
+            self.assertTrue(demuxer.feed(frames[pos:pos + 7]))
+
+        self.assertFalse(demuxer.feed(b''))
+        self.assertEqual(b'a' * 100 + b'b', stdout.getvalue())
+        self.assertEqual(b'error', stderr.getvalue())
+
+    def test_shell_cmd(self):
+        self.assertEqual(['sh', '-c', 'exec "echo" "a \\"b\\"" "$HOME" "\\`id\\`" "1"'],
+                         _get_shell_cmd(['echo', 'a "b"', '$HOME', '`id`', 1]))
+
+    def test_engine(self):
+        stakkr = StakkrActions({'CONFIG': None, 'VERBOSE': False, 'DEBUG': False})
+        stakkr.config = {'exec': {'engine': 'cli'}}
+        self.assertEqual('cli', stakkr._get_exec_engine())
+        self.assertEqual('api', stakkr._get_exec_engine('api'))
+        with mock.patch('stakkr.docker_exec.api_available', return_value=False):
+            self.assertEqual('cli', stakkr._get_exec_engine('api'))
+
+    def test_fallback_on_cli(self):
+        """If docker can't create the exec, the CLI is used"""
+        stakkr = StakkrActions({'CONFIG': None, 'VERBOSE': False, 'DEBUG': False})
+        api = mock.Mock()
+        api.exec_create.side_effect = APIError('Not supported')
+        fallback = mock.Mock(return_value=2)
+        with mock.patch.object(docker_actions, 'get_api_client', return_value=api):
+            self.assertEqual(2, stakkr._exec_api('bench_php', ['php', '-v'], 'root', None, False, fallback))
+        fallback.assert_called_once_with()
+        api.exec_start.assert_not_called()
+
+
+def _frame(stream: int, data: bytes):
+    return struct.pack('>BxxxL', stream, len(data)) + data
+
+
+def _socketpair():
+    return socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+
+
+if __name__ == "__main__":
+    unittest.main()
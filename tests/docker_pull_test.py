@@ -0,0 +1,129 @@
+import io
+import os
+import sys
+import threading
+import time
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import mock
+from docker.errors import APIError, ImageNotFound
+from stakkr import docker_actions, docker_pull
+from stakkr.file_utils import read_json
+
+base_dir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, base_dir + '/../')
+
+
+class FakePullApiClient:
+    """Registry and local images: digest by image, pulls are counted."""
+
+    def __init__(self, local: dict, remote: dict, delay: float = 0):
+        self.local = local
+        self.remote = remote
+        self.delay = delay
+        self.pulled = []
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def inspect_image(self, image: str):
+        if image not in self.local:
+            raise ImageNotFound('No such image: ' + image)
+
+        return {'RepoDigests': [image.split(':')[0] + '@' + self.local[image]]}
+
+    def inspect_distribution(self, image: str):
+        if image not in self.remote:
+            raise APIError('Unauthorized')
+
+        return {'Descriptor': {'digest': self.remote[image]}}
+
+    def pull(self, repository: str, tag: str, stream: bool, decode: bool):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.running, self.max_running)
+        time.sleep(self.delay)
+        self.pulled.append('{}:{}'.format(repository, tag))
+        yield {'status': 'Downloading', 'id': 'layer1', 'progressDetail': {'current': 512, 'total': 1024}}
+        yield {'status': 'Download complete', 'id': 'layer1', 'progressDetail': {}}
+        with self.lock:
+            self.running -= 1
+
+
+# https://docs.python.org/3/library/unittest.html#assert-methods
+class DockerPullTest(unittest.TestCase):
+    def test_pull_changed_images(self):
+        """Images are pulled only when the digest in the registry is not the local one"""
+        api = FakePullApiClient(
+            local={'edyan/php:7.2': 'sha256:a', 'edyan/adminer:latest': 'sha256:b'},
+            remote={'edyan/php:7.2': 'sha256:a', 'edyan/adminer:latest': 'sha256:c', 'mysql:5.7': 'sha256:d'})
+        images = ['edyan/php:7.2', 'edyan/adminer:latest', 'mysql:5.7', 'private/image:1', 'edyan/php:7.2']
+        with mock.patch.object(docker_actions, 'get_api_client', return_value=api):
+            results = docker_pull.ImagesPull(images, stream=io.StringIO()).run()
+
+        self.assertEqual(['edyan/adminer:latest', 'mysql:5.7', 'private/image:1'], sorted(api.pulled))
+        self.assertEqual(['edyan/adminer:latest', 'edyan/php:7.2', 'mysql:5.7', 'private/image:1'], sorted(results))
+        self.assertEqual('up to date', results['edyan/php:7.2']['status'])
+        self.assertEqual({'status': 'pulled', 'digest': 'sha256:c'},
+                         {key: results['edyan/adminer:latest'][key] for key in ('status', 'digest')})
+        self.assertIsNone(results['private/image:1']['digest'])
+        self.assertIn('seconds', results['mysql:5.7'])
+
+    def test_concurrency(self):
+        api = FakePullApiClient({}, {}, delay=0.05)
+        images = ['image{}:latest'.format(num) for num in range(6)]
+        with mock.patch.object(docker_actions, 'get_api_client', return_value=api):
+            docker_pull.ImagesPull(images, concurrency=2, stream=io.StringIO()).run()
+
+        self.assertEqual(6, len(api.pulled))
+        self.assertEqual(2, api.max_running)
+
+    def test_pull_error(self):
+        api = FakePullApiClient({}, {})
+        api.pull = mock.Mock(return_value=iter([{'error': 'manifest unknown'}]))
+        with mock.patch.object(docker_actions, 'get_api_client', return_value=api):
+            with self.assertRaisesRegex(RuntimeError, r"Can't pull images: php:9 \(manifest unknown\)"):
+                docker_pull.ImagesPull(['php:9'], stream=io.StringIO()).run()
+
+    def test_progress(self):
+        """Bytes of all images are added on a single line"""
+        stream = io.StringIO()
+        stream.isatty = lambda: True
+        progress = docker_pull._Progress(2, stream)
+        progress.update('php', {'status': 'Downloading', 'id': 'l1',
+                                'progressDetail': {'current': 1048576, 'total': 2097152}})
+        progress.update('mysql', {'status': 'Downloading', 'id': 'l1',
+                                  'progressDetail': {'current': 0, 'total': 1048576}})
+        progress.update('mysql', {'status': 'Download complete', 'id': 'l1', 'progressDetail': {}})
+        progress.image_done('mysql')
+        progress.close()
+
+        self.assertTrue(stream.getvalue().endswith(' 1/2 images, 2.0 / 3.0 MB\n'))
+
+    def test_pull_services_images(self):
+        """Images come from the rendered compose file, timings are kept into .stakkr/pulls.json"""
+        project_dir = mkdtemp()
+        compose_file = project_dir + '/docker-compose.yml'
+        with open(compose_file, 'w') as stream:
+            stream.write('services:\n  php: {image: "edyan/php:7.2"}\n  app: {build: .}\n'
+                         '  adminer: {image: "edyan/adminer:latest"}\n')
+
+        self.assertEqual({'php': 'edyan/php:7.2'}, docker_pull.get_services_images(compose_file, ['php', 'app']))
+
+        api = FakePullApiClient({}, {})
+        config = {'project_dir': project_dir, 'pull': {'concurrency': 1}}
+        with mock.patch('stakkr.stakkr_compose.get_rendered_compose_file', return_value=compose_file):
+            with mock.patch.object(docker_actions, 'get_api_client', return_value=api):
+                results = docker_pull.pull_services_images(config)
+        self.assertEqual(['edyan/adminer:latest', 'edyan/php:7.2'], sorted(results))
+        self.assertEqual(sorted(results), sorted(read_json(project_dir + '/.stakkr/pulls.json')))
+
+        with mock.patch('stakkr.stakkr_compose.get_rendered_compose_file', return_value=None):
+            self.assertIsNone(docker_pull.pull_services_images(config))
+
+        rmtree(project_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
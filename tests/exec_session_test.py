@@ -0,0 +1,163 @@
+import io
+import os
+import shutil
+import socket
+import struct
+import sys
+import time
+import unittest
+from tempfile import mkdtemp
+from unittest import mock
+from stakkr import docker_actions
+from stakkr.actions import StakkrActions
+from stakkr.exec_session import STDOUT, _MarkedOutput, _read_frames, close_sessions, get_socket_path, input_needed, run
+from tests.fake_docker import FakeDockerServer
+
+base_dir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, base_dir + '/../')
+
+
+# https://docs.python.org/3/library/unittest.html#assert-methods
+class ExecSessionTest(unittest.TestCase):
+    """Sessions against the fake docker daemon: the shell of the container is a local sh"""
+
+    def setUp(self):
+        self.project_dir = mkdtemp()
+        self.server = FakeDockerServer('bench', containers=1).start()
+        self.server.shell = ['sh']
+        # Sessions are other processes: they need the fake daemon and stakkr
+        self.patches = [
+            mock.patch.dict(os.environ, DOCKER_HOST=self.server.base_url,
+                            PYTHONPATH=base_dir + '/..' + os.pathsep + os.environ.get('PYTHONPATH', '')),
+            mock.patch.dict(docker_actions.__clients__, clear=True)]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        close_sessions(self.project_dir)
+        for patch in self.patches:
+            patch.stop()
+        self.server.stop()
+        shutil.rmtree(self.project_dir)
+
+    def test_commands_share_a_session(self):
+        self.assertEqual((0, 'hello world\n', ''), self._run('"echo" "hello world"'))
+        self.assertEqual((3, '', 'oops\n'), self._run('"sh" "-c" "echo oops >&2; exit 3"'))
+        # No end of line
+        self.assertEqual((0, 'abc', ''), self._run('"printf" "abc"'))
+        self.assertEqual((0, '/tmp\n', ''), self._run('"pwd"', '/tmp'))
+        # Variables are expanded by the shell of the container
+        self.assertEqual((0, 'expanded\n', ''), self._run('"echo" "${STAKKR_UNSET:-expanded}"'))
+
+        self.assertEqual(1, self.server.calls['exec_create'])
+
+    def test_big_output(self):
+        exit_code, stdout, stderr = self._run('"sh" "-c" "seq 1 100000; seq 1 1000 >&2"')
+        self.assertEqual(0, exit_code)
+        self.assertEqual(100000, len(stdout.splitlines()))
+        self.assertEqual('100000', stdout.splitlines()[-1])
+        self.assertEqual(1000, len(stderr.splitlines()))
+
+    def test_close(self):
+        self._run('"true"')
+        socket_path = get_socket_path(self.project_dir, 'bench_service0', 'root')
+        self.assertTrue(os.path.exists(socket_path))
+
+        self.assertEqual(1, close_sessions(self.project_dir))
+        self._wait_removed(socket_path)
+        self.assertEqual(0, close_sessions(self.project_dir))
+
+        # A new session is started
+        self.assertEqual((0, 'again\n', ''), self._run('"echo" "again"'))
+        self.assertEqual(2, self.server.calls['exec_create'])
+
+    def test_shell_exited(self):
+        self._run('"true"')
+        # Like a container restarted
+        self.server.shell_processes[0].kill()
+        self.server.shell_processes[0].wait()
+
+        self.assertEqual((0, 'new\n', ''), self._run('"echo" "new"'))
+        self.assertEqual(2, self.server.calls['exec_create'])
+
+    def test_idle_timeout(self):
+        self._run('"true"', timeout=0.2)
+        self._wait_removed(get_socket_path(self.project_dir, 'bench_service0', 'root'))
+
+    def test_input_needed(self):
+        import pty
+
+        read_fd, write_fd = os.pipe()
+        with open(read_fd) as pipe, open(write_fd, 'w'), open(__file__) as file, open(os.devnull) as devnull:
+            self.assertTrue(input_needed(pipe))
+            self.assertTrue(input_needed(file))
+            self.assertFalse(input_needed(devnull))
+        # Closed
+        self.assertFalse(input_needed(file))
+        self.assertFalse(input_needed(io.StringIO()))
+
+        # Without TTY, a terminal is not read
+        master_fd, slave_fd = pty.openpty()
+        with open(master_fd), open(slave_fd) as terminal:
+            self.assertFalse(input_needed(terminal))
+
+    def test_closed_without_answer(self):
+        """A session ending accepts a connection and closes it: like CLOSED, another session is started"""
+        client, server = socket.socketpair()
+        server.close()
+        with client:
+            self.assertIsNone(_read_frames(client, io.BytesIO(), io.BytesIO()))
+
+        client, server = socket.socketpair()
+        server.sendall(struct.pack('>BL', STDOUT, 2) + b'ok')
+        server.close()
+        with client, self.assertRaisesRegex(RuntimeError, 'The session ended during the command'):
+            _read_frames(client, io.BytesIO(), io.BytesIO())
+
+    def test_engine_choice(self):
+        """The session is used from a terminal without TTY, the API with a TTY or an input to read"""
+        import pty
+
+        stakkr = StakkrActions({'CONFIG': base_dir + '/static/config_budget.yml', 'VERBOSE': False, 'DEBUG': False})
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+        master_fd, slave_fd = pty.openpty()
+        read_fd, write_fd = os.pipe()
+        with open(master_fd), open(slave_fd) as terminal, open(read_fd) as pipe, open(write_fd, 'w'), \
+                mock.patch.object(StakkrActions, 'get_running_container', return_value={'name': 'static_php'}), \
+                mock.patch.object(StakkrActions, '_exec_session', return_value=0) as exec_session, \
+                mock.patch.object(StakkrActions, '_exec_api', return_value=0) as exec_api:
+            for stdin, tty, engine in ((terminal, False, 'session'), (terminal, True, 'api'), (pipe, False, 'api')):
+                exec_session.reset_mock()
+                exec_api.reset_mock()
+                with mock.patch('sys.stdin', stdin):
+                    self.assertEqual(0, stakkr.exec_cmd('php', 'root', ('true',), tty, engine='session'))
+                self.assertEqual(engine == 'session', exec_session.called, (stdin, tty))
+                self.assertEqual(engine == 'api', exec_api.called, (stdin, tty))
+
+    def test_marked_output(self):
+        sent = []
+        output = _MarkedOutput('0123456789', STDOUT, lambda kind, data: sent.append(data))
+        for chunk in (b'hello', b' world 01234', b'56789', b':12', b'\n'):
+            output.write(chunk)
+
+        self.assertEqual(b'hello world ', b''.join(sent))
+        self.assertEqual(':12', output.end)
+
+    def _run(self, command: str, workdir: str = None, timeout: float = 10):
+        stdout, stderr = io.BytesIO(), io.BytesIO()
+        exit_code = run(self.project_dir, 'bench_service0', 'root', command, workdir, timeout, stdout, stderr)
+
+        return exit_code, stdout.getvalue().decode(), stderr.getvalue().decode()
+
+    def _wait_removed(self, path: str):
+        for _ in range(200):
+            if os.path.exists(path) is False:
+                return
+            time.sleep(0.01)
+
+        self.fail('{} still exists'.format(path))
+
+
+if __name__ == "__main__":
+    unittest.main()
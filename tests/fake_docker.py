@@ -0,0 +1,651 @@
+"""
+A stand-in for the Docker Engine API, served on a unix socket.
+
+It implements the endpoints stakkr (and docker-compose) use: containers
+list / inspect / create / start / stop / exec, networks, images and pulls, with
+an optional latency per call. Point the docker SDK to it with
+DOCKER_HOST=unix://<socket_path>. Commands run through exec don't run anything:
+they answer what they receive on stdin (or nothing), with exit code 0, unless
+exec_handler says otherwise.
+
+    with FakeDockerServer(containers=10, latency=0.001) as server:
+        subprocess.run(['stakkr', 'status'], env=dict(os.environ, DOCKER_HOST=server.base_url))
+
+FakeApiClient answers the containers list / inspect in-process, for the unit
+tests and benchmarks that replace get_api_client.
+"""
+
+import json
+import os
+import re
+import socket
+import socketserver
+import struct
+import threading
+import time
+from collections import Counter
+from contextlib import nullcontext
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler
+from tempfile import mkdtemp
+from urllib.parse import parse_qs, unquote, urlsplit
+
+API_VERSION = '1.41'
+
+
+class FakeDockerServer:
+    """A fake docker daemon, with a compose project of N running containers."""
+
+    def __init__(self, project: str = 'bench', containers: int = 0, latency: float = 0, running: bool = True,
+                 socket_path: str = None):
+        """Containers are named {project}_service{num}, in the network {project}_stakkr."""
+        self.project = project
+        self.latency = latency
+        self.socket_path = socket_path or mkdtemp() + '/docker.sock'
+        self.lock = threading.RLock()
+        self.calls = Counter()
+        self.containers = dict()
+        self.execs = dict()
+        self.images = dict()
+        self.networks = dict()
+        # Called with the container, the exec config and stdin, returns stdout, stderr and the exit code
+        self.exec_handler = _echo_stdin
+        # If set (['sh'] for example), an exec of sh with stdin runs this local process for as long as it lives
+        self.shell = None
+        self.shell_processes = []
+        self.server = None
+        self.thread = None
+        # Streams of events stay open until the server stops, like docker's
+        self.stopped = threading.Event()
+
+        if containers:
+            network = self.add_network('{}_stakkr'.format(project).lower(), '192.168.1.0/24')
+            for num in range(containers):
+                self.add_container('service{}'.format(num), network=network, running=running)
+
+    @property
+    def base_url(self):
+        """The value of DOCKER_HOST to use the server."""
+        return 'unix://' + self.socket_path
+
+    def start(self):
+        """Listen on the socket, in a thread."""
+        self.server = _Server(self.socket_path, _Handler)
+        self.server.fake = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+        return self
+
+    def stop(self):
+        """Stop listening and remove the socket."""
+        self.stopped.set()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        os.remove(self.socket_path)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def add_network(self, name: str, subnet: str = '172.30.0.0/16', labels: dict = None):
+        """Create a network, return its name."""
+        with self.lock:
+            self.networks[name] = {
+                'Name': name, 'Id': _make_id('network', name), 'Driver': 'bridge', 'Scope': 'local',
+                'IPAM': {'Driver': 'default', 'Config': [{'Subnet': subnet}]},
+                'Labels': labels or {}, 'Containers': {}, 'Options': {}}
+
+        return name
+
+    def add_image(self, name: str):
+        """Add a local image, return its inspect."""
+        name = name if ':' in name.split('/')[-1] else name + ':latest'
+        with self.lock:
+            if name not in self.images:
+                self.images[name] = {
+                    'Id': 'sha256:' + _make_id('image', name), 'RepoTags': [name],
+                    'RepoDigests': ['{}@sha256:{}'.format(name.split(':')[0], _make_id('digest', name))],
+                    'Size': 1024, 'Config': {'Labels': {}, 'Env': [], 'Cmd': ['sh']}, 'ContainerConfig': {}}
+
+            return self.images[name]
+
+    def add_container(self, service: str, image: str = 'edyan/php:7.2', network: str = None, running: bool = True):
+        """Add a container of a compose service of the project, return its inspect."""
+        labels = {
+            'com.docker.compose.project': self.project,
+            'com.docker.compose.service': service,
+            'traefik.frontend.rule': 'Host:{}.{}.localhost'.format(service, self.project)}
+        config = {
+            'Image': image, 'Labels': labels,
+            'HostConfig': {'PortBindings': {}, 'NetworkMode': network or 'default'},
+            'NetworkingConfig': {'EndpointsConfig': {network: {}}} if network else {}}
+        container = self._create_container('{}_{}'.format(self.project, service), config)
+        if running is True:
+            self._set_running(container, True)
+
+        return container
+
+    def _create_container(self, name: str, config: dict):
+        with self.lock:
+            ct_id = _make_id('container', name + str(time.time()))
+            image = self.add_image(config.get('Image', 'scratch'))
+            host_config = config.get('HostConfig') or {}
+            container = {
+                'Id': ct_id, 'Name': '/' + name, 'Created': '2019-01-01T00:00:00Z', 'Image': image['Id'],
+                'Config': {
+                    'Image': config.get('Image'), 'Labels': config.get('Labels') or {}, 'Env': config.get('Env') or [],
+                    'Cmd': config.get('Cmd'), 'Hostname': config.get('Hostname', ct_id[:12]),
+                    'ExposedPorts': config.get('ExposedPorts') or {}, 'Volumes': config.get('Volumes')},
+                'State': {'Status': 'created', 'Running': False, 'ExitCode': 0, 'Pid': 0},
+                'HostConfig': dict(host_config, PortBindings=host_config.get('PortBindings') or {}),
+                'Mounts': [], 'RestartCount': 0,
+                'NetworkSettings': {'Networks': {}, 'Ports': {}}}
+            networks = list((config.get('NetworkingConfig') or {}).get('EndpointsConfig', {}) or {})
+            if not networks and host_config.get('NetworkMode') in self.networks:
+                networks = [host_config['NetworkMode']]
+            for network in networks:
+                self._connect(container, network)
+            self.containers[ct_id] = container
+
+            return container
+
+    def _connect(self, container: dict, network: str):
+        network = self._get_network(network)
+        if network is None:
+            raise _ApiError(404, 'network not found')
+
+        num = len(network['Containers']) + 2
+        subnet = network['IPAM']['Config'][0]['Subnet'].split('/')[0]
+        ip_addr = '.'.join(subnet.split('.')[:3] + [str(num)])
+        container['NetworkSettings']['Networks'][network['Name']] = {
+            'NetworkID': network['Id'], 'IPAddress': ip_addr, 'Aliases': [], 'Gateway': '', 'MacAddress': ''}
+        network['Containers'][container['Id']] = {'Name': container['Name'][1:], 'IPv4Address': ip_addr + '/24'}
+
+    def _set_running(self, container: dict, running: bool):
+        container['State'].update(Running=running, Status='running' if running else 'exited')
+        bindings = container['HostConfig']['PortBindings'] if running else {}
+        container['NetworkSettings']['Ports'] = bindings
+
+    def _get_container(self, ref: str):
+        ref = ref.lstrip('/')
+        for container in self.containers.values():
+            if ref in (container['Id'], container['Name'][1:]) or (len(ref) >= 12 and container['Id'].startswith(ref)):
+                return container
+
+        raise _ApiError(404, 'No such container: {}'.format(ref))
+
+    def _get_network(self, ref: str):
+        for network in self.networks.values():
+            if ref in (network['Name'], network['Id']):
+                return network
+
+        return None
+
+    def _get_image(self, ref: str):
+        ref = ref if ':' in ref.split('/')[-1] or ref.startswith('sha256:') else ref + ':latest'
+        for name, image in self.images.items():
+            if ref in (name, image['Id']):
+                return image
+
+        raise _ApiError(404, 'No such image: {}'.format(ref))
+
+
+class FakeApiClient:
+    """
+    In-process stand-in for docker.APIClient (containers list / inspect only), sleeping
+    on each call: for unit tests that mock get_api_client, without the socket of the server.
+    """
+
+    def __init__(self, num_containers: int, latency: float, sparse: bool = False):
+        self.latency = latency
+        self.sparse = sparse
+        self.calls = 0
+        self.cts = [_api_container(num) for num in range(num_containers)]
+
+    def containers(self, filters: dict = None):
+        self._call()
+        labels = dict(label.split('=', 1) for label in (filters or {}).get('label', []))
+        cts = [ct['list'] for ct in self.cts if labels.items() <= ct['list']['Labels'].items()]
+        if self.sparse is False:
+            return cts
+
+        # Old daemons (or proxies) don't always give the labels
+        return [{key: value for key, value in ct.items() if key != 'Labels'} for ct in cts]
+
+    def inspect_container(self, ct_id: str):
+        self._call()
+        return [ct['inspect'] for ct in self.cts if ct['list']['Id'] == ct_id][0]
+
+    def _call(self):
+        self.calls += 1
+        time.sleep(self.latency)
+
+
+def _api_container(num: int):
+    ct_id = '{:064x}'.format(num)
+    name = 'bench_service{}'.format(num)
+    labels = {
+        'com.docker.compose.project': 'bench',
+        'com.docker.compose.service': 'service{}'.format(num),
+        'traefik.frontend.rule': 'Host:service{}.bench.localhost'.format(num)}
+    networks = {'bench_stakkr': {'IPAddress': '192.168.1.{}'.format(num + 2)}}
+
+    return {
+        'list': {
+            'Id': ct_id, 'Names': ['/' + name], 'Image': 'edyan/php:7.2', 'ImageID': 'sha256:php72',
+            'Labels': labels,
+            'State': 'running', 'Ports': [{'PrivatePort': 80, 'PublicPort': 8000 + num, 'Type': 'tcp'}],
+            'NetworkSettings': {'Networks': networks}},
+        'inspect': {
+            'Id': ct_id, 'Name': '/' + name, 'Image': 'sha256:php72',
+            'Config': {'Image': 'edyan/php:7.2', 'Labels': labels},
+            'State': {'Running': True}, 'HostConfig': {'PortBindings': {'80/tcp': [{'HostPort': str(8000 + num)}]}},
+            'NetworkSettings': {'Networks': networks}}}
+
+
+def _list_item(container: dict):
+    """A container as GET /containers/json gives it."""
+    ports = []
+    for private, bindings in container['NetworkSettings']['Ports'].items():
+        port, proto = private.split('/')
+        ports += [{'IP': '0.0.0.0', 'PrivatePort': int(port), 'PublicPort': int(binding['HostPort']), 'Type': proto}
+                  for binding in bindings or [] if binding.get('HostPort')]
+
+    return {
+        'Id': container['Id'], 'Names': [container['Name']], 'Image': container['Config']['Image'],
+        'ImageID': container['Image'], 'Command': '', 'Created': 1546300800, 'Ports': ports,
+        'Labels': container['Config']['Labels'], 'State': container['State']['Status'],
+        'Status': 'Up 1 minute' if container['State']['Running'] else 'Exited (0)',
+        'HostConfig': {'NetworkMode': container['HostConfig'].get('NetworkMode', 'default')},
+        'NetworkSettings': {'Networks': container['NetworkSettings']['Networks']}, 'Mounts': []}
+
+
+def _match_filters(fake: FakeDockerServer, container: dict, filters: dict):
+    for key, values in filters.items():
+        values = list(values) if isinstance(values, (list, dict)) else [values]
+        labels = container['Config']['Labels']
+        if key == 'label' and not all(
+                labels.get(value.split('=', 1)[0]) == value.split('=', 1)[1] if '=' in value else value in labels
+                for value in values):
+            return False
+        if key == 'name' and not any(re.search(value, container['Name'][1:]) for value in values):
+            return False
+        if key == 'status' and container['State']['Status'] not in values:
+            return False
+        if key == 'id' and not any(container['Id'].startswith(value) for value in values):
+            return False
+        if key == 'network' and not any(
+                network['Name'] in container['NetworkSettings']['Networks']
+                for network in [fake._get_network(value) for value in values] if network is not None):
+            return False
+
+    return True
+
+
+class _ApiError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Route the requests to the methods of the handler, like the docker daemon."""
+
+    protocol_version = 'HTTP/1.1'
+    routes = [
+        ('GET', r'/_ping', 'ping'),
+        ('HEAD', r'/_ping', 'ping'),
+        ('GET', r'/version', 'version'),
+        ('GET', r'/info', 'info'),
+        ('GET', r'/events', 'events'),
+        ('GET', r'/containers/json', 'containers_list'),
+        ('POST', r'/containers/create', 'container_create'),
+        ('GET', r'/containers/(?P<ref>[^/]+)/json', 'container_inspect'),
+        ('POST', r'/containers/(?P<ref>[^/]+)/(?P<action>start|stop|kill|restart)', 'container_action'),
+        ('POST', r'/containers/(?P<ref>[^/]+)/wait', 'container_wait'),
+        ('DELETE', r'/containers/(?P<ref>[^/]+)', 'container_remove'),
+        ('POST', r'/containers/(?P<ref>[^/]+)/exec', 'exec_create'),
+        ('POST', r'/exec/(?P<ref>[^/]+)/start', 'exec_start'),
+        ('POST', r'/exec/(?P<ref>[^/]+)/resize', 'exec_resize'),
+        ('GET', r'/exec/(?P<ref>[^/]+)/json', 'exec_inspect'),
+        ('GET', r'/networks', 'networks_list'),
+        ('POST', r'/networks/create', 'network_create'),
+        ('GET', r'/networks/(?P<ref>[^/]+)', 'network_inspect'),
+        ('POST', r'/networks/(?P<ref>[^/]+)/(?P<action>connect|disconnect)', 'network_connect'),
+        ('DELETE', r'/networks/(?P<ref>[^/]+)', 'network_remove'),
+        ('GET', r'/images/json', 'images_list'),
+        ('POST', r'/images/create', 'image_pull'),
+        ('GET', r'/images/(?P<ref>.+)/json', 'image_inspect'),
+        ('GET', r'/distribution/(?P<ref>.+)/json', 'distribution_inspect'),
+        ('GET', r'/volumes', 'volumes_list'),
+        ('POST', r'/volumes/create', 'volume_create'),
+    ]
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_HEAD(self):
+        self._dispatch('HEAD')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def log_message(self, *args):
+        pass
+
+    def _dispatch(self, method: str):
+        fake = self.server.fake
+        url = urlsplit(self.path)
+        path = re.sub(r'^/v[0-9.]+', '', url.path)
+        self.query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = json.loads(self.rfile.read(length) or 'null') if length else None
+
+        for route_method, pattern, name in self.routes:
+            matches = re.fullmatch(pattern, path)
+            if route_method != method or matches is None:
+                continue
+
+            fake.calls[name] += 1
+            time.sleep(fake.latency)
+            # The stream of events stays open: it must not block the other calls
+            lock = nullcontext() if name == 'events' else fake.lock
+            try:
+                with lock:
+                    result = getattr(self, '_' + name)(fake, **{key: unquote(value)
+                                                                for key, value in matches.groupdict().items()})
+            except _ApiError as error:
+                return self._send(error.status, {'message': str(error)})
+
+            if result is not None:
+                self._send(*result)
+            return
+
+        self._send(404, {'message': 'page not found: {} {}'.format(method, path)})
+
+    def _send(self, status: int, data=None, content_type: str = 'application/json'):
+        body = b'' if data is None else (data if isinstance(data, bytes) else json.dumps(data).encode())
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Api-Version', API_VERSION)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _send_stream(self, items: list):
+        """A chunked stream of JSON objects, like pulls or events."""
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for item in items:
+            chunk = (json.dumps(item) + '\r\n').encode()
+            self.wfile.write('{:x}\r\n'.format(len(chunk)).encode() + chunk + b'\r\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _ping(self, fake):
+        return 200, b'OK', 'text/plain'
+
+    def _version(self, fake):
+        return 200, {'Version': '20.10.0', 'ApiVersion': API_VERSION, 'MinAPIVersion': '1.12',
+                     'Os': 'linux', 'Arch': 'amd64', 'KernelVersion': '5.0.0'}
+
+    def _info(self, fake):
+        return 200, {'Containers': len(fake.containers), 'Images': len(fake.images), 'Name': 'fake',
+                     'ServerVersion': '20.10.0', 'OperatingSystem': 'Fake Docker'}
+
+    def _events(self, fake):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self.wfile.flush()
+        fake.stopped.wait()
+        try:
+            self.wfile.write(b'0\r\n\r\n')
+        except OSError:
+            # The client is gone
+            pass
+
+    def _containers_list(self, fake):
+        filters = json.loads(self.query.get('filters', '{}'))
+        show_all = self.query.get('all') in ('1', 'true', 'True')
+        containers = [ct for ct in fake.containers.values() if show_all or ct['State']['Running']]
+
+        return 200, [_list_item(ct) for ct in containers if _match_filters(fake, ct, filters)]
+
+    def _container_create(self, fake):
+        name = self.query.get('name') or _make_id('name', str(time.time()))[:12]
+        if any(ct['Name'] == '/' + name for ct in fake.containers.values()):
+            raise _ApiError(409, 'Conflict. The container name "/{}" is already in use'.format(name))
+        container = fake._create_container(name, self.body or {})
+
+        return 201, {'Id': container['Id'], 'Warnings': []}
+
+    def _container_inspect(self, fake, ref: str):
+        return 200, fake._get_container(ref)
+
+    def _container_action(self, fake, ref: str, action: str):
+        container = fake._get_container(ref)
+        fake._set_running(container, action in ('start', 'restart'))
+        if container['State']['Running'] is False and container['HostConfig'].get('AutoRemove'):
+            self._container_remove(fake, ref)
+
+        return 204, None
+
+    def _container_wait(self, fake, ref: str):
+        fake._set_running(fake._get_container(ref), False)
+
+        return 200, {'StatusCode': 0}
+
+    def _container_remove(self, fake, ref: str):
+        container = fake._get_container(ref)
+        for network in fake.networks.values():
+            network['Containers'].pop(container['Id'], None)
+        del fake.containers[container['Id']]
+
+        return 204, None
+
+    def _exec_create(self, fake, ref: str):
+        container = fake._get_container(ref)
+        if container['State']['Running'] is False:
+            raise _ApiError(409, 'Container {} is not running'.format(ref))
+
+        exec_id = _make_id('exec', str(time.time()) + str(len(fake.execs)))
+        fake.execs[exec_id] = {'ID': exec_id, 'ContainerID': container['Id'], 'Running': False, 'ExitCode': None,
+                               'ProcessConfig': self.body, 'config': self.body}
+
+        return 201, {'Id': exec_id}
+
+    def _exec_start(self, fake, ref: str):
+        if ref not in fake.execs:
+            raise _ApiError(404, 'No such exec instance: {}'.format(ref))
+        exec_instance = fake.execs[ref]
+        exec_instance['Running'] = True
+        container = fake.containers[exec_instance['ContainerID']]
+
+        # Like the daemon, the connection is hijacked: raw (multiplexed) stream, outside the lock
+        self.close_connection = True
+        tty = bool((self.body or {}).get('Tty'))
+        self.wfile.write(b'HTTP/1.1 101 UPGRADED\r\nContent-Type: application/vnd.docker.raw-stream\r\n'
+                         b'Connection: Upgrade\r\nUpgrade: tcp\r\n\r\n')
+        self.wfile.flush()
+        fake.lock.release()
+        try:
+            self._run_exec(fake, container, exec_instance, tty)
+        finally:
+            fake.lock.acquire()
+
+    def _run_exec(self, fake, container: dict, exec_instance: dict, tty: bool):
+        if fake.shell is not None and exec_instance['config'].get('Cmd') == ['sh'] and tty is False:
+            return self._run_shell(fake, exec_instance)
+
+        stdin = b''
+        if exec_instance['config'].get('AttachStdin'):
+            # Like cat: read until the client closes its side (or stops sending)
+            self.connection.settimeout(0.05)
+            try:
+                while True:
+                    data = self.connection.recv(65536)
+                    if not data:
+                        break
+                    stdin += data
+            except socket.timeout:
+                pass
+        else:
+            # The client reads the raw socket once the headers are parsed, don't send the output with them
+            time.sleep(0.005)
+
+        stdout, stderr, exit_code = fake.exec_handler(container, exec_instance['config'], stdin)
+        if tty is True:
+            self.connection.sendall(stdout + stderr)
+        else:
+            self.connection.sendall(_frame(1, stdout) + _frame(2, stderr))
+        exec_instance.update(Running=False, ExitCode=exit_code)
+        self.connection.shutdown(2)
+
+    def _run_shell(self, fake, exec_instance: dict):
+        """A long-lived shell: the socket goes to its stdin, its output is framed back as it comes."""
+        import subprocess
+
+        process = subprocess.Popen(fake.shell, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        fake.shell_processes.append(process)
+        lock = threading.Lock()
+
+        def _forward(stream, num: int):
+            for data in iter(lambda: stream.read1(65536), b''):
+                with lock:
+                    try:
+                        self.connection.sendall(_frame(num, data))
+                    except OSError:
+                        pass
+
+        threads = [threading.Thread(target=_forward, args=(process.stdout, 1), daemon=True),
+                   threading.Thread(target=_forward, args=(process.stderr, 2), daemon=True)]
+        for thread in threads:
+            thread.start()
+
+        self.connection.settimeout(None)
+        try:
+            for data in iter(lambda: self.connection.recv(65536), b''):
+                process.stdin.write(data)
+                process.stdin.flush()
+        except OSError:
+            pass
+        finally:
+            process.stdin.close()
+
+        exec_instance.update(Running=False, ExitCode=process.wait())
+        for thread in threads:
+            thread.join()
+        try:
+            self.connection.shutdown(2)
+        except OSError:
+            pass
+
+    def _exec_resize(self, fake, ref: str):
+        return 201, None
+
+    def _exec_inspect(self, fake, ref: str):
+        if ref not in fake.execs:
+            raise _ApiError(404, 'No such exec instance: {}'.format(ref))
+
+        return 200, {key: value for key, value in fake.execs[ref].items() if key != 'config'}
+
+    def _networks_list(self, fake):
+        filters = json.loads(self.query.get('filters', '{}'))
+        names = filters.get('name', [])
+        networks = [network for network in fake.networks.values()
+                    if not names or any(name in network['Name'] for name in names)]
+
+        return 200, networks
+
+    def _network_create(self, fake):
+        name = self.body['Name']
+        if name in fake.networks:
+            raise _ApiError(409, 'network with name {} already exists'.format(name))
+        subnet = '172.{}.0.0/16'.format(30 + len(fake.networks))
+        config = (self.body.get('IPAM') or {}).get('Config') or [{}]
+        fake.add_network(name, config[0].get('Subnet', subnet), self.body.get('Labels'))
+
+        return 201, {'Id': fake.networks[name]['Id'], 'Warning': ''}
+
+    def _network_inspect(self, fake, ref: str):
+        network = fake._get_network(ref)
+        if network is None:
+            raise _ApiError(404, 'network {} not found'.format(ref))
+
+        return 200, network
+
+    def _network_connect(self, fake, ref: str, action: str):
+        container = fake._get_container(self.body['Container'])
+        network = fake._get_network(ref)
+        if network is None:
+            raise _ApiError(404, 'network {} not found'.format(ref))
+        if action == 'connect':
+            fake._connect(container, ref)
+        else:
+            container['NetworkSettings']['Networks'].pop(network['Name'], None)
+            network['Containers'].pop(container['Id'], None)
+
+        return 200, None
+
+    def _network_remove(self, fake, ref: str):
+        network = fake._get_network(ref)
+        if network is None:
+            raise _ApiError(404, 'network {} not found'.format(ref))
+        del fake.networks[network['Name']]
+
+        return 204, None
+
+    def _images_list(self, fake):
+        return 200, [{'Id': image['Id'], 'RepoTags': image['RepoTags'], 'RepoDigests': image['RepoDigests'],
+                      'Size': image['Size'], 'Labels': {}, 'Created': 1546300800} for image in fake.images.values()]
+
+    def _image_pull(self, fake):
+        name = '{}:{}'.format(self.query['fromImage'], self.query.get('tag') or 'latest')
+        fake.add_image(name)
+        layers = [{'status': 'Downloading', 'id': 'layer{}'.format(num),
+                   'progressDetail': {'current': 512, 'total': 1024}} for num in range(2)]
+        layers += [{'status': 'Download complete', 'id': 'layer{}'.format(num)} for num in range(2)]
+        self._send_stream([{'status': 'Pulling from ' + self.query['fromImage']}] + layers + [
+            {'status': 'Status: Downloaded newer image for ' + name}])
+
+    def _image_inspect(self, fake, ref: str):
+        return 200, fake._get_image(ref)
+
+    def _distribution_inspect(self, fake, ref: str):
+        ref = ref if ':' in ref.split('/')[-1] else ref + ':latest'
+
+        return 200, {'Descriptor': {'mediaType': 'application/vnd.docker.distribution.manifest.v2+json',
+                                    'digest': 'sha256:' + _make_id('digest', ref), 'size': 1024}, 'Platforms': []}
+
+    def _volumes_list(self, fake):
+        return 200, {'Volumes': [], 'Warnings': None}
+
+    def _volume_create(self, fake):
+        return 201, {'Name': (self.body or {}).get('Name', 'volume'), 'Driver': 'local', 'Mountpoint': '/tmp'}
+
+
+def _echo_stdin(container: dict, config: dict, stdin: bytes):
+    return stdin, b'', 0
+
+
+def _frame(stream: int, data: bytes):
+    return struct.pack('>BxxxL', stream, len(data)) + data if data else b''
+
+
+def _make_id(kind: str, value: str):
+    return sha256('{}:{}'.format(kind, value).encode()).hexdigest()
@@ -0,0 +1,99 @@
+import io
+import os
+import subprocess
+import sys
+import unittest
+from unittest import mock
+from stakkr import docker_actions
+from stakkr.docker_exec import DockerExec
+from stakkr.docker_pull import ImagesPull
+from stakkr.proxy import Proxy
+from tests.fake_docker import FakeDockerServer
+
+base_dir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, base_dir + '/../')
+
+
+# https://docs.python.org/3/library/unittest.html#assert-methods
+class FakeDockerTest(unittest.TestCase):
+    """stakkr against the fake docker daemon, through the docker SDK and a unix socket"""
+
+    def setUp(self):
+        self.server = FakeDockerServer('bench', containers=3).start()
+        self.patches = [mock.patch.dict(os.environ, DOCKER_HOST=self.server.base_url),
+                        mock.patch.dict(docker_actions.__clients__, clear=True)]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.server.stop()
+
+    def test_containers(self):
+        numcts, cts = docker_actions.get_running_containers('bench')
+        self.assertEqual(3, numcts)
+        self.assertEqual(['bench_service0', 'bench_service1', 'bench_service2'], sorted(cts))
+        self.assertEqual('192.168.1.3', cts['bench_service1']['ip'])
+        self.assertEqual('service1.bench.localhost', cts['bench_service1']['traefik_host'])
+
+        self.assertEqual('bench_service2', docker_actions.get_service_container('bench', 'service2')['name'])
+        self.assertIsNone(docker_actions.get_service_container('bench', 'mysql'))
+        self.assertTrue(docker_actions.container_running('bench_service0'))
+        self.assertFalse(docker_actions.container_running('bench_mysql'))
+
+    def test_networks(self):
+        self.assertEqual('bench_stakkr', docker_actions.get_network_name('bench'))
+        self.assertEqual('192.168.1.0', docker_actions.get_subnet('bench'))
+        self.assertFalse(docker_actions.network_exists('nw_pytest'))
+        self.assertIsInstance(docker_actions.create_network('nw_pytest'), str)
+        self.assertFalse(docker_actions.create_network('nw_pytest'))
+        self.assertTrue(docker_actions.add_container_to_network('bench_service0', 'nw_pytest'))
+        self.assertFalse(docker_actions.add_container_to_network('bench_service0', 'nw_pytest'))
+
+    def test_exec(self):
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, b'hello')
+        os.close(write_fd)
+        stdout = io.BytesIO()
+        with open(read_fd, 'rb') as stdin:
+            return_code = DockerExec('bench_service0', ['cat'], stdin=stdin, stdout=stdout, stderr=io.BytesIO()).run()
+
+        self.assertEqual(0, return_code)
+        self.assertEqual(b'hello', stdout.getvalue())
+
+        self.server.exec_handler = lambda container, config, stdin: (b'', b'no iptables', 127)
+        docker_actions.get_running_containers('bench')
+        self.assertEqual({'service1': (True, "Can't block ports on service1, is iptables installed ?")},
+                         docker_actions.block_cts_ports('bench', {'service1': [25]}))
+
+    def test_images_and_proxy(self):
+        results = ImagesPull(['edyan/php:7.2', 'mysql:5.7'], stream=io.StringIO()).run()
+        self.assertEqual('up to date', results['edyan/php:7.2']['status'])
+        self.assertEqual('pulled', results['mysql:5.7']['status'])
+
+        proxy = Proxy(version='1.7.0')
+        proxy.start('bench_stakkr')
+        self.assertTrue(docker_actions.container_running('proxy_stakkr'))
+        # mysql then traefik
+        self.assertEqual(2, self.server.calls['image_pull'])
+        proxy.stop()
+        self.assertFalse(docker_actions.container_running('proxy_stakkr'))
+
+    def test_cli_status(self):
+        """The whole command, in a new process"""
+        env = dict(os.environ, STAKKR_DAEMON='0', PYTHONPATH=base_dir + '/..')
+        config = base_dir + '/static/stakkr.yml'
+        server = FakeDockerServer('static', containers=2).start()
+        env['DOCKER_HOST'] = server.base_url
+        result = subprocess.run([sys.executable, '-m', 'stakkr.cli', '-c', config, 'status'], env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        server.stop()
+
+        self.assertEqual(0, result.returncode, result.stderr.decode())
+        self.assertRegex(result.stdout.decode(), r'service0\s+.*192\.168\.1\.2')
+        self.assertEqual(1, server.calls['containers_list'])
+
+
+if __name__ == "__main__":
+    unittest.main()
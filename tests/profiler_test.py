@@ -0,0 +1,66 @@
+import io
+import os
+import subprocess
+import sys
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+from stakkr import profiler
+
+base_dir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, base_dir + '/../')
+
+
+# https://docs.python.org/3/library/unittest.html#assert-methods
+class ProfilerTest(unittest.TestCase):
+    def tearDown(self):
+        profiler.stop_profile()
+
+    def test_not_profiled(self):
+        self.assertIsNone(profiler.get_profile())
+        with profiler.phase('config'):
+            pass
+        self.assertEqual(3, profiler.wrap('sum', sum)([1, 2]))
+        self.assertIsNone(profiler.stop_profile())
+
+    def test_phases(self):
+        """Phases are listed when they start, summed when run again, child processes are timed"""
+        profile = profiler.start_profile('start')
+        with profiler.phase('compose up'):
+            with profiler.phase('render'):
+                pass
+            subprocess.run([sys.executable, '-c', 'sum(range(3000000))'])
+        profiler.wrap('render', lambda: None)()
+        self.assertIs(profile, profiler.stop_profile())
+
+        record = profile.get_record()
+        self.assertEqual('start', record['command'])
+        self.assertEqual(['compose up', 'render'], [phase['name'] for phase in record['phases']])
+        self.assertEqual([1, 2], [phase['calls'] for phase in record['phases']])
+        self.assertGreater(record['phases'][0]['children_cpu'], 0)
+        self.assertGreaterEqual(record['wall'], record['phases'][0]['wall'])
+
+        stream = io.StringIO()
+        profile.display(stream)
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(['Phase', 'Calls', 'Wall', '(s)', 'CPU', '(s)', 'Children', '(s)'], lines[1].split())
+        self.assertEqual(['render', '2'], lines[3].split()[:2])
+        self.assertEqual('total', lines[4].split()[0])
+
+    def test_save(self):
+        project_dir = mkdtemp()
+        profile = profiler.start_profile('status')
+        with profiler.phase('containers'):
+            pass
+        profile.save(project_dir)
+        profile.save(project_dir)
+
+        with open(project_dir + '/.stakkr/timings.jsonl') as stream:
+            lines = stream.read().splitlines()
+        self.assertEqual(2, len(lines))
+        self.assertIn('"command": "status"', lines[0])
+        rmtree(project_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import os
+import sys
+import unittest
+from unittest import mock
+from docker.errors import ImageNotFound
+from stakkr import docker_actions
+from stakkr.proxy import Proxy
+
+base_dir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, base_dir + '/../')
+
+
+# https://docs.python.org/3/library/unittest.html#assert-methods
+class ProxyTest(unittest.TestCase):
+    def test_pull_missing(self):
+        """By default, the image is pulled only if it's not there"""
+        client = _pull_image()
+        client.images.get.assert_called_once_with('traefik:1.7.0')
+        client.images.pull.assert_not_called()
+
+        client = _pull_image(image_exists=False)
+        client.images.pull.assert_called_once_with('traefik:1.7.0')
+
+    def test_pull_always(self):
+        client = _pull_image('always')
+        client.images.get.assert_not_called()
+        client.images.pull.assert_called_once_with('traefik:1.7.0')
+
+    def test_pull_never(self):
+        client = _pull_image('never', image_exists=False)
+        client.images.get.assert_not_called()
+        client.images.pull.assert_not_called()
+
+
+def _pull_image(pull: str = None, image_exists: bool = True):
+    client = mock.Mock()
+    if image_exists is False:
+        client.images.get.side_effect = ImageNotFound('No such image')
+
+    params = {} if pull is None else {'pull': pull}
+    with mock.patch.object(docker_actions, 'get_client', return_value=client):
+        Proxy(version='1.7.0', **params)._pull_image()
+
+    return client
+
+
+if __name__ == "__main__":
+    unittest.main()
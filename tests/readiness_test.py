@@ -0,0 +1,115 @@
+import os
+import socket
+import sys
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+from stakkr import docker_actions
+from stakkr.readiness import Probe, get_probe, wait_for
+
+base_dir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, base_dir + '/../')
+
+PROXY_ON = {'enabled': True, 'http_port': 80}
+PROXY_OFF = {'enabled': False, 'http_port': 80}
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    """Answer with the status given by the Host header: 503.localhost returns a 503."""
+
+    def do_GET(self):
+        self.send_response(int(self.headers['Host'].split('.')[0]))
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+# https://docs.python.org/3/library/unittest.html#assert-methods
+class ReadinessTest(unittest.TestCase):
+    def test_get_probe(self):
+        ct_info = _ct_info(ports=['8080'])
+        api = mock.Mock()
+        api.inspect_container.return_value = {'State': {}}
+        with mock.patch.object(docker_actions, 'get_api_client', return_value=api):
+            probe = get_probe(ct_info, {'service_url': 'http://{}/admin'}, PROXY_ON)
+            self.assertEqual('health', probe.kind)
+            self.assertEqual('http', probe.fallback.kind)
+            self.assertEqual(('127.0.0.1', 80), probe.fallback.address)
+            self.assertEqual(('php.bench.localhost', '/admin'), (probe.fallback.http_host, probe.fallback.path))
+
+            probe = get_probe(ct_info, {'service_url': 'http://{}', 'ready': {'port': 9000}}, PROXY_OFF).fallback
+            self.assertEqual((('192.168.1.3', 9000), '192.168.1.3'), (probe.address, probe.http_host))
+
+            self.assertEqual(('127.0.0.1', 8080), get_probe(ct_info, {}, PROXY_ON).fallback.address)
+            probe = get_probe(ct_info, {'ready': {'probe': 'tcp', 'port': 3306}}, PROXY_ON)
+            self.assertEqual(('tcp', ('192.168.1.3', 3306)), (probe.kind, probe.address))
+            self.assertEqual('running', get_probe(_ct_info(), {}, PROXY_ON).fallback.kind)
+
+        with self.assertRaisesRegex(ValueError, 'Unknown probe "ping" for php'):
+            get_probe(ct_info, {'ready': {'probe': 'ping'}}, PROXY_ON)
+        # Nothing published, and no port given
+        with self.assertRaisesRegex(ValueError, 'The probe "tcp" of php needs a port.*set ready.port'):
+            get_probe(_ct_info(), {'ready': {'probe': 'tcp'}}, PROXY_ON)
+
+    def test_wait_tcp(self):
+        """A port that accepts connections is ready, a closed one is not"""
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen()
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        probes = [Probe('mysql', 'tcp', address=server.getsockname()),
+                  Probe('redis', 'tcp', address=closed.getsockname()),
+                  Probe('maildev', 'running')]
+        results = wait_for(probes, 0.5, max_delay=0.1)
+        server.close()
+        closed.close()
+
+        self.assertEqual('tcp', results['mysql']['probe'])
+        self.assertLess(results['mysql']['seconds'], 0.5)
+        self.assertIsNone(results['redis']['seconds'])
+        self.assertIsNotNone(results['maildev']['seconds'])
+
+    def test_wait_http(self):
+        server = HTTPServer(('127.0.0.1', 0), StatusHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        statuses = ['200', '302', '404', '502']
+        probes = [Probe(status, 'http', address=server.server_address, http_host=status + '.localhost')
+                  for status in statuses]
+        results = wait_for(probes, 0.5, max_delay=0.1)
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+        self.assertEqual([True, True, False, False], [results[status]['seconds'] is not None for status in statuses])
+
+    def test_wait_health(self):
+        """The healthcheck is probed again until it's healthy, without one the fallback is used"""
+        api = mock.Mock()
+        api.inspect_container.side_effect = [
+            {'State': {'Health': {'Status': 'starting'}}},
+            {'State': {'Health': {'Status': 'starting'}}},
+            {'State': {'Health': {'Status': 'healthy'}}}]
+        probe = Probe('php', 'health', ct_id='1', fallback=Probe('php', 'running'))
+        with mock.patch.object(docker_actions, 'get_api_client', return_value=api):
+            results = wait_for([probe], 2, max_delay=0.1)
+        self.assertEqual('health', results['php']['probe'])
+        self.assertIsNotNone(results['php']['seconds'])
+        self.assertEqual(3, api.inspect_container.call_count)
+
+        api.inspect_container.side_effect = None
+        api.inspect_container.return_value = {'State': {}}
+        with mock.patch.object(docker_actions, 'get_api_client', return_value=api):
+            self.assertEqual('running', wait_for([probe], 2)['php']['probe'])
+
+
+def _ct_info(ports: list = ()):
+    return {'id': '1', 'compose_name': 'php', 'ip': '192.168.1.3', 'ports': list(ports),
+            'traefik_host': 'php.bench.localhost'}
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+import os
+import sys
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import mock
+from stakkr import services_index
+from stakkr.file_utils import get_lib_basedir, read_json
+from tests.temp_files import make_temp_dir, write_file
+
+base_dir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, base_dir + '/../')
+
+
+# https://docs.python.org/3/library/unittest.html#assert-methods
+class ServicesIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.project_dir = mkdtemp()
+        _write_pack(self.project_dir, 'b_pack', ['php', 'portainer'])
+        _write_pack(self.project_dir, 'a_pack', ['php', 'mysql'], config=False)
+
+    def tearDown(self):
+        rmtree(self.project_dir)
+
+    def test_index(self):
+        index = services_index.ServicesIndex(self.project_dir)
+        services = index.get_services()
+
+        services_dir = self.project_dir + '/services'
+        # Packs override stakkr's services, by pack name
+        self.assertEqual(services_dir + '/b_pack/docker-compose/php.yml', services['php'])
+        self.assertEqual(services_dir + '/b_pack/docker-compose/portainer.yml', services['portainer'])
+        self.assertEqual(services_dir + '/a_pack/docker-compose/mysql.yml', index.get_service_file('mysql'))
+        self.assertIsNone(index.get_service_file('redis'))
+
+        self.assertEqual(([services_dir + '/b_pack/config_default.yml'], [services_dir + '/b_pack/config_schema.yml']),
+                         index.get_config_files())
+        self.assertEqual(['a_pack', 'b_pack'], sorted(index.get_packs()))
+        self.assertEqual(4, len(index.get_packs()['b_pack']['signatures']))
+
+        saved = read_json(self.project_dir + '/.stakkr/services.json')
+        self.assertEqual(services, saved['services'])
+
+    def test_index_without_packs(self):
+        project_dir = make_temp_dir(self)
+        index = services_index.ServicesIndex(project_dir)
+        self.assertEqual({'portainer': get_lib_basedir() + '/static/services/portainer.yml'}, index.get_services())
+        self.assertEqual(([], []), index.get_config_files())
+
+    def test_index_is_reused(self):
+        services_index.ServicesIndex(self.project_dir).get_services()
+        with mock.patch('stakkr.services_index._build_index', wraps=services_index._build_index) as build:
+            index = services_index.ServicesIndex(self.project_dir)
+            index.get_services()
+            index.get_service_file('php')
+            build.assert_not_called()
+
+            # A new service
+            write_file(self.project_dir + '/services/a_pack/docker-compose/redis.yml', 'services: {}')
+            self.assertEqual(self.project_dir + '/services/a_pack/docker-compose/redis.yml',
+                             index.check().get_service_file('redis'))
+            self.assertEqual(1, build.call_count)
+
+            # A pack removed
+            rmtree(self.project_dir + '/services/a_pack')
+            self.assertIsNone(index.check().get_service_file('mysql'))
+            self.assertEqual(2, build.call_count)
+
+    def test_get_services_index(self):
+        with mock.patch.dict('stakkr.services_index.__indexes__', clear=True):
+            index = services_index.get_services_index(self.project_dir)
+            index.get_services()
+            # Checked once per process: the directories are not listed again
+            with mock.patch.object(services_index.ServicesIndex, '_get_key') as get_key:
+                self.assertIs(index, services_index.get_services_index(self.project_dir))
+            get_key.assert_not_called()
+            with mock.patch('stakkr.services_index._build_index', wraps=services_index._build_index) as build:
+                services_index.rebuild_services_index(self.project_dir)
+            build.assert_called_once_with(self.project_dir + '/services')
+
+
+def _write_pack(project_dir: str, pack: str, services: list, config: bool = True):
+    os.makedirs('{}/services/{}/docker-compose'.format(project_dir, pack))
+    for service in services:
+        write_file('{}/services/{}/docker-compose/{}.yml'.format(project_dir, pack, service), 'services: {}')
+
+    if config is True:
+        write_file('{}/services/{}/config_default.yml'.format(project_dir, pack), 'services: {}')
+        write_file('{}/services/{}/config_schema.yml'.format(project_dir, pack), 'properties: {}')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -38,6 +38,101 @@ class StakkrComposeTest(unittest.TestCase):
     def test_get_gid_whenset(self):
         self.assertEqual(sc._get_gid(1000), '1000')
 
+    def test_get_environment(self):
+        """The environment is built in memory, os.environ is not changed"""
+        config = {
+            'project_dir': '/tmp/bench', 'project_name': 'bench', 'subnet': '', 'uid': 1000, 'gid': None,
+            'proxy': {'enabled': True, 'domain': 'localhost'},
+            'services': {'php': {'enabled': True, 'version': 7.2}, 'mysql': {'enabled': False, 'version': 5.7}}}
+        environ = os.environ.copy()
+        environment = sc.get_environment(config)
+        self.assertEqual(environ, os.environ)
+
+        self.assertEqual('/tmp/bench', environment['COMPOSE_BASE_DIR'])
+        self.assertEqual('bench', environment['DOCKER_PROJECT_NAME'])
+        self.assertEqual('7.2', environment['DOCKER_PHP_VERSION'])
+        self.assertNotIn('DOCKER_MYSQL_VERSION', environment)
+        self.assertEqual('1000', environment['DOCKER_UID'])
+        self.assertEqual(sc._get_gid(None), environment['DOCKER_GID'])
+        self.assertEqual('True', environment['PROXY_ENABLED'])
+
+        # Sections compose doesn't use are not exported: changing them doesn't render the compose file again
+        other_config = dict(config, aliases={'test': {'exec': []}}, exec={'engine': 'session'}, wait={'timeout': 1})
+        self.assertEqual(environment, sc.get_environment(other_config))
+
+    def test_get_compose_files(self):
+        config = {'project_dir': base_dir + '/static', 'subnet': '192.168.23.0/24',
+                  'services': {'portainer': {'enabled': True}, 'maildev': {'enabled': False}}}
+        files = sc.get_compose_files(config)
+        self.assertEqual(2, len(files))
+        self.assertTrue(files[0].endswith('static/docker-compose.subnet.yml'))
+        self.assertTrue(files[1].endswith('static/services/portainer.yml'))
+        self.assertEqual(['docker-compose', '-f'] + files[:1] + ['-f'] + files[1:] + ['-p', 'bench'],
+                         sc._get_compose_command(dict(config, project_name='bench'), files))
+
+    def test_get_rendered_compose_file(self):
+        """Compose files are rendered once, then again only if something changes"""
+        from shutil import rmtree
+        from tempfile import mkdtemp
+        from unittest import mock
+
+        project_dir = mkdtemp()
+        config = {
+            'project_dir': project_dir, 'project_name': 'bench', 'subnet': '', 'uid': None, 'gid': None,
+            'proxy': {'enabled': True, 'domain': 'localhost'}, 'services': {'portainer': {'enabled': True}}}
+        rendered = subprocess.CompletedProcess([], 0, b'services: {}\n', b'')
+        with mock.patch('subprocess.run', return_value=rendered) as run:
+            rendered_file = sc.get_rendered_compose_file(config)
+            self.assertEqual(rendered_file, sc.get_rendered_compose_file(config))
+            self.assertEqual(1, run.call_count)
+            self.assertEqual(['docker-compose', '-f'], run.call_args[0][0][:2])
+            self.assertEqual(['-p', 'bench', 'config'], run.call_args[0][0][-3:])
+            self.assertEqual('bench', run.call_args[1]['env']['COMPOSE_PROJECT_NAME'])
+
+            self.assertEqual(['docker-compose', '-f', rendered_file, '-p', 'bench'], sc._get_base_command(config))
+            self.assertEqual(1, run.call_count)
+
+            # A variable used by the compose files changes
+            config['proxy']['domain'] = 'example.com'
+            self.assertEqual(rendered_file, sc.get_rendered_compose_file(config))
+            self.assertEqual(2, run.call_count)
+
+        with open(rendered_file) as stream:
+            self.assertRegex(stream.read(), r'^# Rendered by stakkr-compose, key: [0-9a-f]+\nservices: {}\n$')
+
+        with mock.patch('subprocess.run', return_value=subprocess.CompletedProcess([], 1, b'', b'Error')):
+            config['proxy']['domain'] = 'localhost'
+            self.assertIsNone(sc.get_rendered_compose_file(config))
+
+        rmtree(project_dir)
+
+    def test_render_key_included_files(self):
+        """Files read through env_file and extends are part of the key"""
+        from tests.temp_files import make_temp_dir, write_file
+
+        project_dir = make_temp_dir(self)
+        files = {
+            'docker-compose.yml': "services:\n  php:\n    extends: {file: common/base.yml, service: base}\n"
+                                  "    env_file: ${STAKKR_ENV_DIR}/php.env\n",
+            'common/base.yml': "services:\n  base:\n    env_file: [base.env]\n",
+            'common/base.env': 'A=1\n',
+            'conf/php.env': 'B=1\n'}
+        for filename, content in files.items():
+            os.makedirs(os.path.dirname(project_dir + '/' + filename), exist_ok=True)
+            write_file(project_dir + '/' + filename, content)
+
+        compose_files = [project_dir + '/docker-compose.yml']
+        environment = {'STAKKR_ENV_DIR': 'conf'}
+        key = sc._get_render_key(compose_files, environment)
+        self.assertEqual(key, sc._get_render_key(compose_files, environment))
+
+        for filename, content in (('conf/php.env', 'B=2\n'), ('common/base.env', 'A=2\n'),
+                                  ('common/base.yml', "services:\n  base:\n    env_file: [base.env]\n    tty: true\n")):
+            write_file(project_dir + '/' + filename, content)
+            new_key = sc._get_render_key(compose_files, environment)
+            self.assertNotEqual(key, new_key, filename)
+            key = new_key
+
     # def test_get_wrong_enabled_service(self):
     #     with self.assertRaises(SystemExit):
     #         sc._get_enabled_services_files(['c'])
@@ -0,0 +1,19 @@
+"""Files written by the tests, in temporary directories removed after each test (even if it fails)."""
+
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+
+def make_temp_dir(test: unittest.TestCase):
+    """A temporary directory, removed when the test ends."""
+    path = mkdtemp()
+    test.addCleanup(shutil.rmtree, path, True)
+
+    return path
+
+
+def write_file(filename: str, content: str):
+    """Write a text file, replacing it."""
+    with open(filename, 'w') as stream:
+        stream.write(content)
@@ -0,0 +1,123 @@
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import unittest
+from tempfile import mkdtemp
+from stakkr.watcher import Trigger, Watcher, _Inotify, get_roots
+from tests.temp_files import write_file
+
+base_dir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, base_dir + '/../')
+
+
+# https://docs.python.org/3/library/unittest.html#assert-methods
+class WatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.project_dir = mkdtemp()
+        os.makedirs(self.project_dir + '/www/app/src')
+        os.makedirs(self.project_dir + '/www/app/vendor')
+        write_file(self.project_dir + '/.gitignore', 'www/app/vendor/\n*.log\n')
+        subprocess.run(['git', 'init', '-q', self.project_dir], check=True)
+        self.runs = []
+        self.running = {'lint': 0, 'composer': 0}
+        self.max_running = {'lint': 0, 'composer': 0}
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        shutil.rmtree(self.project_dir)
+
+    def test_trigger(self):
+        trigger = Trigger('lint', ['www/**/*.php', 'www/app/composer.lock'])
+        self.assertTrue(trigger.matches('www/index.php'))
+        self.assertTrue(trigger.matches('www/app/src/Controller/Home.php'))
+        self.assertTrue(trigger.matches('www/app/composer.lock'))
+        self.assertFalse(trigger.matches('www/index.phpx'))
+        self.assertFalse(trigger.matches('conf/index.php'))
+        self.assertFalse(trigger.matches('www/app/composer.json'))
+
+        self.assertTrue(Trigger('css', ['www/*.scss']).matches('www/main.scss'))
+        self.assertFalse(Trigger('css', ['www/*.scss']).matches('www/css/main.scss'))
+
+    def test_roots(self):
+        self.assertEqual(['www/app'], get_roots(self.project_dir, ['www/app/src/**/*.php', 'www/app/*.lock']))
+        # Missing directories are watched from their parent
+        self.assertEqual(['www'], get_roots(self.project_dir, ['www/assets/*.js', 'www/app/src/*.php']))
+        self.assertEqual([''], get_roots(self.project_dir, ['*.yml', 'www/*.php']))
+
+    def test_inotify(self):
+        try:
+            _Inotify(self.project_dir, [''], set()).close()
+        except (AttributeError, OSError) as error:
+            self.skipTest('inotify is not available: {}'.format(error))
+
+        self._test_watch(False)
+
+    def test_polling(self):
+        self._test_watch(True)
+
+    def _test_watch(self, poll: bool):
+        triggers = [Trigger('lint', ['www/**/*.php']), Trigger('composer', ['www/app/composer.lock'])]
+        watcher = Watcher(self.project_dir, triggers, self._run_alias, 0.2, poll)
+        stop = threading.Event()
+        thread = threading.Thread(target=watcher.run, args=(stop,))
+        thread.start()
+        try:
+            # A burst of changes: a single run, even in a new directory
+            for num in range(100):
+                write_file('{}/www/app/src/file{}.php'.format(self.project_dir, num), '<?php')
+            os.makedirs(self.project_dir + '/www/app/src/new')
+            write_file(self.project_dir + '/www/app/src/new/file.php', '<?php')
+            self._wait_runs(1)
+            self.assertEqual(['lint'], self.runs)
+
+            # Ignored by git, or not matched
+            write_file(self.project_dir + '/www/app/vendor/lib.php', '<?php')
+            write_file(self.project_dir + '/www/app/debug.log', 'log')
+            write_file(self.project_dir + '/www/app/README', 'readme')
+            time.sleep(1.5)
+            self.assertEqual(['lint'], self.runs)
+
+            # composer is slow: changes while it runs make it run once more, after. lint can run meanwhile
+            write_file(self.project_dir + '/www/app/composer.lock', '{}')
+            self._wait_runs(2)
+            for num in range(3):
+                write_file(self.project_dir + '/www/app/composer.lock', '{"version": %d}' % num)
+                time.sleep(0.3)
+            write_file(self.project_dir + '/www/app/src/file0.php', '<?php // lint')
+            self._wait_runs(4)
+            time.sleep(2)
+            self.assertEqual(['composer', 'composer', 'lint', 'lint'], sorted(self.runs))
+        finally:
+            stop.set()
+            thread.join(10)
+
+        # Never twice the same alias at the same time
+        self.assertEqual({'lint': 1, 'composer': 1}, self.max_running)
+
+    def _run_alias(self, alias: str):
+        with self.lock:
+            self.runs.append(alias)
+            self.running[alias] += 1
+            self.max_running[alias] = max(self.max_running[alias], self.running[alias])
+        # A slow alias, changes come while it runs
+        time.sleep(2 if alias == 'composer' else 0.1)
+        with self.lock:
+            self.running[alias] -= 1
+
+        return 0
+
+    def _wait_runs(self, num: int):
+        for _ in range(500):
+            with self.lock:
+                if len(self.runs) >= num:
+                    return
+            time.sleep(0.01)
+
+        self.fail('{} runs expected, got {}'.format(num, self.runs))
+
+
+if __name__ == "__main__":
+    unittest.main()